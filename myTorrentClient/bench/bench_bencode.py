@@ -0,0 +1,62 @@
+# File: bench/bench_bencode.py
+# -----------------------------
+# Torrent parse cost: bencodepy decode + re-encode of info (the previous
+# parser) against the single-pass utils.bencode_utils decoder.
+# Run: python bench/bench_bencode.py [--json]
+import hashlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.bencode_utils import decode_torrent, encode
+
+try:
+    import bencodepy
+except ImportError:
+    bencodepy = None
+
+def make_torrent(pieces, files):
+    info = {
+        b'name': b'bench',
+        b'piece length': 2 ** 18,
+        b'pieces': os.urandom(20 * pieces),
+        b'files': [{b'length': 12345 + i, b'path': [b'dir', b'file%d.bin' % i]} for i in range(files)],
+    }
+    return encode({b'announce': b'http://127.0.0.1/announce', b'info': info})
+
+def parse_bencodepy(raw):
+    data = bencodepy.decode(raw)
+    return hashlib.sha1(bencodepy.encode(data[b'info'])).digest()
+
+def parse_single_pass(raw):
+    _, (start, end) = decode_torrent(raw)
+    return hashlib.sha1(memoryview(raw)[start:end]).digest()
+
+def timeit(fn, raw, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(raw)
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    results = []
+    for pieces, files, rounds in ((1000, 10, 200), (100000, 10, 20), (20000, 5000, 10)):
+        raw = make_torrent(pieces, files)
+        row = {'pieces': pieces, 'files': files, 'bytes': len(raw),
+               'single_pass_ms': round(timeit(parse_single_pass, raw, rounds) * 1000, 3)}
+        line = f"{pieces:>7} pieces {files:>5} files: single-pass {row['single_pass_ms']:8.3f} ms"
+        if bencodepy is not None:
+            assert parse_bencodepy(raw) == parse_single_pass(raw)
+            row['bencodepy_ms'] = round(timeit(parse_bencodepy, raw, rounds) * 1000, 3)
+            row['speedup'] = round(row['bencodepy_ms'] / row['single_pass_ms'], 2)
+            line += f"   bencodepy {row['bencodepy_ms']:8.3f} ms   x{row['speedup']:.2f}"
+        results.append(row)
+        print(line)
+    if '--json' in sys.argv:
+        print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
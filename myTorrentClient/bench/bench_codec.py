@@ -0,0 +1,89 @@
+# File: bench/bench_codec.py
+# -----------------------------
+# Messages/sec of the buffered MessageDecoder against the previous
+# readexactly-per-field reader loop. Run: python bench/bench_codec.py
+import asyncio
+import json
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from peer.protocol import MessageDecoder, PIECE
+
+CHUNK = 2 ** 16   # bytes handed to the reader per socket read
+
+def make_stream(kind, count):
+    if kind == 'piece':
+        block = os.urandom(2 ** 14)
+        msg = struct.pack('>IBII', 9 + len(block), PIECE, 1, 0) + block
+    else:
+        msg = struct.pack('>IBI', 5, 4, 1)
+    return msg * count
+
+async def feed(reader, data):
+    # Hands the stream over one socket-sized chunk per loop iteration
+    for i in range(0, len(data), CHUNK):
+        reader.feed_data(data[i:i + CHUNK])
+        await asyncio.sleep(0)
+    reader.feed_eof()
+
+async def readexactly_loop(reader, piece_buf):
+    # The loop PeerConnection used before: length, id and body read separately
+    count = 0
+    try:
+        while True:
+            length = struct.unpack('>I', await reader.readexactly(4))[0]
+            msg_id = (await reader.readexactly(1))[0]
+            body = await reader.readexactly(length - 1)
+            if msg_id == PIECE:
+                piece_buf[:len(body) - 8] = memoryview(body)[8:]
+            count += 1
+    except asyncio.IncompleteReadError:
+        return count
+
+async def decoder_loop(reader, piece_buf):
+    decoder = MessageDecoder()
+    count = 0
+
+    def handler(msg_id, payload):
+        nonlocal count
+        if msg_id == PIECE:
+            piece_buf[:len(payload) - 8] = payload[8:]
+        count += 1
+
+    while True:
+        data = await reader.read(CHUNK)
+        if not data:
+            return count
+        decoder.feed(data, handler)
+
+def bench(kind, count, loop_fn):
+    data = make_stream(kind, count)
+    piece_buf = bytearray(2 ** 14)
+
+    async def run():
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        start = time.perf_counter()
+        done, _ = await asyncio.gather(loop_fn(reader, piece_buf), feed(reader, data))
+        return done, time.perf_counter() - start
+
+    done, elapsed = asyncio.run(run())
+    assert done == count
+    return count / elapsed
+
+def main():
+    results = []
+    for kind, count in (('piece', 20000), ('have', 300000)):
+        old = bench(kind, count, readexactly_loop)
+        new = bench(kind, count, decoder_loop)
+        results.append({'message': kind, 'readexactly_msgs_per_sec': round(old),
+                        'decoder_msgs_per_sec': round(new), 'speedup': round(new / old, 2)})
+        print(f"{kind:>6}: readexactly {old:12,.0f} msg/s   decoder {new:12,.0f} msg/s   x{new / old:.2f}")
+    if '--json' in sys.argv:
+        print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
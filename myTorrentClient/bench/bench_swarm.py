@@ -0,0 +1,190 @@
+# File: bench/bench_swarm.py
+# -----------------------------
+# End-to-end download benchmark against a localhost swarm. Seeders and the
+# tracker run in this process; main.main runs in a child process so its
+# CPU time and peak RSS are measured on their own.
+# Run: python bench/bench_swarm.py --size 64 --peers 4 --latency 20 --json
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+from fakeswarm import HTTPTracker, SeedPeer, UDPTracker, WebSeedServer, make_torrent, write_torrent
+
+RESULT_PREFIX = 'BENCH-RESULT '
+
+def run_client(torrent, hash_workers, max_connections, sequential=False):
+    # Child side: drive main.main and report timings on one tagged line
+    from main import main
+    from pieces.manager import PieceManager
+
+    start = time.perf_counter()
+    first_piece = []
+    mark_complete = PieceManager.mark_complete
+
+    def timed_mark_complete(self, index):
+        if not first_piece:
+            first_piece.append(time.perf_counter() - start)
+        return mark_complete(self, index)
+
+    PieceManager.mark_complete = timed_mark_complete
+    asyncio.run(main(torrent, hash_workers, max_connections, sequential=sequential))
+    result = {'seconds': time.perf_counter() - start,
+              'time_to_first_piece': first_piece[0] if first_piece else None,
+              'cpu_seconds': None, 'peak_rss_mb': None}
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        result['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        result['peak_rss_mb'] = usage.ru_maxrss / scale
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+def seeder_settings(args, i):
+    # The first --corrupt peers send bad data, the next --chokers choke
+    # periodically and the next --droppers disconnect; the rest are honest
+    settings = {'latency': args.latency / 1000, 'rate': args.rate * 1024}
+    if i < args.corrupt:
+        settings['corrupt'] = 3
+    elif i < args.corrupt + args.chokers:
+        settings['choke_every'] = 64
+    elif i < args.corrupt + args.chokers + args.droppers:
+        settings['drop_after'] = 48
+    return settings
+
+def downloaded_bytes(directory, info):
+    base = os.path.join(directory, info[b'name'].decode())
+    if b'files' not in info:
+        with open(base, 'rb') as f:
+            return f.read()
+    parts = []
+    for entry in info[b'files']:
+        with open(os.path.join(base, *[p.decode() for p in entry[b'path']]), 'rb') as f:
+            parts.append(f.read())
+    return b''.join(parts)
+
+async def run_once(args, workdir):
+    size = int(args.size * 2 ** 20)
+    info, data, info_hash = make_torrent(size, args.piece_length * 1024, args.files)
+    seeders = [SeedPeer(data, info_hash, args.piece_length * 1024, **seeder_settings(args, i))
+               for i in range(args.peers)]
+    peers = [await s.start() for s in seeders]
+    tracker = UDPTracker(peers) if args.tracker == 'udp' else HTTPTracker(peers)
+    announce = await tracker.start()
+    web_seed = WebSeedServer(info, data) if args.web_seed else None
+    url_list = [await web_seed.start()] if web_seed else []
+    torrent = write_torrent(os.path.join(workdir, 'bench.torrent'), info, announce, url_list)
+
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--client', torrent,
+        '--hash-workers', str(args.hash_workers), '--max-connections', str(args.max_connections),
+        *(['--sequential'] if args.sequential else []),
+        cwd=workdir, stdout=asyncio.subprocess.PIPE,
+        stderr=None if args.verbose else asyncio.subprocess.DEVNULL)
+    try:
+        out, _ = await asyncio.wait_for(proc.communicate(), args.timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        out = b''
+    finally:
+        for s in seeders:
+            s.close()
+        await tracker.close()
+        if web_seed is not None:
+            await web_seed.close()
+
+    client = {}
+    for line in out.decode(errors='replace').splitlines():
+        if line.startswith(RESULT_PREFIX):
+            client = json.loads(line[len(RESULT_PREFIX):])
+        elif args.verbose:
+            print(line, file=sys.stderr)
+    try:
+        verified = downloaded_bytes(workdir, info) == data
+    except OSError:
+        verified = False
+
+    seconds = client.get('seconds')
+    result = {
+        'size_mb': args.size, 'piece_length_kb': args.piece_length, 'files': args.files,
+        'peers': args.peers, 'tracker': args.tracker, 'latency_ms': args.latency,
+        'rate_kbps': args.rate, 'corrupt': args.corrupt, 'chokers': args.chokers,
+        'droppers': args.droppers, 'sequential': args.sequential, 'web_seed': args.web_seed,
+        'ok': bool(client) and verified,
+        'seconds': seconds,
+        'mb_per_s': size / 2 ** 20 / seconds if seconds else None,
+        'time_to_first_piece': client.get('time_to_first_piece'),
+        'cpu_seconds': client.get('cpu_seconds'),
+        'cpu_percent': 100 * client['cpu_seconds'] / seconds if seconds and client.get('cpu_seconds') else None,
+        'peak_rss_mb': client.get('peak_rss_mb'),
+        'served_mb': sum(s.uploaded for s in seeders) / 2 ** 20,
+        'web_seed_mb': web_seed.served / 2 ** 20 if web_seed else None,
+        'connections': sum(s.connections for s in seeders),
+        'announces': tracker.announces,
+    }
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Download benchmark against a localhost swarm')
+    parser.add_argument('--size', type=float, default=64, help='payload size in MB')
+    parser.add_argument('--piece-length', type=int, default=256, help='piece length in KB')
+    parser.add_argument('--files', type=int, default=1, help='number of files in the torrent')
+    parser.add_argument('--peers', type=int, default=4, help='number of seeding peers')
+    parser.add_argument('--tracker', choices=('http', 'udp'), default='http')
+    parser.add_argument('--latency', type=float, default=0, help='per-reply latency in ms')
+    parser.add_argument('--rate', type=int, default=0, help='per-connection upload rate in KB/s (0 = unlimited)')
+    parser.add_argument('--corrupt', type=int, default=0, help='peers that serve bad data for every third piece')
+    parser.add_argument('--chokers', type=int, default=0, help='peers that choke every 64 blocks')
+    parser.add_argument('--droppers', type=int, default=0, help='peers that disconnect after 48 blocks')
+    parser.add_argument('--sequential', action='store_true', help='run the client in streaming order')
+    parser.add_argument('--web-seed', action='store_true', help='also serve the payload as an HTTP web seed')
+    parser.add_argument('--hash-workers', type=int, default=0)
+    parser.add_argument('--max-connections', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before a run is abandoned')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per run')
+    parser.add_argument('--output', help='append JSON results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show client output')
+    parser.add_argument('--client', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    if args.client:
+        run_client(args.client, args.hash_workers, args.max_connections, args.sequential)
+        return
+    failed = False
+    for _ in range(args.repeat):
+        workdir = tempfile.mkdtemp(prefix='bench-swarm-')
+        try:
+            result = asyncio.run(run_once(args, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        failed = failed or not result['ok']
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{result['size_mb']:g} MB from {result['peers']} peers: "
+                  f"{result['mb_per_s'] or 0:.1f} MB/s, first piece {result['time_to_first_piece']}s, "
+                  f"cpu {result['cpu_seconds']}s, rss {result['peak_rss_mb']} MB"
+                  + ('' if result['ok'] else '  FAILED'))
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# File: bench/fakeswarm.py
+# -----------------------------
+# Localhost stand-ins for a swarm: synthetic torrents, an HTTP or UDP
+# tracker and seeding peers with scripted latency, bandwidth and faults.
+import asyncio
+import hashlib
+import os
+import socket
+import struct
+import time
+
+from aiohttp import web
+
+from utils.bencode_utils import encode
+
+CHOKE, UNCHOKE, BITFIELD, REQUEST, PIECE, CANCEL = 0, 1, 5, 6, 7, 8
+
+def make_torrent(size, piece_length=2 ** 18, files=1, name=b'bench'):
+    # Random payload and its info dict; returns (info, data, info_hash)
+    data = os.urandom(size)
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                      for i in range(0, size, piece_length))
+    info = {b'name': name, b'piece length': piece_length, b'pieces': pieces}
+    if files > 1:
+        step = size // files
+        lengths = [step] * (files - 1) + [size - step * (files - 1)]
+        info[b'files'] = [{b'length': n, b'path': [b'part%d.bin' % i]} for i, n in enumerate(lengths)]
+    else:
+        info[b'length'] = size
+    return info, data, hashlib.sha1(encode(info)).digest()
+
+def write_torrent(path, info, announce, url_list=()):
+    torrent = {b'announce': announce.encode(), b'info': info}
+    if url_list:
+        torrent[b'url-list'] = [url.encode() for url in url_list]
+    with open(path, 'wb') as f:
+        f.write(encode(torrent))
+    return path
+
+class SeedPeer:
+    # latency:     seconds added before each reply
+    # rate:        bytes/sec per connection (0 = unlimited)
+    # choke_every: choke after this many blocks, unchoke choke_time later
+    # corrupt:     serve garbage for pieces where index % corrupt == 0
+    # drop_after:  close the connection after this many blocks
+    def __init__(self, data, info_hash, piece_length, latency=0.0, rate=0,
+                 choke_every=0, choke_time=0.5, corrupt=0, drop_after=0):
+        self.data = data
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.latency = latency
+        self.rate = rate
+        self.choke_every = choke_every
+        self.choke_time = choke_time
+        self.corrupt = corrupt
+        self.drop_after = drop_after
+        self.uploaded = 0
+        self.connections = 0
+        self.server = None
+
+    async def start(self, host='127.0.0.1'):
+        self.server = await asyncio.start_server(self._serve, host, 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        queue = asyncio.Queue()
+        cancelled = set()
+        sender = asyncio.ensure_future(self._send(queue, cancelled, writer))
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return
+            writer.write(bytes([19]) + b'BitTorrent protocol' + bytes(8) + self.info_hash + b'-FS0001-' + os.urandom(12))
+            count = (len(self.data) + self.piece_length - 1) // self.piece_length
+            bitfield = bytearray(b'\xff' * (count // 8))
+            if count % 8:
+                bitfield.append((0xff << (8 - count % 8)) & 0xff)
+            writer.write(struct.pack('>IB', 1 + len(bitfield), BITFIELD) + bitfield)
+            writer.write(struct.pack('>IB', 1, UNCHOKE))
+            while not sender.done():
+                length = struct.unpack('>I', await reader.readexactly(4))[0]
+                if not length:
+                    continue
+                msg = await reader.readexactly(length)
+                if msg[0] == REQUEST:
+                    request = struct.unpack_from('>III', msg, 1)
+                    # A cancel for a block already sent must not swallow a
+                    # later request for it, e.g. after a failed hash check
+                    cancelled.discard(request[:2])
+                    queue.put_nowait((time.monotonic() + self.latency, request))
+                elif msg[0] == CANCEL:
+                    cancelled.add(struct.unpack_from('>II', msg, 1))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def _send(self, queue, cancelled, writer):
+        served = 0
+        next_send = time.monotonic()
+        while True:
+            due, (index, begin, length) = await queue.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if (index, begin) in cancelled:
+                cancelled.discard((index, begin))
+                continue
+            start = index * self.piece_length + begin
+            block = self.data[start:start + length]
+            if self.corrupt and index % self.corrupt == 0:
+                block = bytes(len(block))
+            if self.rate:
+                next_send = max(next_send, time.monotonic()) + len(block) / self.rate
+                await asyncio.sleep(next_send - time.monotonic())
+            writer.write(struct.pack('>IBII', 9 + len(block), PIECE, index, begin) + block)
+            await writer.drain()
+            self.uploaded += len(block)
+            served += 1
+            if self.drop_after and served >= self.drop_after:
+                writer.close()
+                return
+            if self.choke_every and served % self.choke_every == 0:
+                writer.write(struct.pack('>IB', 1, CHOKE))
+                await asyncio.sleep(self.choke_time)
+                # Requests that arrived while choked are discarded
+                while not queue.empty():
+                    queue.get_nowait()
+                writer.write(struct.pack('>IB', 1, UNCHOKE))
+
+class HTTPTracker:
+    def __init__(self, peers, interval=60):
+        self.peers = peers
+        self.interval = interval
+        self.announces = 0
+        self.runner = None
+
+    async def start(self, host='127.0.0.1'):
+        app = web.Application()
+        app.router.add_get('/announce', self._announce)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/announce'
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _announce(self, request):
+        self.announces += 1
+        body = encode({b'interval': self.interval, b'peers': compact(self.peers)})
+        return web.Response(body=body)
+
+class WebSeedServer:
+    # The payload over HTTP with Range support, laid out as a BEP 19 web seed
+    def __init__(self, info, data):
+        name = info[b'name'].decode()
+        self.files = {}
+        if b'files' in info:
+            offset = 0
+            for entry in info[b'files']:
+                path = '/'.join([name] + [p.decode() for p in entry[b'path']])
+                self.files[path] = (offset, entry[b'length'])
+                offset += entry[b'length']
+        else:
+            self.files[name] = (0, len(data))
+        self.data = memoryview(data)
+        self.requests = 0
+        self.served = 0
+        self.runner = None
+
+    async def start(self, host='127.0.0.1'):
+        app = web.Application()
+        app.router.add_get('/seed/{path:.+}', self._get)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/seed/'
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _get(self, request):
+        self.requests += 1
+        entry = self.files.get(request.match_info['path'])
+        if entry is None:
+            raise web.HTTPNotFound()
+        offset, length = entry
+        first, last = 0, length - 1
+        status = 200
+        if request.http_range.start is not None:
+            first = request.http_range.start
+            last = (request.http_range.stop or length) - 1
+            status = 206
+        body = self.data[offset + first:offset + last + 1]
+        self.served += len(body)
+        headers = {'Content-Range': f'bytes {first}-{last}/{length}'} if status == 206 else {}
+        return web.Response(body=bytes(body), status=status, headers=headers)
+
+class UDPTracker(asyncio.DatagramProtocol):
+    def __init__(self, peers, interval=60):
+        self.peers = peers
+        self.interval = interval
+        self.announces = 0
+        self.transport = None
+
+    async def start(self, host='127.0.0.1'):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, 0))
+        port = self.transport.get_extra_info('sockname')[1]
+        return f'udp://{host}:{port}/announce'
+
+    async def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 16:
+            return
+        _, action, tid = struct.unpack_from('>QII', data)
+        if action == 0:
+            reply = struct.pack('>IIQ', 0, tid, 0x5eed)
+        elif action == 1:
+            self.announces += 1
+            reply = struct.pack('>IIIII', 1, tid, self.interval, 0, len(self.peers)) + compact(self.peers)
+        else:
+            return
+        self.transport.sendto(reply, addr)
+
+def compact(peers):
+    return b''.join(socket.inet_aton(host) + struct.pack('>H', port) for host, port in peers)
@@ -4,14 +4,12 @@
 import sys
 import os
 import json
-import asyncio
-import threading
-import time
+import logging
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QTableWidget, QTableWidgetItem, QProgressBar,
     QToolBar, QAction, QFileDialog, QLineEdit,
     QWidget, QVBoxLayout, QLabel, QDialog, QFormLayout, QSlider, QComboBox,
-    QSplitter, QTextEdit, QPushButton, QHBoxLayout
+    QSplitter, QTextEdit, QPushButton, QHBoxLayout, QSpinBox
 )
 from PyQt5.QtGui import QIcon
 from PyQt5.QtCore import Qt, pyqtSignal, QObject
@@ -19,11 +17,7 @@ from PyQt5.QtCore import Qt, pyqtSignal, QObject
 # Ensure project root for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from torrent_parser.parser import TorrentParser
-from tracker.client import TrackerClient
-from peer.connection import PeerConnection
-from pieces.manager import PieceManager
-from pieces.storage import Storage
+from session.engine import SessionEngine
 
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.json')
 
@@ -32,7 +26,7 @@ class SettingsDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("Settings")
         layout = QFormLayout(self)
-        self.config = {'upload_limit': 0, 'download_limit': 0, 'theme': 'Light'}
+        self.config = {'upload_limit': 0, 'download_limit': 0, 'theme': 'Light', 'hash_workers': 0}
         if os.path.exists(CONFIG_PATH):
             try:
                 self.config.update(json.load(open(CONFIG_PATH)))
@@ -46,88 +40,40 @@ class SettingsDialog(QDialog):
         self.down_slider.setRange(0, 10000)
         self.down_slider.setValue(self.config['download_limit'])
         layout.addRow("Download Limit (KB/s):", self.down_slider)
+        self.hash_spin = QSpinBox()
+        self.hash_spin.setRange(0, 64)
+        self.hash_spin.setSpecialValueText('Auto')
+        self.hash_spin.setValue(self.config['hash_workers'])
+        layout.addRow("Hash Workers:", self.hash_spin)
         self.theme_combo = QComboBox()
         self.theme_combo.addItems(['Light', 'Dark'])
         self.theme_combo.setCurrentText(self.config['theme'])
         layout.addRow("Theme:", self.theme_combo)
-        save_btn = QAction("Save", self)
-        save_btn.triggered.connect(self.save)
+        save_btn = QPushButton("Save")
+        save_btn.clicked.connect(self.save)
         layout.addRow(save_btn)
 
     def save(self):
-        cfg = {'upload_limit': self.up_slider.value(),
-               'download_limit': self.down_slider.value(),
-               'theme': self.theme_combo.currentText()}
+        # Update the loaded config so keys this dialog does not edit
+        # (metrics_port) survive the rewrite
+        self.config.update({'upload_limit': self.up_slider.value(),
+                            'download_limit': self.down_slider.value(),
+                            'hash_workers': self.hash_spin.value(),
+                            'theme': self.theme_combo.currentText()})
         with open(CONFIG_PATH, 'w') as f:
-            json.dump(cfg, f)
+            json.dump(self.config, f)
         self.accept()
 
-class Worker(QObject):
+class EngineBridge(QObject):
+    # Engine callbacks run on the engine thread; emitting a signal queues
+    # them onto the GUI thread
     log_signal = pyqtSignal(str)
-    progress_signal = pyqtSignal(int, int)
+    update_signal = pyqtSignal(dict)
 
-    def __init__(self, source, row, table):
-        super().__init__()
-        self.source = source
-        self.row = row
-        self.table = table
-        cfg = {'download_limit': 0}
-        if os.path.exists(CONFIG_PATH):
-            try:
-                cfg.update(json.load(open(CONFIG_PATH)))
-            except:
-                pass
-        self.down_limit = cfg['download_limit'] * 1024  # bytes/sec
-        self.paused = False
-        self.stopped = False
-
-    def pause(self):
-        self.paused = True
-        self.log_signal.emit(f"[Worker] Paused row {self.row}")
-
-    def resume(self):
-        self.paused = False
-        self.log_signal.emit(f"[Worker] Resumed row {self.row}")
-
-    def stop(self):
-        self.stopped = True
-        self.log_signal.emit(f"[Worker] Stopped row {self.row}")
-
-    def run(self):
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.download())
-
-    async def download(self):
-        parser = TorrentParser(self.source)
-        metadata = parser.parse()
-        storage = Storage(metadata['name'], metadata['length'], metadata['piece_length'])
-        manager = PieceManager(metadata)
-        peers = await TrackerClient(metadata).get_peers()
-        if not peers:
-            self.log_signal.emit("[Worker] No peers found.")
-            return
-        conn = PeerConnection(peers[0], metadata, manager, storage)
-        total = len(manager.hash_list)
-        for i in range(total):
-            if self.stopped:
-                break
-            while self.paused:
-                await asyncio.sleep(0.2)
-            start = time.time()
-            try:
-                block_size = await conn.start_single(i, return_size=True)
-                elapsed = time.time() - start
-                if self.down_limit > 0 and elapsed > 0:
-                    to_sleep = max(0, block_size / self.down_limit - elapsed)
-                    await asyncio.sleep(to_sleep)
-                percent = int((i+1)/total * 100)
-                self.progress_signal.emit(self.row, percent)
-                self.log_signal.emit(f"[Worker] Piece {i+1}/{total} completed")
-            except Exception as e:
-                self.log_signal.emit(f"[Worker] Error on piece {i}: {e}")
-                break
-        self.log_signal.emit("[Worker] Download finished.")
+def format_rate(rate):
+    if rate >= 1024 * 1024:
+        return f"{rate / (1024 * 1024):.1f} MB/s"
+    return f"{rate / 1024:.0f} KB/s"
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -136,6 +82,27 @@ class MainWindow(QMainWindow):
         self.resize(900, 600)
         self._load_theme()
         self._init_ui()
+        cfg = self._load_config()
+        # One engine thread and event loop runs every torrent
+        self.rows = {}   # torrent id -> table row
+        self.bridge = EngineBridge()
+        self.bridge.log_signal.connect(self._append_log)
+        self.bridge.update_signal.connect(self._update_rows)
+        self.engine = SessionEngine(cfg.get('download_limit', 0) * 1024, cfg.get('upload_limit', 0) * 1024,
+                                    cfg.get('hash_workers', 0),
+                                    on_update=self.bridge.update_signal.emit,
+                                    on_log=self.bridge.log_signal.emit,
+                                    metrics_port=cfg.get('metrics_port'))
+        self.engine.start()
+
+    def _load_config(self):
+        cfg = {}
+        if os.path.exists(CONFIG_PATH):
+            try:
+                cfg = json.load(open(CONFIG_PATH))
+            except:
+                pass
+        return cfg
 
     def _load_theme(self):
         theme = 'Light'
@@ -193,6 +160,7 @@ class MainWindow(QMainWindow):
         pb = QProgressBar(); pb.setValue(0)
         self.table.setCellWidget(row,2,pb)
         self.table.setItem(row,3,QTableWidgetItem('0 KB/s'))
+        self.table.setItem(row,5,QTableWidgetItem('queued'))
         # Actions: play, pause, stop
         action_widget = QWidget(); h = QHBoxLayout(action_widget); h.setContentsMargins(0,0,0,0)
         play_btn = QPushButton(QIcon.fromTheme('media-playback-start'), '')
@@ -200,28 +168,45 @@ class MainWindow(QMainWindow):
         stop_btn = QPushButton(QIcon.fromTheme('media-playback-stop'), '')
         h.addWidget(play_btn); h.addWidget(pause_btn); h.addWidget(stop_btn)
         self.table.setCellWidget(row,4, action_widget)
-        # Worker
-        worker = Worker(source, row, self.table)
-        play_btn.clicked.connect(worker.resume)
-        pause_btn.clicked.connect(worker.pause)
-        stop_btn.clicked.connect(worker.stop)
-        worker.log_signal.connect(self._append_log)
-        worker.progress_signal.connect(self._update_progress)
-        thread = threading.Thread(target=worker.run, daemon=True)
-        thread.start()
-
-    def _update_progress(self,row,percent):
-        widget = self.table.cellWidget(row,2)
-        if isinstance(widget, QProgressBar): widget.setValue(percent)
+        # Hand the torrent to the session engine
+        torrent_id = self.engine.add(source)
+        self.rows[torrent_id] = row
+        play_btn.clicked.connect(lambda: self.engine.resume(torrent_id))
+        pause_btn.clicked.connect(lambda: self.engine.pause(torrent_id))
+        stop_btn.clicked.connect(lambda: self.engine.stop(torrent_id))
+
+    def _update_rows(self, snapshots):
+        latency = self.engine.stats()['peer_block_latency_seconds']
+        for torrent_id, snap in snapshots.items():
+            row = self.rows.get(torrent_id)
+            if row is None:
+                continue
+            self.table.item(row,0).setText(snap['name'])
+            self.table.item(row,1).setText(f"{snap['size'] / (1024 * 1024):.0f} MB")
+            widget = self.table.cellWidget(row,2)
+            if isinstance(widget, QProgressBar): widget.setValue(int(snap['progress'] * 100))
+            speed = self.table.item(row,3)
+            speed.setText(f"\u2193 {format_rate(snap['download_rate'])}  \u2191 {format_rate(snap['upload_rate'])}")
+            tip = [f"{n}. {format_rate(rate)}" for n, rate in enumerate(snap['peer_rates'][:10], 1)]
+            if latency['count']:
+                tip.append(f"Block latency p50 {latency['p50'] * 1000:g} ms, p99 {latency['p99'] * 1000:g} ms")
+            speed.setToolTip('\n'.join(tip))
+            self.table.item(row,5).setText(f"{snap['state']} ({snap['peers']} peers)")
 
     def _append_log(self,msg):
         self.log.append(msg)
 
     def open_settings(self):
         dlg = SettingsDialog(self)
-        dlg.exec_()
+        if dlg.exec_():
+            self.engine.set_limits(dlg.config['download_limit'] * 1024, dlg.config['upload_limit'] * 1024)
+
+    def closeEvent(self, event):
+        self.engine.shutdown()
+        super().closeEvent(event)
 
 if __name__=='__main__':
+    logging.basicConfig(level=logging.INFO, format='[%(name)s] %(message)s')
     app = QApplication(sys.argv)
     win = MainWindow()
     win.show()
@@ -1,57 +1,66 @@
 # File: main.py
 # -----------------------------
+import argparse
 import asyncio
-import aiohttp
-import os
-import sys
-from torrent_parser.parser import TorrentParser
-from tracker.client import TrackerClient
-from peer.connection import PeerConnection
-from pieces.manager import PieceManager
-from pieces.storage import Storage
+import logging
+from peer.swarm import MAX_CONNECTIONS
+from pieces.verifier import PieceVerifier
+from pieces.writer import MAX_PENDING
+from session.torrent import Torrent
+from utils import metrics
+from utils.ratelimit import TransferLimits
 
-async def main(torrent_path_or_url):
-    # Step 1: If URL, download torrent file
-    if torrent_path_or_url.startswith(('http://', 'https://')):
-        print("[Main] Detected torrent URL, downloading...")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(torrent_path_or_url) as resp:
-                data = await resp.read()
-                filename = os.path.basename(torrent_path_or_url)
-                with open(filename, 'wb') as f:
-                    f.write(data)
-                torrent_path_or_url = filename
-                print(f"[Main] Torrent file saved as {filename}")
-
-    # Step 2: Parse metadata
-    parser = TorrentParser(torrent_path_or_url)
-    metadata = parser.parse()
-
-    # Step 3: Initialize storage and piece manager
-    storage = Storage(metadata['name'], metadata['length'], metadata['piece_length'])
-    piece_manager = PieceManager(metadata)
-
-    # Step 4: Get peers
-    tracker = TrackerClient(metadata)
-    peers = await tracker.get_peers()
-    if not peers:
-        print("[Main] No peers found, exiting.")
-        return
-
-    # Step 5: Connect to peers in parallel
-    tasks = []
-    for peer in peers:
-        conn = PeerConnection(peer, metadata, piece_manager, storage)
-        tasks.append(asyncio.create_task(conn.start()))
-
-    await asyncio.gather(*tasks)
+async def main(torrent_path_or_url, hash_workers=0, max_connections=MAX_CONNECTIONS, limits=None,
+               metrics_port=None, write_buffer=MAX_PENDING, sequential=False):
+    verifier = PieceVerifier(hash_workers)
+    torrent = Torrent(torrent_path_or_url, verifier, limits, max_connections,
+                      write_buffer=write_buffer, sequential=sequential)
+    exporter = await metrics.serve(metrics_port) if metrics_port else None
+    try:
+        await torrent.run()
+    finally:
+        await verifier.drain()
+        verifier.close()
+        if exporter is not None:
+            await exporter.cleanup()
+    pm = torrent.piece_manager
+    print(f"[Main] Verified {verifier.pieces} pieces with {verifier.workers} workers "
+          f"at {verifier.throughput() / 2**20:.1f} MB/s per worker")
+    if pm is not None and pm.tail_time is not None:
+        print(f"[Main] Last 1% of pieces took {pm.tail_time:.2f}s "
+              f"({pm.duplicate_bytes} duplicate bytes in endgame)")
+    latency = metrics.snapshot()['peer_block_latency_seconds']
+    if latency['count']:
+        print(f"[Main] Block latency p50 {latency['p50'] * 1000:g} ms, p99 {latency['p99'] * 1000:g} ms")
     print("[Main] Download tasks complete.")
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Download a torrent')
+    arg_parser.add_argument('torrent', help='.torrent file path or URL')
+    arg_parser.add_argument('--hash-workers', type=int, default=0,
+                            help='piece verification threads (default: CPU count)')
+    arg_parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                            help='maximum simultaneous peer connections')
+    arg_parser.add_argument('--download-limit', type=int, default=0,
+                            help='global download limit in KB/s (0 for unlimited)')
+    arg_parser.add_argument('--upload-limit', type=int, default=0,
+                            help='global upload limit in KB/s (0 for unlimited)')
+    arg_parser.add_argument('--write-buffer', type=int, default=MAX_PENDING // 2 ** 20,
+                            help='MB of verified data allowed to wait for the disk')
+    arg_parser.add_argument('--sequential', action='store_true',
+                            help='download in order, e.g. to play media while it downloads')
+    arg_parser.add_argument('--metrics-port', type=int,
+                            help='serve Prometheus metrics on 127.0.0.1:PORT/metrics')
+    arg_parser.add_argument('--log-level', default='info',
+                            choices=('debug', 'info', 'warning', 'error'))
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='[%(name)s] %(message)s')
     try:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        loop.run_until_complete(main(sys.argv[1]))
+        limits = TransferLimits(args.download_limit * 1024, args.upload_limit * 1024)
+        loop.run_until_complete(main(args.torrent, args.hash_workers, args.max_connections, limits,
+                                     args.metrics_port, args.write_buffer * 2 ** 20, args.sequential))
     except Exception as e:
         print("[Main] Error:", e)
     finally:
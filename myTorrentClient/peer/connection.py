@@ -1,118 +1,676 @@
 # File: peer/connection.py
 # -----------------------------
 import asyncio
+import logging
 import struct
-import random
-import hashlib
+import time
+from collections import deque
+from peer.protocol import (MessageDecoder, MessageBatch, parse_piece, handshake,
+                           supports_fast, supports_extensions, PROTOCOL,
+                           HAVE_ALL, HAVE_NONE, REJECT_REQUEST, ALLOWED_FAST,
+                           EXTENDED, EXTENDED_HANDSHAKE,
+                           CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, HAVE, BITFIELD,
+                           REQUEST, PIECE, CANCEL)
+from pieces.bitfield import Bitfield
+from pieces.manager import BLOCK_SIZE, COMPLETE, IN_PROGRESS
+from utils import metrics
+from utils.bencode_utils import encode, decode, BencodeError
+from utils.ratelimit import TransferLimits
 
-class PeerConnection:
-    def __init__(self, peer, metadata, piece_manager, storage):
+MIN_REQUESTS = 2
+MAX_REQUESTS = 250
+INITIAL_REQUESTS = 4
+REQUEST_QUEUE_TIME = 3.0      # seconds of data to keep in flight when auto-sizing
+CONNECT_TIMEOUT = 10.0
+READ_SIZE = 2 ** 18
+LIMITED_READ_SIZE = 2 ** 14   # small reads keep rate-limited traffic smooth
+MAX_UPLOAD_BLOCK = 2 ** 17    # larger requests are ignored
+MAX_UPLOAD_QUEUE = 500        # requests held for a peer before new ones are dropped
+REQUEST_TIMEOUT = 20.0        # a block not back after this long marks the peer as snubbing us
+ENDGAME_PER_PEER = 2          # duplicate endgame requests one peer may have in flight
+MAX_HASH_FAILURES = 3         # failed pieces a peer may feed us before we disconnect
+KEEPALIVE_INTERVAL = 60.0     # send a keep-alive after this long without writing
+PEER_TIMEOUT = 150.0          # peers send keep-alives every two minutes; silence past that is a dead link
+IDLE_TIMEOUT = 60.0           # disconnect when neither side has been interested for this long
+WATCHDOG_INTERVAL = 1.0
+CLIENT_VERSION = b'myTorrentClient 0.1'
+
+log = logging.getLogger('PeerConnection')
+BLOCK_LATENCY = metrics.histogram('peer_block_latency_seconds', 'Time from request to block arrival')
+QUEUE_DEPTH = metrics.histogram('peer_request_queue_depth', 'Block requests in flight per read',
+                                metrics.DEPTH_BUCKETS)
+PEER_RATE = metrics.histogram('peer_download_rate_bytes', 'Average download rate of closed connections',
+                              metrics.RATE_BUCKETS)
+CHOKED_TIME = metrics.histogram('peer_choked_seconds', 'Time spent choked before an unchoke')
+DOWNLOADED = metrics.counter('peer_downloaded_bytes_total', 'Block payload bytes received')
+UPLOADED = metrics.counter('peer_uploaded_bytes_total', 'Block payload bytes sent')
+UNEXPECTED = metrics.counter('peer_unexpected_blocks_total', 'Blocks received that were not pending')
+REQUEUED = metrics.counter('peer_requeued_blocks_total', 'Outstanding requests handed back after a choke or disconnect')
+TIMEOUTS = metrics.counter('peer_request_timeouts_total', 'Block requests that timed out')
+
+class PieceSink:
+    # Hash check and storage of downloaded pieces, shared by peer connections
+    # and web seeds. Needs piece_manager, storage, verifier, cache, disk, label
+    # and hash_failures.
+    async def _verify(self, index, piece, sources=None):
+        # Piece complete: hash it off the event loop, then store. sources are
+        # the sinks that delivered its blocks; a bad hash is charged to them.
+        task = await self.verifier.submit(piece, self.piece_manager.expected_hash(index))
+        task.add_done_callback(lambda t: self._on_verified(index, piece, t, sources or (self,)))
+
+    def _on_verified(self, index, piece, task, sources=()):
+        if not task.cancelled() and task.exception() is None and task.result():
+            if self.cache is not None:
+                self.cache.put(index, piece)
+            if self.disk is None:
+                self.storage.write_block(index, 0, piece)
+                self._on_written(index, None)
+            else:
+                self.disk.write(index, piece).add_done_callback(lambda f: self._on_written(index, f))
+        else:
+            self.piece_manager.mark_failed(index)
+            log.warning("Hash mismatch for piece %d from %s", index,
+                        ', '.join(source.label for source in sources))
+            for source in sources:
+                source._on_hash_failure()
+
+    def _on_hash_failure(self):
+        self.hash_failures += 1
+
+    def _on_written(self, index, future):
+        # Only pieces that reached the disk count as complete
+        if future is not None and (future.cancelled() or future.exception() is not None):
+            log.error("Writing piece %d failed: %r", index,
+                      None if future.cancelled() else future.exception())
+            self.piece_manager.mark_failed(index)
+            return
+        self.piece_manager.mark_complete(index)
+        log.debug("Stored piece %d", index)
+        self._on_stored(index)
+
+    def _on_stored(self, index):
+        pass
+
+class PeerConnection(PieceSink):
+    def __init__(self, peer, metadata, piece_manager, storage, verifier, max_requests=None,
+                 connect_timeout=CONNECT_TIMEOUT, limits=None, cache=None, disk=None):
         self.peer = peer
+        self.label = '%s:%s' % peer
         self.metadata = metadata
         self.piece_manager = piece_manager
         self.storage = storage
-        self.available = set()
+        self.verifier = verifier
+        self.cache = cache   # PieceCache shared by the torrent's connections
+        self.disk = disk     # DiskWriter; pieces are written inline when None
+        self.available = Bitfield(piece_manager.num_pieces)
+        self._seed = False   # counted in piece_manager.seeds rather than availability
+        # Fixed request queue depth, or None to size it from the measured rate
+        self.max_requests = max_requests
+        self.queue_depth = max_requests or INITIAL_REQUESTS
+        self.request_limit = MAX_REQUESTS   # lowered to the peer's reqq if it sends one
+        self.pending = {}   # (index, begin) -> (length, request time) of requested blocks
+        self.pieces = {}    # index -> PieceDownload this connection picked
+        self.connect_timeout = connect_timeout
+        self.limits = limits or TransferLimits()
+        self.downloaded = 0
+        self.uploaded = 0
+        self.hash_failures = 0   # failed pieces this peer delivered blocks for
+        self.connected = False
+        self.last_block = None
+        self._rate_start = None
+        self._writer = None
+        self.choked = True
+        self._choked_at = None
+        self.am_interested = False
+        self.snubbed = False      # a request timed out; only one block in flight until a block arrives
+        self.last_received = self.last_sent = self._last_interest = None
+        # Negotiated in the handshake reserved bytes
+        self.fast = False         # BEP 6: have-all/none, reject and allowed-fast
+        self.extended = False     # BEP 10 extension messages
+        self.allowed_fast = Bitfield(piece_manager.num_pieces)   # requestable while choked
+        self.client = None        # 'v' from the peer's extended handshake
+        # Upload side: we start out choking, the swarm's choker unchokes
+        self.am_choking = True
+        self.peer_interested = False
+        self.requests = deque()   # (index, begin, length) the peer asked us for
+        self._requested = asyncio.Event()
+        self._sending = False     # a block is going out through sendfile
+        self.decoder = MessageDecoder()
+        self.outbox = MessageBatch()
+        self._completed = []   # (index, piece, sources) assembled but not yet verified
 
     async def start(self):
         ip, port = self.peer
-        print(f"[PeerConnection] Connecting to {ip}:{port}")
+        log.debug("Connecting to %s:%s", ip, port)
+        uploader = watchdog = None
         try:
-            reader, writer = await asyncio.open_connection(ip, port)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port),
+                                                    self.connect_timeout)
+            self._writer = writer
             # Handshake
             writer.write(self.build_handshake())
             await writer.drain()
-            resp = await reader.readexactly(68)
-            if resp[1:20] != b'BitTorrent protocol':
-                print("[PeerConnection] Invalid handshake")
+            resp = await asyncio.wait_for(reader.readexactly(68), self.connect_timeout)
+            if resp[1:20] != PROTOCOL or resp[28:48] != self.metadata['info_hash']:
+                log.debug("Invalid handshake from %s:%s", ip, port)
                 return
-            print("[PeerConnection] Handshake OK")
-            # Interested
-            writer.write(struct.pack('>IB', 1, 2)); await writer.drain()
-            print("[PeerConnection] Sent interested")
+            reserved = resp[20:28]
+            self.fast = supports_fast(reserved)
+            self.extended = supports_extensions(reserved)
+            log.debug("Handshake OK (fast=%s, extended=%s)", self.fast, self.extended)
+            self.connected = True
+            self._choked_at = self.last_received = self.last_sent = self._last_interest = time.monotonic()
+            # What we have comes first (BEP 3, BEP 6); interest follows once we
+            # know what the peer has
+            self._send_have_state()
+            if self.extended:
+                self.outbox.extended(EXTENDED_HANDSHAKE, encode({b'reqq': MAX_UPLOAD_QUEUE,
+                                                                 b'v': CLIENT_VERSION, b'm': {}}))
+            self._flush()
+            await writer.drain()
+            uploader = asyncio.ensure_future(self._serve_uploads(writer))
+            watchdog = asyncio.ensure_future(self._watchdog(writer))
 
-            # Read messages until unchoke, parsing bitfield
+            # One read per chunk; the decoder dispatches every message in it
             while True:
-                header = await reader.readexactly(4)
-                length = struct.unpack('>I', header)[0]
-                if length == 0:
-                    continue  # keep-alive
-                msg_id = (await reader.readexactly(1))[0]
-                body_len = length - 1
-                if msg_id == 5:  # bitfield
-                    bitfield = await reader.readexactly(body_len)
-                    self._parse_bitfield(bitfield)
-                    print(f"[PeerConnection] Bitfield parsed: {len(self.available)} pieces available")
-                elif msg_id == 1:  # unchoke
-                    await reader.readexactly(body_len)
-                    print("[PeerConnection] Unchoked")
+                if (not self.choked or self.allowed_fast) and self.am_interested:
+                    if self.disk is not None and self.disk.congested():
+                        # Too much verified data still unwritten: stop asking for more
+                        self._flush()
+                        await self.disk.wait()
+                    # Keep up to queue_depth block requests in flight
+                    self._fill_pipeline()
+                    if self.pending:
+                        QUEUE_DEPTH.observe(len(self.pending))
+                    else:
+                        # Nothing left to ask for: maybe the peer has nothing we need
+                        self._update_interest()
+                self._flush()
+                await writer.drain()
+                limited = self.limits.download.limited()
+                data = await reader.read(LIMITED_READ_SIZE if limited else READ_SIZE)
+                if not data:
+                    log.debug("Peer closed the connection")
                     break
-                else:
-                    await reader.readexactly(body_len)
+                self.last_received = time.monotonic()
+                if limited:
+                    # Holding off the next read lets TCP flow control slow the peer
+                    await self.limits.download.consume(len(data))
+                self.decoder.feed(data, self._on_message)
+                while self._completed:
+                    await self._verify(*self._completed.pop())
 
-            # Download loop: request only pieces this peer has
-            total_pieces = len(self.piece_manager.hash_list)
-            while True:
-                # Find next available piece
-                idx = None
-                while True:
-                    candidate = self.piece_manager.next_piece()
-                    if candidate is None:
-                        break
-                    if candidate in self.available:
-                        idx = candidate
-                        break
-                if idx is None:
-                    print("[PeerConnection] No more available pieces to request from this peer")
-                    break
+        except Exception as e:
+            log.debug("Error: %r", e)
+        finally:
+            for task in (uploader, watchdog):
+                if task is not None:
+                    task.cancel()
+            if self._writer is not None:
+                self._writer.close()
+            if self._rate_start is not None:
+                PEER_RATE.observe(self.rate())
+            # Hand unfinished pieces back to the picker and forget our availability
+            self._give_up()
+            self.piece_manager.remove_peer(self.available, self._seed)
 
-                begin = 0
-                length = self.metadata['piece_length']
-                # Request piece
-                writer.write(struct.pack('>IBIII', 13, 6, idx, begin, length))
-                await writer.drain()
-                print(f"[PeerConnection] Requested piece {idx}")
-
-                # Read piece message
-                header = await reader.readexactly(4)
-                size = struct.unpack('>I', header)[0]
-                msg_id = (await reader.readexactly(1))[0]
-                if msg_id != 7:
-                    print(f"[PeerConnection] Expected piece (id 7), got {msg_id}")
-                    await reader.readexactly(size - 1)
+    def _on_message(self, msg_id, payload):
+        if msg_id == PIECE:
+            self._on_block(*parse_piece(payload))
+        elif msg_id == HAVE:
+            self._on_have(struct.unpack_from('>I', payload)[0])
+        elif msg_id == BITFIELD:
+            self._set_available(Bitfield(self.piece_manager.num_pieces, payload))
+        elif msg_id == HAVE_ALL and self.fast:
+            self._set_available(Bitfield.full(self.piece_manager.num_pieces))
+        elif msg_id == HAVE_NONE and self.fast:
+            self._set_available(Bitfield(self.piece_manager.num_pieces))
+        elif msg_id == REJECT_REQUEST and self.fast:
+            self._on_reject(*struct.unpack_from('>III', payload))
+        elif msg_id == ALLOWED_FAST and self.fast:
+            index = struct.unpack_from('>I', payload)[0]
+            if index < self.piece_manager.num_pieces:
+                self.allowed_fast.add(index)
+        elif msg_id == EXTENDED and self.extended:
+            if payload[0] == EXTENDED_HANDSHAKE:
+                self._on_extended_handshake(bytes(payload[1:]))
+        elif msg_id == UNCHOKE:
+            if not self.choked:
+                return
+            log.debug("Unchoked")
+            self.choked = False
+            if self._choked_at is not None:
+                CHOKED_TIME.observe(time.monotonic() - self._choked_at)
+                self._choked_at = None
+            if self._rate_start is None:
+                self._rate_start = self.last_block = time.monotonic()
+        elif msg_id == CHOKE:
+            if self.choked:
+                return
+            log.debug("Choked with %d requests outstanding", len(self.pending))
+            self.choked = True
+            self._choked_at = time.monotonic()
+            if self.fast:
+                # Requests stay outstanding until the peer serves or rejects
+                # them; pieces outside the allowed-fast set go to other peers
+                for index in [i for i in self.pieces if i not in self.allowed_fast]:
+                    self.piece_manager.abandon(index)
+                    del self.pieces[index]
+            else:
+                # The peer discards our requests when it chokes us
+                self._give_up()
+        elif msg_id == REQUEST:
+            self._on_request(*struct.unpack_from('>III', payload))
+        elif msg_id == CANCEL:
+            request = struct.unpack_from('>III', payload)
+            try:
+                self.requests.remove(request)
+            except ValueError:
+                return
+            if self.fast:
+                # Fast peers expect every request to end in a piece or a reject
+                self.outbox.reject(*request)
+        elif msg_id == INTERESTED:
+            self.peer_interested = True
+        elif msg_id == NOT_INTERESTED:
+            self.peer_interested = False
+
+    def _fill_pipeline(self):
+        now = time.monotonic()
+        while len(self.pending) < self.queue_depth:
+            block = self._next_block()
+            if block is None:
+                break
+            index, begin, length = block
+            self.outbox.request(index, begin, length)
+            self.pending[(index, begin)] = (length, now)
+
+    def _next_block(self):
+        manager = self.piece_manager
+        # While choked only allowed-fast pieces may be requested
+        available = self.allowed_fast & self.available if self.choked else self.available
+        if manager.window is not None:
+            # Streaming: race blocks the reader is about to need
+            found = manager.late_block(available, self.pending)
+            if found is not None:
+                return self._race(found)
+        for index, download in self.pieces.items():
+            if index in available:
+                block = download.next_block(self)
+                if block is not None:
+                    return (index,) + block
+        # Finish a piece another peer left half done before starting a new one,
+        # unless this peer is the one that just let a piece stall
+        block = None if self.snubbed else self._adopt(available)
+        if block is not None:
+            return block
+        # Every open piece is fully requested, start the next window piece or the rarest one
+        candidate = manager.pick(available)
+        if candidate is not None:
+            download = manager.start_download(candidate, self)
+            self.pieces[candidate] = download
+            return (candidate,) + download.next_block(self)
+        if self.snubbed:
+            block = self._adopt(available)
+            if block is not None:
+                return block
+        # Endgame: ask for blocks already requested from slower peers too, a
+        # few at a time so the peer's whole queue is not spent on duplicates
+        if manager.in_endgame() and self._racing() < ENDGAME_PER_PEER:
+            found = manager.endgame_block(available, self.pending)
+            if found is not None:
+                return self._race(found)
+        return None
+
+    def _racing(self):
+        # Pending requests that another peer has outstanding too
+        downloads = self.piece_manager.downloads
+        count = 0
+        for index, begin in self.pending:
+            download = downloads.get(index)
+            if download is not None and len(download.requesters.get(begin, ())) > 1:
+                count += 1
+        return count
+
+    def _adopt(self, available):
+        download = self.piece_manager.adopt(available, self)
+        if download is None:
+            return None
+        self.pieces[download.index] = download
+        block = download.next_block(self)
+        return None if block is None else (download.index,) + block
+
+    def _race(self, found):
+        # Request a block another peer already has outstanding
+        download, begin, length = found
+        download.requesters[begin].add(self)
+        return download.index, begin, length
+
+    def cancel(self, index, begin):
+        # Another peer delivered this block first
+        request = self.pending.pop((index, begin), None)
+        if request is not None:
+            self.outbox.cancel(index, begin, request[0])
+            self._flush()
+
+    def _set_available(self, pieces):
+        # Bitfield, have-all or have-none: replaces whatever the peer sent before
+        self.piece_manager.remove_peer(self.available, self._seed)
+        self.available = pieces
+        self._seed = self.piece_manager.add_peer(pieces)
+        log.debug("Peer has %d pieces", len(pieces))
+        self._update_interest()
+
+    def _send_have_state(self):
+        manager = self.piece_manager
+        if self.fast and manager.is_complete():
+            self.outbox.have_all()
+        elif self.fast and not manager.completed:
+            self.outbox.have_none()
+        elif manager.completed:
+            self.outbox.bitfield(manager.completed_bitfield())
+
+    def _on_reject(self, index, begin, length):
+        # Requeue at once instead of waiting for a timeout
+        if self.pending.pop((index, begin), None) is None:
+            return
+        if self.choked:
+            # The peer will not serve this piece while choking us after all
+            self.allowed_fast.discard(index)
+        REQUEUED.inc()
+        download = self.piece_manager.downloads.get(index)
+        if download is not None:
+            download.drop(self, begin)
+
+    def _on_extended_handshake(self, payload):
+        try:
+            info = decode(payload)
+        except BencodeError:
+            return
+        if not isinstance(info, dict):
+            return
+        reqq = info.get(b'reqq')
+        if isinstance(reqq, int) and reqq > 0:
+            # Never keep more requests in flight than the peer will queue
+            self.request_limit = min(MAX_REQUESTS, reqq)
+            self.queue_depth = min(self.queue_depth, self.request_limit)
+        version = info.get(b'v')
+        if isinstance(version, bytes):
+            self.client = version.decode('utf-8', 'replace')
+        log.debug("Extended handshake from %s:%s: reqq=%s, v=%s", *self.peer, reqq, self.client)
+
+    def _give_up(self):
+        # Outstanding requests go back to their pieces and the pieces we own go
+        # back to the manager, keeping the blocks that already arrived
+        manager = self.piece_manager
+        REQUEUED.inc(len(self.pending))
+        for index, begin in self.pending:
+            download = manager.downloads.get(index)
+            if download is not None:
+                download.drop(self, begin)
+        self.pending.clear()
+        for index in self.pieces:
+            manager.abandon(index)
+        self.pieces.clear()
+
+    def _update_interest(self):
+        self._set_interested(bool(self.piece_manager.wanted(self.available)))
+
+    def _set_interested(self, interested):
+        if interested == self.am_interested:
+            return
+        self.am_interested = interested
+        if interested:
+            self.outbox.interested()
+        else:
+            log.debug("Nothing to download from %s:%s", *self.peer)
+            self.outbox.not_interested()
+
+    async def _watchdog(self, writer):
+        # Keep-alives, request timeouts and dead or idle links; the read loop
+        # notices the closed socket and cleans up
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            if now - self.last_received > PEER_TIMEOUT:
+                log.debug("No message from %s:%s in %.0fs", self.peer[0], self.peer[1], PEER_TIMEOUT)
+                writer.close()
+                return
+            if self.am_interested or self.peer_interested:
+                self._last_interest = now
+            elif now - self._last_interest > IDLE_TIMEOUT:
+                log.debug("Neither side interested, closing %s:%s", *self.peer)
+                writer.close()
+                return
+            expired = [key for key, (_, requested) in self.pending.items()
+                       if now - requested > REQUEST_TIMEOUT]
+            if expired:
+                self._on_timeout(expired)
+            if now - self.last_sent > KEEPALIVE_INTERVAL:
+                self.outbox.keepalive()
+                self._flush()
+
+    def _on_timeout(self, expired):
+        # Snubbed: cancel the late requests, let other peers finish our pieces
+        # and keep a single block in flight until the peer sends something
+        log.debug("%d requests to %s:%s timed out", len(expired), *self.peer)
+        TIMEOUTS.inc(len(expired))
+        self.snubbed = True
+        self.queue_depth = 1
+        manager = self.piece_manager
+        for index, begin in expired:
+            length, _ = self.pending.pop((index, begin))
+            self.outbox.cancel(index, begin, length)
+            download = manager.downloads.get(index)
+            if download is not None:
+                download.drop(self, begin)
+        for index in self.pieces:
+            manager.abandon(index)
+        self.pieces.clear()
+        # The read loop may be waiting on a peer with nothing left to send
+        if not self.choked and self.am_interested:
+            self._fill_pipeline()
+        self._flush()
+
+    def wake(self):
+        # Pieces went back into the pool; with nothing in flight the read loop
+        # would wait for the peer before asking for them, as in _on_timeout
+        if not self.connected or self.pending or self._writer is None or self._writer.is_closing():
+            return
+        if self.disk is not None and self.disk.congested():
+            return
+        if not self.am_interested:
+            self._update_interest()
+        elif not self.choked or self.allowed_fast:
+            self._fill_pipeline()
+        self._flush()
+
+    def send_have(self, index):
+        self.outbox.have(index)
+        self._recheck_interest()
+        self._flush()
+
+    def _recheck_interest(self):
+        # Called as pieces complete; only a connection with nothing in flight
+        # can have run out of pieces to ask for
+        if self.am_interested and not self.pending and not self.pieces:
+            self._update_interest()
+
+    def set_choking(self, choking):
+        if choking == self.am_choking:
+            return
+        self.am_choking = choking
+        if choking:
+            self.outbox.choke()
+            if self.fast:
+                for request in self.requests:
+                    self.outbox.reject(*request)
+            self.requests.clear()
+        else:
+            self.outbox.unchoke()
+        self._flush()
+
+    def _flush(self):
+        # Writes queued messages unless sendfile owns the socket right now
+        if self.outbox and self._writer is not None and not self._sending and not self._writer.is_closing():
+            self.outbox.flush(self._writer)
+            self.last_sent = time.monotonic()
+
+    def _on_block(self, index, begin, block):
+        manager = self.piece_manager
+        download = manager.downloads.get(index)
+        request = self.pending.pop((index, begin), None)
+        if request is None:
+            # Already in flight when we were choked, gave up on it or cancelled
+            # it; still useful if nobody else has delivered it yet
+            if download is not None and begin in download.received or (
+                    download is None and index < manager.num_pieces
+                    and manager.state[index] in (IN_PROGRESS, COMPLETE)):
+                # Another source won the race and our cancel came too late
+                manager.duplicate_bytes += len(block)
+                return
+            if download is None or download.block_length(begin) != len(block):
+                UNEXPECTED.inc()
+                log.debug("Unexpected block %d:%d", index, begin)
+                return
+            length = len(block)
+        elif request[0] != len(block):
+            UNEXPECTED.inc()
+            log.debug("Block %d:%d has the wrong length", index, begin)
+            # The request is gone either way; hand the block back to the pool
+            REQUEUED.inc()
+            if download is not None:
+                download.drop(self, begin)
+            return
+        else:
+            length = request[0]
+            BLOCK_LATENCY.observe(time.monotonic() - request[1])
+        self.downloaded += length
+        self.last_block = time.monotonic()
+        DOWNLOADED.inc(length)
+        if self.snubbed:
+            self.snubbed = False
+            self.queue_depth = self.max_requests or MIN_REQUESTS
+        self._update_queue_depth()
+        if download is None or not download.write(begin, block):
+            manager.duplicate_bytes += length
+            return
+        manager.downloaded += length
+        download.sources.add(self)
+        for other in download.requesters.pop(begin, ()):
+            if other is not self:
+                other.cancel(index, begin)
+        if download.remaining:
+            return
+
+        manager.finish_download(index)
+        self._completed.append((index, download.buffer, download.sources))
+
+    def _on_request(self, index, begin, length):
+        manager = self.piece_manager
+        if (self.am_choking or length > MAX_UPLOAD_BLOCK or len(self.requests) >= MAX_UPLOAD_QUEUE
+                or index >= len(manager.state) or manager.state[index] != COMPLETE
+                or begin + length > manager.piece_size(index)):
+            if self.fast:
+                self.outbox.reject(index, begin, length)
+            return
+        self.requests.append((index, begin, length))
+        self._requested.set()
+
+    async def _serve_uploads(self, writer):
+        try:
+            while True:
+                if not self.requests:
+                    self._requested.clear()
+                    await self._requested.wait()
                     continue
-                await reader.readexactly(8)  # skip index & begin
-                block = await reader.readexactly(size - 9)
-                print(f"[PeerConnection] Received block size {len(block)} for piece {idx}")
-
-                # Verify and store
-                expected = self.piece_manager.expected_hash(idx)
-                if hashlib.sha1(block).digest() == expected:
-                    self.storage.write_block(idx, begin, block)
-                    print(f"[PeerConnection] Stored piece {idx}")
+                index, begin, length = self.requests.popleft()
+                await self.limits.upload.consume(length)
+                if writer.is_closing():
+                    continue
+                if self.am_choking:
+                    # Choked while this request waited on the rate limiter
+                    if self.fast:
+                        self.outbox.reject(index, begin, length)
+                        self._flush()
+                    continue
+                await self._send_block(writer, index, begin, length)
+                self.uploaded += length
+                self.piece_manager.uploaded += length
+                UPLOADED.inc(length)
+        except (OSError, RuntimeError) as e:
+            # The read loop notices the closed socket and cleans up
+            log.debug("Upload failed: %r", e)
+            writer.close()
+
+    async def _send_block(self, writer, index, begin, length):
+        # Cached pieces go out as memoryviews; anything else is handed to the
+        # kernel with sendfile when the block sits inside one file
+        block = self.cache.block(index, begin, length) if self.cache is not None else None
+        span = None
+        if block is None:
+            span = self.storage.locate(index, begin, length)
+            if span is None:
+                if self.cache is not None:
+                    block = memoryview(self.cache.load(index))[begin:begin + length]
                 else:
-                    print(f"[PeerConnection] Hash mismatch for piece {idx}")
+                    block = self.storage.read_block(index, begin, length)
+        self.outbox.piece_header(index, begin, length)
+        self.outbox.flush(writer)
+        if block is not None:
+            writer.write(block)
+        else:
+            path, offset = span
+            self._sending = True
+            try:
+                # Storage's descriptor cache, rather than an open() per block
+                with self.storage.open_file(path) as f:
+                    await asyncio.get_running_loop().sendfile(writer.transport, f, offset, length)
+            finally:
+                self._sending = False
+            self._flush()
+        await writer.drain()
 
-            writer.close()
-            await writer.wait_closed()
-        except Exception as e:
-            print(f"[PeerConnection] Error: {e}")
+    def _on_stored(self, index):
+        self._recheck_interest()
+        self._flush()
+
+    def _on_hash_failure(self):
+        super()._on_hash_failure()
+        if self.hash_failures >= MAX_HASH_FAILURES and self._writer is not None:
+            # Keeps sending bad data; the read loop notices and gives its pieces back
+            log.info("Dropping %s after %d bad pieces", self.label, self.hash_failures)
+            self._writer.close()
+
+    def _on_have(self, index):
+        manager = self.piece_manager
+        if index < manager.num_pieces and self.available.add(index):
+            manager.add_have(index)
+            if not self.am_interested and manager.state[index] != COMPLETE:
+                self._set_interested(True)
+
+    def rate(self):
+        # Average download rate since unchoke, in bytes per second
+        if self._rate_start is None:
+            return 0.0
+        elapsed = time.monotonic() - self._rate_start
+        return self.downloaded / elapsed if elapsed > 0 else 0.0
+
+    def _update_queue_depth(self):
+        if self.max_requests or self.snubbed:
+            return
+        # Bandwidth-delay product: enough blocks to cover REQUEST_QUEUE_TIME at the current rate
+        rate = self.rate()
+        if not rate:
+            return
+        depth = int(rate * REQUEST_QUEUE_TIME / BLOCK_SIZE)
+        self.queue_depth = max(MIN_REQUESTS, min(self.request_limit, depth))
 
     def build_handshake(self):
-        pstr = b'BitTorrent protocol'
-        peer_id = b'-PC0001-' + bytes([random.randint(0, 255) for _ in range(12)])
-        return bytes([len(pstr)]) + pstr + bytes(8) + self.metadata['info_hash'] + peer_id
-
-    def _parse_bitfield(self, bitfield):
-        total = len(self.piece_manager.hash_list)
-        for byte_index, byte in enumerate(bitfield):
-            for bit in range(8):
-                if byte & (1 << (7 - bit)):
-                    piece = byte_index * 8 + bit
-                    if piece < total:
-                        self.available.add(piece)
+        return handshake(self.metadata['info_hash'])
 
     async def wait_for_unchoke(self, reader):
         # Unused: bitfield logic moved into start(), so this can be removed or kept minimal
         pass
 
-# -----------------------------
\ No newline at end of file
+# -----------------------------
@@ -0,0 +1,177 @@
+# File: peer/protocol.py
+# -----------------------------
+# Peer wire message codec: parses length-prefixed messages out of one receive
+# buffer and batches outgoing messages into a single write
+import random
+import struct
+
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
+HAVE = 4
+BITFIELD = 5
+REQUEST = 6
+PIECE = 7
+CANCEL = 8
+# BEP 6 Fast Extension
+SUGGEST_PIECE = 13
+HAVE_ALL = 14
+HAVE_NONE = 15
+REJECT_REQUEST = 16
+ALLOWED_FAST = 17
+# BEP 10 Extension Protocol; the first payload byte is the extended message id
+EXTENDED = 20
+EXTENDED_HANDSHAKE = 0
+
+PROTOCOL = b'BitTorrent protocol'
+# Reserved handshake bits: byte 5 0x10 is BEP 10, byte 7 0x04 is BEP 6
+RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0x04])
+# One peer_id for the whole session, shared by tracker announces and handshakes
+PEER_ID = b'-PC0001-' + bytes(random.choice(b'0123456789') for _ in range(12))
+
+MAX_MESSAGE = 2 ** 20   # fits the bitfield of an 8M-piece torrent; anything larger is bogus
+
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>IB')
+_HAVE = struct.Struct('>IBI')
+_REQUEST = struct.Struct('>IBIII')
+_PIECE_HEADER = struct.Struct('>II')
+_PIECE = struct.Struct('>IBII')
+
+class ProtocolError(Exception):
+    pass
+
+class MessageDecoder:
+    def __init__(self, max_length=MAX_MESSAGE):
+        self.max_length = max_length
+        self.buffer = bytearray()   # unconsumed tail of earlier reads
+
+    def feed(self, data, handler):
+        # Calls handler(msg_id, payload) for each complete message. payload is
+        # a memoryview into the receive buffer, only valid during the call, so
+        # handlers copy what they keep (e.g. a block into its piece buffer).
+        view = memoryview(data)
+        try:
+            if self.buffer:
+                # Finish the buffered message with just the bytes it still needs
+                view = self._complete(view, handler)
+                if self.buffer:
+                    return
+            consumed = self._parse(view, handler)
+            if consumed < len(view):
+                # Only a partial trailing message is ever copied
+                self.buffer = bytearray(view[consumed:])
+        finally:
+            view.release()
+
+    def _complete(self, view, handler):
+        buf = self.buffer
+        if len(buf) < 4:
+            take = 4 - len(buf)
+            buf += view[:take]
+            view = view[take:]
+            if len(buf) < 4:
+                return view
+        length = _LENGTH.unpack_from(buf)[0]
+        self._check(length)
+        take = 4 + length - len(buf)
+        buf += view[:take]
+        view = view[take:]
+        if len(buf) == 4 + length:
+            self._parse(memoryview(buf), handler)
+            self.buffer = bytearray()
+        return view
+
+    def _parse(self, view, handler):
+        pos = 0
+        end = len(view)
+        unpack = _LENGTH.unpack_from
+        while end - pos >= 4:
+            length = unpack(view, pos)[0]
+            if length > self.max_length:
+                self._check(length)
+            if end - pos - 4 < length:
+                break
+            if length:   # zero length is a keep-alive
+                handler(view[pos + 4], view[pos + 5:pos + 4 + length])
+            pos += 4 + length
+        return pos
+
+    def _check(self, length):
+        if length > self.max_length:
+            raise ProtocolError(f'Message of {length} bytes')
+
+def handshake(info_hash, peer_id=PEER_ID):
+    return bytes([len(PROTOCOL)]) + PROTOCOL + RESERVED + info_hash + peer_id
+
+def supports_fast(reserved):
+    return bool(reserved[7] & 0x04)
+
+def supports_extensions(reserved):
+    return bool(reserved[5] & 0x10)
+
+def parse_piece(payload):
+    # (index, begin, block view) from a piece message payload
+    index, begin = _PIECE_HEADER.unpack_from(payload)
+    return index, begin, payload[8:]
+
+class MessageBatch:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def message(self, msg_id, payload=b''):
+        self.buffer += _HEADER.pack(1 + len(payload), msg_id)
+        self.buffer += payload
+
+    def keepalive(self):
+        self.buffer += bytes(4)
+
+    def choke(self):
+        self.buffer += _HEADER.pack(1, CHOKE)
+
+    def unchoke(self):
+        self.buffer += _HEADER.pack(1, UNCHOKE)
+
+    def interested(self):
+        self.buffer += _HEADER.pack(1, INTERESTED)
+
+    def not_interested(self):
+        self.buffer += _HEADER.pack(1, NOT_INTERESTED)
+
+    def bitfield(self, bitfield):
+        self.message(BITFIELD, bitfield)
+
+    def have(self, index):
+        self.buffer += _HAVE.pack(5, HAVE, index)
+
+    def have_all(self):
+        self.buffer += _HEADER.pack(1, HAVE_ALL)
+
+    def have_none(self):
+        self.buffer += _HEADER.pack(1, HAVE_NONE)
+
+    def request(self, index, begin, length):
+        self.buffer += _REQUEST.pack(13, REQUEST, index, begin, length)
+
+    def cancel(self, index, begin, length):
+        self.buffer += _REQUEST.pack(13, CANCEL, index, begin, length)
+
+    def reject(self, index, begin, length):
+        self.buffer += _REQUEST.pack(13, REJECT_REQUEST, index, begin, length)
+
+    def extended(self, ext_id, payload):
+        self.message(EXTENDED, bytes([ext_id]) + payload)
+
+    def piece_header(self, index, begin, length):
+        # The block itself is written separately so it is never copied in here
+        self.buffer += _PIECE.pack(9 + length, PIECE, index, begin)
+
+    def flush(self, writer):
+        # A fresh buffer each time: the transport may hold on to the old one
+        if self.buffer:
+            writer.write(self.buffer)
+            self.buffer = bytearray()
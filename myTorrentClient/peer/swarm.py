@@ -0,0 +1,272 @@
+# File: peer/swarm.py
+# -----------------------------
+import asyncio
+import logging
+import random
+import time
+from peer.connection import PeerConnection, CONNECT_TIMEOUT
+from peer.webseed import WebSeed, MAX_FAILURES as WEBSEED_FAILURES
+from pieces.cache import PieceCache
+
+MAX_CONNECTIONS = 50
+MAX_FAILURES = 5
+RETRY_DELAY = 30.0        # base back-off before reconnecting to a peer
+SNUB_TIMEOUT = 60.0       # no block for this long and the peer is dropped
+ROTATE_INTERVAL = 30.0    # how often the slowest peer makes room for a fresh one
+UPLOAD_SLOTS = 4          # peers we upload to at once, one of them optimistic
+CHOKE_INTERVAL = 10.0     # tit-for-tat re-evaluation period
+OPTIMISTIC_INTERVAL = 30.0
+TICK = 1.0
+
+log = logging.getLogger('SwarmManager')
+
+class PeerStats:
+    def __init__(self):
+        self.failures = 0
+        self.rate = 0.0       # bytes/sec measured on the last connection
+        self.retry_at = 0.0
+
+    def score(self):
+        # Known fast peers first, untried peers next, flaky peers last
+        return (self.failures, -self.rate)
+
+class SwarmManager:
+    def __init__(self, metadata, piece_manager, storage, verifier,
+                 max_connections=MAX_CONNECTIONS, connect_timeout=CONNECT_TIMEOUT, limits=None,
+                 disk=None, web_seeds=(), session=None):
+        self.metadata = metadata
+        self.piece_manager = piece_manager
+        self.storage = storage
+        self.verifier = verifier
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.limits = limits
+        self.disk = disk
+        self.cache = PieceCache(storage, piece_manager)
+        piece_manager.listeners.append(self._broadcast_have)
+        piece_manager.returned.append(self._on_returned)
+        self._waking = False   # a _wake_idle call is scheduled
+        # Set with the last piece, so run() returns without waiting out a TICK
+        self._complete = asyncio.Event()
+        self.candidates = {}   # peer -> PeerStats
+        # BEP 19 HTTP seeds, fetched alongside the peer connections
+        self.web_seeds = [WebSeed(url, metadata, piece_manager, storage, verifier, session,
+                                  cache=self.cache, disk=disk, limits=limits) for url in web_seeds]
+        self._web_tasks = {}   # WebSeed -> task
+        self.active = {}       # task -> PeerConnection
+        self.paused = False
+        self._since = {}       # task -> connect time
+        self._dropped = set()  # tasks cancelled for being slow or snubbing us
+        self._parked = set()   # tasks cancelled by pause()
+        self._transferred = {}  # connection -> bytes downloaded at the last choke round
+        self._optimistic = None
+        self._optimistic_at = 0.0
+
+    def add_peers(self, peers):
+        for peer in peers:
+            self.candidates.setdefault(peer, PeerStats())
+
+    async def run(self):
+        last_rotate = last_choke = time.monotonic()
+        complete = asyncio.ensure_future(self._complete.wait())
+        try:
+            while not self.piece_manager.is_complete():
+                if not self.paused:
+                    self._fill()
+                    self._fill_web_seeds()
+                if not self.active:
+                    delay = TICK if self.paused or self._web_tasks else self._next_retry()
+                    if delay is None:
+                        log.info("No usable peers left")
+                        break
+                    # Short naps so pieces still being verified can finish the download
+                    await asyncio.wait([complete], timeout=min(delay, TICK))
+                    continue
+                # Wake for a closed connection (to refill its slot) or the last piece
+                done, _ = await asyncio.wait([complete, *self.active], timeout=TICK,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self._finished(task)
+                now = time.monotonic()
+                if now - last_rotate >= ROTATE_INTERVAL:
+                    self._rotate()
+                    last_rotate = now
+                if now - last_choke >= CHOKE_INTERVAL:
+                    self._choke()
+                    last_choke = now
+                else:
+                    self._fill_upload_slots()
+        finally:
+            complete.cancel()
+            if self._broadcast_have in self.piece_manager.listeners:
+                self.piece_manager.listeners.remove(self._broadcast_have)
+            if self._on_returned in self.piece_manager.returned:
+                self.piece_manager.returned.remove(self._on_returned)
+            self.cache.clear()
+            await self.close()
+
+    def pause(self):
+        # Disconnect everyone without holding it against them
+        self.paused = True
+        for task in self.active:
+            self._parked.add(task)
+            task.cancel()
+        for task in self._web_tasks.values():
+            task.cancel()
+
+    def resume(self):
+        self.paused = False
+
+    async def close(self):
+        tasks = list(self.active)
+        web_tasks = list(self._web_tasks.values())
+        for task in tasks + web_tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *web_tasks, return_exceptions=True)
+        for task in tasks:
+            self._finished(task)
+        self._web_tasks.clear()
+
+    def sources(self):
+        # Connected peers and running web seeds; both have rate()
+        return list(self.active.values()) + [seed for seed, task in self._web_tasks.items()
+                                             if not task.done()]
+
+    def _eligible(self):
+        now = time.monotonic()
+        connected = {conn.peer for conn in self.active.values()}
+        return [peer for peer, stats in self.candidates.items()
+                if peer not in connected and stats.failures < MAX_FAILURES and stats.retry_at <= now]
+
+    def _fill(self):
+        free = self.max_connections - len(self.active)
+        if free <= 0:
+            return
+        eligible = sorted(self._eligible(), key=lambda peer: self.candidates[peer].score())
+        for peer in eligible[:free]:
+            conn = PeerConnection(peer, self.metadata, self.piece_manager, self.storage,
+                                  self.verifier, connect_timeout=self.connect_timeout,
+                                  limits=self.limits, cache=self.cache, disk=self.disk)
+            task = asyncio.create_task(conn.start())
+            self.active[task] = conn
+            self._since[task] = time.monotonic()
+
+    def _fill_web_seeds(self):
+        # (Re)start web seeds that are not running and have not given up
+        for seed in self.web_seeds:
+            task = self._web_tasks.get(seed)
+            if task is not None and task.done():
+                del self._web_tasks[seed]
+                if not task.cancelled() and task.exception() is not None:
+                    log.warning("Web seed %s stopped: %r", seed.url, task.exception())
+                    seed.failures = WEBSEED_FAILURES
+                task = None
+            if task is None and seed.failures < WEBSEED_FAILURES:
+                self._web_tasks[seed] = asyncio.create_task(seed.run())
+
+    def _finished(self, task):
+        conn = self.active.pop(task, None)
+        if conn is None:
+            return
+        del self._since[task]
+        self._transferred.pop(conn, None)
+        if self._optimistic is conn:
+            self._optimistic = None
+        stats = self.candidates[conn.peer]
+        stats.rate = conn.rate()
+        if task in self._parked:
+            self._parked.discard(task)
+            self._dropped.discard(task)
+            return
+        # Pieces that failed their hash count against the peer like a failed connection
+        if conn.downloaded and task not in self._dropped and not conn.hash_failures:
+            stats.failures = 0
+            stats.retry_at = time.monotonic() + RETRY_DELAY
+        else:
+            stats.failures += max(1, conn.hash_failures)
+            stats.retry_at = time.monotonic() + RETRY_DELAY * 2 ** stats.failures
+        self._dropped.discard(task)
+
+    def _next_retry(self):
+        waiting = [stats.retry_at for stats in self.candidates.values() if stats.failures < MAX_FAILURES]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - time.monotonic())
+
+    def _rotate(self):
+        now = time.monotonic()
+        for task, conn in self.active.items():
+            # Never unchoked us, or stopped sending blocks
+            if now - (conn.last_block or self._since[task]) > SNUB_TIMEOUT:
+                log.info("Dropping snubbing peer %s", conn.peer)
+                self._drop(task)
+        # Swap the slowest peer for a fresh candidate when every slot is taken
+        if len(self.active) - len(self._dropped) >= self.max_connections and self._eligible():
+            settled = [task for task in self.active
+                       if task not in self._dropped and now - self._since[task] >= ROTATE_INTERVAL]
+            if settled:
+                task = min(settled, key=lambda t: self.active[t].rate())
+                log.info("Replacing slow peer %s", self.active[task].peer)
+                self._drop(task)
+
+    def _choke(self):
+        # Tit-for-tat: unchoke the interested peers that gave us the most in the
+        # last round, plus one optimistic unchoke that rotates so new peers get
+        # a chance. run() returns once the download completes, so this only
+        # ever runs while leeching.
+        now = time.monotonic()
+        conns = [conn for conn in self.active.values() if conn.connected]
+        gained = {}
+        for conn in conns:
+            gained[conn] = conn.downloaded - self._transferred.get(conn, 0)
+            self._transferred[conn] = conn.downloaded
+        interested = sorted((conn for conn in conns if conn.peer_interested),
+                            key=gained.get, reverse=True)
+        unchoke = set(interested[:UPLOAD_SLOTS - 1])
+        optimistic = self._optimistic
+        if (optimistic not in conns or not optimistic.peer_interested or optimistic in unchoke
+                or now - self._optimistic_at >= OPTIMISTIC_INTERVAL):
+            others = [conn for conn in interested if conn not in unchoke]
+            optimistic = random.choice(others) if others else None
+            self._optimistic = optimistic
+            self._optimistic_at = now
+        if optimistic is not None:
+            unchoke.add(optimistic)
+        for conn in conns:
+            conn.set_choking(conn not in unchoke)
+
+    def _fill_upload_slots(self):
+        # Between rounds, hand free slots to newly interested peers right away
+        unchoked = sum(1 for conn in self.active.values() if not conn.am_choking)
+        if unchoked >= UPLOAD_SLOTS:
+            return
+        for conn in self.active.values():
+            if conn.connected and conn.peer_interested and conn.am_choking:
+                conn.set_choking(False)
+                unchoked += 1
+                if unchoked >= UPLOAD_SLOTS:
+                    break
+
+    def _broadcast_have(self, index):
+        for conn in self.active.values():
+            if conn.connected and index not in conn.available:
+                conn.send_have(index)
+        if self.piece_manager.is_complete():
+            self._complete.set()
+
+    def _on_returned(self, index):
+        # A failed, released or orphaned piece: connections that went idle
+        # before it came back would not ask for it until their peer speaks.
+        # Woken once per loop pass, outside the manager call that got here.
+        if not self._waking:
+            self._waking = True
+            asyncio.get_running_loop().call_soon(self._wake_idle)
+
+    def _wake_idle(self):
+        self._waking = False
+        for conn in self.active.values():
+            conn.wake()
+
+    def _drop(self, task):
+        self._dropped.add(task)
+        task.cancel()
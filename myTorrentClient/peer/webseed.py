@@ -0,0 +1,187 @@
+# File: peer/webseed.py
+# -----------------------------
+# BEP 19 web seeds: an HTTP server with the torrent's files acts as a seed.
+# Runs of consecutive pieces are fetched with Range requests over one pooled
+# keep-alive session and go through the same hash check and storage as
+# pieces from peers.
+import asyncio
+import logging
+import os
+import time
+import urllib.parse
+from bisect import bisect_right
+import aiohttp
+from peer.connection import PieceSink
+from pieces.bitfield import Bitfield
+from utils import metrics
+from utils.ratelimit import TransferLimits
+
+WEBSEED_REQUESTS = 4          # ranges in flight per web seed
+WEBSEED_RUN = 4 * 2 ** 20     # most bytes fetched by one run of pieces
+WEBSEED_TIMEOUT = 60.0
+WEBSEED_CONNECTIONS = 8
+MAX_FAILURES = 5
+RETRY_DELAY = 5.0
+IDLE_DELAY = 1.0              # wait when every missing piece is taken
+
+log = logging.getLogger('WebSeed')
+DOWNLOADED = metrics.counter('webseed_downloaded_bytes_total', 'Bytes received from web seeds')
+ERRORS = metrics.counter('webseed_errors_total', 'Failed web seed range requests')
+RANGE_LATENCY = metrics.histogram('webseed_range_seconds', 'Duration of web seed range requests')
+
+class WebSeedError(Exception):
+    pass
+
+def file_urls(url, files):
+    # URL of every file: a single-file torrent may name the file itself,
+    # otherwise the torrent's name and path are appended to the base URL
+    urls = []
+    for path, _ in files:
+        parts = path.split(os.sep)
+        if len(parts) == 1 and not url.endswith('/'):
+            urls.append(url)
+        else:
+            base = url if url.endswith('/') else url + '/'
+            urls.append(base + '/'.join(urllib.parse.quote(p) for p in parts))
+    return urls
+
+class WebSeed(PieceSink):
+    def __init__(self, url, metadata, piece_manager, storage, verifier, session=None,
+                 cache=None, disk=None, requests=WEBSEED_REQUESTS, limits=None):
+        self.url = url
+        self.label = url
+        self.metadata = metadata
+        self.piece_manager = piece_manager
+        self.storage = storage
+        self.verifier = verifier
+        self.cache = cache
+        self.disk = disk
+        self.requests = requests
+        self.limits = limits or TransferLimits()
+        self.files = [(file_url, length) for file_url, (_, length)
+                      in zip(file_urls(url, metadata['files']), metadata['files'])]
+        self._offsets = []
+        offset = 0
+        for _, length in self.files:
+            self._offsets.append(offset)
+            offset += length
+        self._session = session
+        self._own_session = session is None
+        self.downloaded = 0
+        self.failures = 0
+        self.hash_failures = 0
+        self._started = None
+
+    async def run(self):
+        # Fetch until the torrent is complete or the server keeps failing;
+        # the pieces count as one more seed for the picker
+        manager = self.piece_manager
+        seed = Bitfield.full(manager.num_pieces)
+        manager.add_peer(seed)
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=WEBSEED_CONNECTIONS)
+            self._session = aiohttp.ClientSession(connector=connector)
+        self._started = time.monotonic()
+        try:
+            await asyncio.gather(*(self._worker(seed) for _ in range(self.requests)))
+        finally:
+            manager.remove_peer(seed, True)
+            if self._own_session:
+                await self._session.close()
+                self._session = None
+
+    def rate(self):
+        if self._started is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started
+        return self.downloaded / elapsed if elapsed > 0 else 0.0
+
+    async def _worker(self, seed):
+        manager = self.piece_manager
+        piece_length = self.metadata['piece_length']
+        while not manager.is_complete() and self.failures < MAX_FAILURES:
+            if self.disk is not None:
+                await self.disk.wait()
+            run = self._claim(seed)
+            if not run:
+                await asyncio.sleep(IDLE_DELAY)
+                continue
+            try:
+                data = await self._fetch_run(run[0], run[-1])
+                self.failures = 0
+                self.downloaded += len(data)
+                manager.downloaded += len(data)
+                DOWNLOADED.inc(len(data))
+                view = memoryview(data)
+                start = run[0] * piece_length
+                while run:
+                    offset = run[0] * piece_length - start
+                    await self._verify(run[0], view[offset:offset + manager.piece_size(run[0])])
+                    run.pop(0)
+            except (aiohttp.ClientError, asyncio.TimeoutError, WebSeedError) as e:
+                ERRORS.inc()
+                self.failures += 1
+                log.warning("%s failed (%d): %r", self.url, self.failures, e)
+            finally:
+                # Pieces not handed to the verifier go back to the picker
+                for index in run:
+                    manager.release(index)
+            if 0 < self.failures < MAX_FAILURES:
+                await asyncio.sleep(RETRY_DELAY * 2 ** (self.failures - 1))
+        if self.failures >= MAX_FAILURES:
+            log.info("Giving up on web seed %s", self.url)
+
+    def _claim(self, seed):
+        # The picker's next piece plus the missing pieces right after it, so
+        # one request covers a contiguous range
+        manager = self.piece_manager
+        index = manager.pick(seed)
+        if index is None:
+            return []
+        run = [index]
+        size = manager.piece_size(index)
+        while (index + 1 < manager.num_pieces and size + manager.piece_size(index + 1) <= WEBSEED_RUN
+               and manager.claim(index + 1)):
+            index += 1
+            run.append(index)
+            size += manager.piece_size(index)
+        return run
+
+    async def _fetch_run(self, first, last):
+        piece_length = self.metadata['piece_length']
+        start = first * piece_length
+        end = last * piece_length + self.piece_manager.piece_size(last)
+        buf = bytearray(end - start)
+        pos = start
+        i = bisect_right(self._offsets, start) - 1
+        while pos < end:
+            file_url, length = self.files[i]
+            file_start = pos - self._offsets[i]
+            n = min(length - file_start, end - pos)
+            if n > 0:
+                await self._get(file_url, file_start, n, memoryview(buf)[pos - start:pos - start + n])
+                pos += n
+            i += 1
+        return buf
+
+    async def _get(self, url, offset, length, out):
+        started = time.perf_counter()
+        headers = {'Range': f'bytes={offset}-{offset + length - 1}'}
+        timeout = aiohttp.ClientTimeout(total=WEBSEED_TIMEOUT)
+        async with self._session.get(url, headers=headers, timeout=timeout) as resp:
+            # A server that ignores Range is only usable for a whole file
+            if resp.status != 206 and not (resp.status == 200 and offset == 0
+                                           and resp.content_length == length):
+                raise WebSeedError(f'HTTP {resp.status} for {url}')
+            pos = 0
+            limited = self.limits.download.limited()
+            async for chunk in resp.content.iter_any():
+                if pos + len(chunk) > length:
+                    raise WebSeedError(f'Too much data from {url}')
+                out[pos:pos + len(chunk)] = chunk
+                pos += len(chunk)
+                if limited:
+                    await self.limits.download.consume(len(chunk))
+            if pos != length:
+                raise WebSeedError(f'Short read from {url}: {pos} of {length} bytes')
+        RANGE_LATENCY.observe(time.perf_counter() - started)
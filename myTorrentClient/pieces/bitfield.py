@@ -0,0 +1,102 @@
+# File: pieces/bitfield.py
+# -----------------------------
+# Fixed-size bitfield in wire order: piece 0 is the high bit of byte 0.
+# Whole-field operations go through Python's big integers, so they run over
+# the bytes in C rather than as a Python loop per bit.
+
+# Set-bit positions of every byte value, for iterating over set bits
+_BYTE_BITS = tuple(tuple(i for i in range(8) if b & (0x80 >> i)) for b in range(256))
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:   # Python < 3.10
+    def _popcount(value):
+        return bin(value).count('1')
+
+class Bitfield:
+    __slots__ = ('size', 'bits', 'count')
+
+    def __init__(self, size, data=None):
+        self.size = size
+        length = (size + 7) // 8
+        if data is None:
+            self.bits = bytearray(length)
+            self.count = 0
+            return
+        bits = bytearray(data[:length])
+        bits.extend(bytes(length - len(bits)))
+        if size % 8:
+            # Spare bits after the last piece must be ignored
+            bits[-1] &= (0xff << (8 - size % 8)) & 0xff
+        self.bits = bits
+        self.count = _popcount(int.from_bytes(bits, 'big'))
+
+    @classmethod
+    def full(cls, size):
+        return cls(size, b'\xff' * ((size + 7) // 8))
+
+    def __contains__(self, index):
+        return 0 <= index < self.size and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __len__(self):
+        # Number of set bits
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        # Indices of set bits; zero bytes are skipped
+        table = _BYTE_BITS
+        for i, byte in enumerate(self.bits):
+            if byte:
+                base = i * 8
+                for bit in table[byte]:
+                    yield base + bit
+
+    def __eq__(self, other):
+        return isinstance(other, Bitfield) and self.size == other.size and self.bits == other.bits
+
+    def add(self, index):
+        # True if the bit was not set before
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if byte & mask:
+            return False
+        self.bits[index >> 3] = byte | mask
+        self.count += 1
+        return True
+
+    def discard(self, index):
+        mask = 0x80 >> (index & 7)
+        byte = self.bits[index >> 3]
+        if byte & mask:
+            self.bits[index >> 3] = byte & ~mask
+            self.count -= 1
+
+    def is_full(self):
+        return self.count == self.size
+
+    def __and__(self, other):
+        return self._from_int(self._int() & other._int())
+
+    def __or__(self, other):
+        return self._from_int(self._int() | other._int())
+
+    def andnot(self, other):
+        # Bits set here but not in other, e.g. a peer's pieces we still need
+        return self._from_int(self._int() & ~other._int())
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def to_digits(self):
+        # b'0' or b'1' per index, for expanding into per-piece counters
+        marker = 1 << 8 * len(self.bits)
+        return bin(self._int() | marker)[3:3 + self.size].encode()
+
+    def _int(self):
+        return int.from_bytes(self.bits, 'big')
+
+    def _from_int(self, value):
+        return Bitfield(self.size, value.to_bytes(len(self.bits), 'big'))
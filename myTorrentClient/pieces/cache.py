@@ -0,0 +1,51 @@
+# File: pieces/cache.py
+# -----------------------------
+# LRU cache of whole verified pieces for serving uploads. Peers usually ask
+# for every block of a piece in a row, so one read (or the buffer we just
+# verified) serves them all.
+from collections import OrderedDict
+from utils import metrics
+
+CACHE_SIZE = 64 * 2 ** 20
+
+HITS = metrics.counter('upload_cache_hits_total', 'Upload blocks served from the piece cache')
+MISSES = metrics.counter('upload_cache_misses_total', 'Upload blocks not in the piece cache')
+
+class PieceCache:
+    def __init__(self, storage, piece_manager, max_bytes=CACHE_SIZE):
+        self.storage = storage
+        self.piece_manager = piece_manager
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pieces = OrderedDict()   # index -> piece, least recently used first
+
+    def put(self, index, piece):
+        if len(piece) > self.max_bytes:
+            return
+        old = self._pieces.pop(index, None)
+        if old is not None:
+            self.size -= len(old)
+        self._pieces[index] = piece
+        self.size += len(piece)
+        while self.size > self.max_bytes:
+            self.size -= len(self._pieces.popitem(last=False)[1])
+
+    def block(self, index, begin, length):
+        # Memoryview of a cached block, or None on a miss
+        piece = self._pieces.get(index)
+        if piece is None:
+            MISSES.inc()
+            return None
+        HITS.inc()
+        self._pieces.move_to_end(index)
+        return memoryview(piece)[begin:begin + length]
+
+    def load(self, index):
+        # Reads the whole piece from disk into the cache
+        piece = self.storage.read_block(index, 0, self.piece_manager.piece_size(index))
+        self.put(index, piece)
+        return piece
+
+    def clear(self):
+        self._pieces.clear()
+        self.size = 0
@@ -1,21 +1,380 @@
 # File: pieces/manager.py
 # -----------------------------
-import hashlib
+import heapq
+import logging
+import random
+import sys
+import time
+from array import array
+from pieces.bitfield import Bitfield
+
+# Piece states, one byte per piece in PieceManager.state
+MISSING = 0
+IN_PROGRESS = 1
+COMPLETE = 2
+FAILED = 3
+
+# translate() table mapping a state byte to 1 if the piece can be picked
+PICKABLE = bytes(1 if s in (MISSING, FAILED) else 0 for s in range(256))
+# translate() tables between piece states and ASCII bits, used to pack
+# bitfields through int(..., 2) without a per-bit Python loop
+COMPLETE_DIGITS = bytes(ord('1') if s == COMPLETE else ord('0') for s in range(256))
+DIGIT_STATES = bytes(COMPLETE if c == ord('1') else MISSING for c in range(256))
+DIGIT_COUNTS = bytes(1 if c == ord('1') else 0 for c in range(256))
+# Offset of the low byte within each native 16-bit availability count
+_LOW_BYTE = 0 if sys.byteorder == 'little' else 1
+REORDER_INTERVAL = 1.0   # max staleness of the rarest-first order, in seconds
+BLOCK_SIZE = 2 ** 14     # 16 KiB, the largest request most peers accept
+
+log = logging.getLogger('PieceManager')
+TAIL_FRACTION = 0.99     # tail latency is measured over the last 1% of pieces
+ENDGAME_REQUESTERS = 3   # most peers asked for the same block in endgame
+STREAM_DEADLINE = 1.0    # a window block outstanding this long is raced from another peer
+STREAM_REQUESTERS = 2    # most peers asked for the same late window block
+
+class PieceDownload:
+    # Blocks of one in-progress piece, shared by every peer requesting them
+    def __init__(self, index, size, owner):
+        self.index = index
+        self.buffer = bytearray(size)
+        self.owner = owner
+        self.next_begin = 0     # first block never requested
+        self.remaining = size
+        self.requesters = {}    # begin -> connections with that block outstanding
+        self.requested_at = {}  # begin -> time of the first request
+        self.received = set()
+        self.retry = []         # heap of begins whose requests were dropped
+        self.sources = set()    # connections that delivered blocks, blamed for a bad hash
+
+    def next_block(self, requester):
+        size = len(self.buffer)
+        # A dropped block can still turn up late, so skip those already received
+        while self.retry and self.retry[0] in self.received:
+            heapq.heappop(self.retry)
+        if self.retry:
+            begin = heapq.heappop(self.retry)
+        elif self.next_begin < size:
+            begin = self.next_begin
+            self.next_begin += min(BLOCK_SIZE, size - begin)
+        else:
+            return None
+        length = min(BLOCK_SIZE, size - begin)
+        self.requesters[begin] = {requester}
+        self.requested_at[begin] = time.monotonic()
+        return begin, length
+
+    def write(self, begin, block):
+        # False for a block we already have (endgame duplicates)
+        if begin in self.received:
+            return False
+        self.buffer[begin:begin + len(block)] = block
+        self.received.add(begin)
+        self.remaining -= len(block)
+        return True
+
+    def drop(self, requester, begin):
+        # The requester will not deliver this block (choked, timed out or gone);
+        # once nobody else has it outstanding it is requested again
+        requesters = self.requesters.get(begin)
+        if requesters is None:
+            return
+        requesters.discard(requester)
+        if not requesters:
+            del self.requesters[begin]
+            del self.requested_at[begin]
+            heapq.heappush(self.retry, begin)
+
+    def block_length(self, begin):
+        # Expected length of the block at begin, or None if begin is not a block boundary
+        if begin % BLOCK_SIZE or begin >= len(self.buffer):
+            return None
+        return min(BLOCK_SIZE, len(self.buffer) - begin)
 
 class PieceManager:
     def __init__(self, metadata):
         self.metadata = metadata
-        hashes = metadata['pieces']
-        self.hash_list = [hashes[i:i+20] for i in range(0, len(hashes), 20)]
-        self.next_idx = 0
-
-    def next_piece(self):
-        if self.next_idx < len(self.hash_list):
-            idx = self.next_idx
-            self.next_idx += 1
-            return idx
+        # Hashes are sliced out of the original buffer on demand
+        self.hashes = memoryview(metadata['pieces'])
+        self.num_pieces = total = len(self.hashes) // 20
+        self.state = bytearray(total)
+        self.availability = array('H', bytes(2 * total))
+        self.seeds = 0          # peers with every piece, kept out of availability
+        self.completed = 0
+        # Transfer totals reported to trackers
+        self.downloaded = 0
+        self.uploaded = 0
+        # Fixed random permutation; a stable sort by availability over it
+        # gives rarest-first with random tie-breaks
+        self._tiebreak = list(range(total))
+        random.shuffle(self._tiebreak)
+        self._order = None
+        self._order_time = 0.0
+        self._order_start = 0   # entries of _order before this were all taken
+        self._dirty = False
+        self.downloads = {}     # index -> PieceDownload
+        self.orphaned = set()   # downloads with received blocks but no owner
+        # Endgame bookkeeping and the time-to-complete-last-1% metric
+        self.endgame_since = None
+        self.duplicate_bytes = 0
+        self.tail_start = None
+        self.tail_time = None
+        self.listeners = []     # called with the index of every newly completed piece
+        self.returned = []      # called with the index of every piece put back for others to take
+        # Streaming: pieces in [first, last) are picked in order before
+        # rarest-first; the window slides as its first piece completes
+        self.window = None
+        self._window_size = 0
+        self._next_late = 0.0   # no window block can be late before this time
+
+    def add_peer(self, pieces):
+        # A seed raises every piece's availability equally, which leaves the
+        # rarest-first order unchanged, so seeds are only counted. Returns
+        # True for a seed; pass that back to remove_peer.
+        if len(pieces) == self.num_pieces:
+            self.seeds += 1
+            return True
+        if pieces:
+            self._count(pieces, 1)
+        return False
+
+    def remove_peer(self, pieces, seed=False):
+        # pieces must be what add_peer and add_have counted for the peer
+        if seed:
+            self.seeds -= 1
+        elif pieces:
+            self._count(pieces, -1)
+
+    def _count(self, pieces, sign):
+        # Adds or subtracts a Bitfield from every count at once: the counts
+        # and the bits each become one big integer with a 16-bit lane per
+        # piece, so the work runs in C instead of a Python loop per bit
+        order = sys.byteorder
+        lanes = bytearray(2 * self.num_pieces)
+        lanes[_LOW_BYTE::2] = pieces.to_digits().translate(DIGIT_COUNTS)
+        total = int.from_bytes(self.availability, order) + sign * int.from_bytes(lanes, order)
+        self.availability = array('H', total.to_bytes(len(lanes), order))
+        self._dirty = True
+
+    def wanted(self, pieces):
+        # The pieces in a peer's Bitfield that we do not have yet
+        return pieces.andnot(Bitfield(self.num_pieces, self.completed_bitfield()))
+
+    def add_have(self, index):
+        self.availability[index] += 1
+        self._dirty = True
+
+    def set_window(self, first, size):
+        self._window_size = size
+        self._slide_window(first)
+
+    def clear_window(self):
+        self.window = None
+
+    def pick(self, peer_pieces):
+        if self.window is not None:
+            index = self._pick_from(range(*self.window), peer_pieces)
+            if index is not None:
+                return index
+        index = self._pick_ordered(peer_pieces)
+        if index is None and self._dirty:
+            # A stale order may be missing released or failed pieces
+            self._order = None
+            index = self._pick_ordered(peer_pieces)
+        return index
+
+    def claim(self, index):
+        # Take one specific piece if nobody has it, e.g. to extend a web seed's range
+        if PICKABLE[self.state[index]]:
+            self.state[index] = IN_PROGRESS
+            return True
+        return False
+
+    def start_download(self, index, owner):
+        download = PieceDownload(index, self.piece_size(index), owner)
+        self.downloads[index] = download
+        return download
+
+    def finish_download(self, index):
+        download = self.downloads.pop(index, None)
+        self.orphaned.discard(index)
+        if download is not None and download.owner is not None:
+            download.owner.pieces.pop(index, None)
+        return download
+
+    def abandon(self, index):
+        # The owner was choked or gave up: keep the blocks already received
+        # for another peer to finish, or release the piece if there are none
+        download = self.downloads.get(index)
+        if download is None:
+            return
+        if not download.received and not download.requesters:
+            self.release(index)
+            return
+        download.owner = None
+        self.orphaned.add(index)
+        self._notify_returned(index)
+
+    def adopt(self, peer_pieces, owner):
+        # An orphaned piece this peer can finish
+        for index in self.orphaned:
+            if index in peer_pieces:
+                self.orphaned.discard(index)
+                download = self.downloads[index]
+                download.owner = owner
+                return download
+        return None
+
+    def in_endgame(self):
+        # Every remaining block has been requested from someone
+        if not self.downloads or self.state.count(MISSING) or self.state.count(FAILED):
+            return False
+        if any(d.next_begin < len(d.buffer) or d.retry for d in self.downloads.values()):
+            return False
+        if self.endgame_since is None:
+            self.endgame_since = time.monotonic()
+            log.info("Endgame with %d pieces left", len(self.downloads))
+        return True
+
+    def endgame_block(self, peer_pieces, pending):
+        # An outstanding block this peer has and we have not asked it for yet
+        downloads = [d for d in self.downloads.values() if d.index in peer_pieces]
+        random.shuffle(downloads)
+        for download in downloads:
+            for begin, requesters in download.requesters.items():
+                if len(requesters) < ENDGAME_REQUESTERS and (download.index, begin) not in pending:
+                    length = min(BLOCK_SIZE, len(download.buffer) - begin)
+                    return download, begin, length
+        return None
+
+    def late_block(self, peer_pieces, pending):
+        # A window block past its deadline that this peer could race for
+        now = time.monotonic()
+        if self.window is None or now < self._next_late:
+            return None
+        next_late = now + STREAM_DEADLINE
+        for index in range(*self.window):
+            download = self.downloads.get(index)
+            if download is None:
+                continue
+            for begin, requesters in download.requesters.items():
+                if len(requesters) >= STREAM_REQUESTERS:
+                    continue
+                deadline = download.requested_at[begin] + STREAM_DEADLINE
+                if deadline > now:
+                    next_late = min(next_late, deadline)
+                elif index in peer_pieces and (index, begin) not in pending:
+                    return download, begin, min(BLOCK_SIZE, len(download.buffer) - begin)
+                else:
+                    next_late = now   # late, but for another peer to take
+        # Later requests only have later deadlines, so skip scans until then
+        self._next_late = next_late
         return None
 
+    def mark_complete(self, index):
+        if self.state[index] != COMPLETE:
+            self.state[index] = COMPLETE
+            self.completed += 1
+            total = len(self.state)
+            if self.tail_start is None and total - self.completed <= max(1, int(total * (1 - TAIL_FRACTION))):
+                self.tail_start = time.monotonic()
+            if self.completed == total and self.tail_start is not None:
+                self.tail_time = time.monotonic() - self.tail_start
+            if self.window is not None and index == self.window[0]:
+                self._slide_window(index)
+            for listener in self.listeners:
+                listener(index)
+
+    def mark_failed(self, index):
+        # Failed pieces go back into the pool
+        if self.state[index] != COMPLETE:
+            self.state[index] = FAILED
+            self._order_start = 0
+            self._dirty = True
+            self._notify_returned(index)
+
+    def release(self, index):
+        # Piece given up before any of it arrived
+        self.downloads.pop(index, None)
+        self.orphaned.discard(index)
+        if self.state[index] == IN_PROGRESS:
+            self.state[index] = MISSING
+            self._order_start = 0
+            self._dirty = True
+            self._notify_returned(index)
+
+    def _notify_returned(self, index):
+        for listener in self.returned:
+            listener(index)
+
+    def completed_bitfield(self):
+        total = len(self.state)
+        padded = self.state.translate(COMPLETE_DIGITS) + b'0' * (-total % 8)
+        return int(padded, 2).to_bytes(len(padded) // 8, 'big') if total else b''
+
+    def load_bitfield(self, bitfield):
+        total = len(self.state)
+        digits = bin(int.from_bytes(bitfield, 'big'))[2:].zfill(8 * len(bitfield))
+        self.state[:] = digits[:total].encode().translate(DIGIT_STATES)
+        self.completed = self.state.count(COMPLETE)
+        self._order = None
+
+    def bytes_left(self):
+        left = self.metadata['length'] - self.completed * self.metadata['piece_length']
+        if self.state and self.state[-1] == COMPLETE:
+            # The last piece is usually short, so it was over-counted above
+            left += self.metadata['piece_length'] - self.piece_size(len(self.state) - 1)
+        return max(0, left)
+
+    def is_complete(self):
+        return self.completed == self.num_pieces
+
+    def piece_size(self, index):
+        if index == self.num_pieces - 1:
+            return self.metadata['length'] - index * self.metadata['piece_length']
+        return self.metadata['piece_length']
+
     def expected_hash(self, index):
-        return self.hash_list[index]
+        return self.hashes[20 * index:20 * index + 20]
+
+    def _slide_window(self, first):
+        total = len(self.state)
+        while first < total and self.state[first] == COMPLETE:
+            first += 1
+        self.window = (first, min(total, first + self._window_size)) if first < total else None
+
+    def _pick_from(self, order, peer_pieces):
+        state = self.state
+        for index in order:
+            if PICKABLE[state[index]] and index in peer_pieces:
+                state[index] = IN_PROGRESS
+                return index
+        return None
+
+    def _pick_ordered(self, peer_pieces):
+        # Picked and completed pieces stay in the order until it is rebuilt;
+        # skip past that prefix once instead of on every pick
+        order = self._ordered()
+        state = self.state
+        start = self._order_start
+        while start < len(order) and not PICKABLE[state[order[start]]]:
+            start += 1
+        self._order_start = start
+        for i in range(start, len(order)):
+            index = order[i]
+            if PICKABLE[state[index]] and index in peer_pieces:
+                state[index] = IN_PROGRESS
+                return index
+        return None
 
+    def _ordered(self):
+        # Re-sorting 100k+ pieces is cheap in C but not free, so the order is
+        # rebuilt at most every REORDER_INTERVAL while availability churns
+        stale = self._dirty and time.monotonic() - self._order_time > REORDER_INTERVAL
+        if self._order is None or stale:
+            wanted = self.state.translate(PICKABLE)
+            candidates = filter(wanted.__getitem__, self._tiebreak)
+            self._order = sorted(candidates, key=self.availability.__getitem__)
+            self._order_time = time.monotonic()
+            self._order_start = 0
+            self._dirty = False
+        return self._order
@@ -0,0 +1,80 @@
+# File: pieces/resume.py
+# -----------------------------
+import asyncio
+import json
+import logging
+import os
+
+CHUNK_SIZE = 16 * 2 ** 20   # sequential read size for rechecks
+
+log = logging.getLogger('FastResume')
+
+class FastResume:
+    def __init__(self, metadata, storage, piece_manager, path=None):
+        self.metadata = metadata
+        self.storage = storage
+        self.piece_manager = piece_manager
+        self.path = path or os.path.join(storage.base_dir, metadata['name'] + '.resume')
+
+    def load(self):
+        # Marks the saved pieces complete; False if the sidecar is missing or stale
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('info_hash') != self.metadata['info_hash'].hex():
+            log.info("Sidecar belongs to another torrent")
+            return False
+        if data.get('files') != self._file_stats():
+            log.info("Files changed since last run")
+            return False
+        self.piece_manager.load_bitfield(bytes.fromhex(data['bitfield']))
+        log.info("Resumed %d pieces", self.piece_manager.completed)
+        return True
+
+    def save(self):
+        data = {
+            'info_hash': self.metadata['info_hash'].hex(),
+            'bitfield': self.piece_manager.completed_bitfield().hex(),
+            'files': self._file_stats(),
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    async def recheck(self, verifier, chunk_size=CHUNK_SIZE):
+        # Read the torrent front to back in large chunks and hash the pieces in
+        # each chunk on the verifier's pool while the next chunk is read
+        loop = asyncio.get_running_loop()
+        manager = self.piece_manager
+        total = manager.num_pieces
+        piece_length = self.storage.piece_length
+        per_chunk = max(1, chunk_size // piece_length)
+        tasks = []
+        log.info("Rechecking %d pieces", total)
+        for first in range(0, total, per_chunk):
+            last = min(first + per_chunk, total)
+            length = sum(manager.piece_size(i) for i in range(first, last))
+            chunk = await loop.run_in_executor(None, self.storage.read_block, first, 0, length)
+            view = memoryview(chunk)
+            for index in range(first, last):
+                start = (index - first) * piece_length
+                piece = view[start:start + manager.piece_size(index)]
+                task = await verifier.submit(piece, manager.expected_hash(index))
+                tasks.append((index, task))
+        for index, task in tasks:
+            if await task:
+                manager.mark_complete(index)
+        log.info("Recheck found %d/%d pieces", manager.completed, total)
+
+    def _file_stats(self):
+        stats = []
+        for path, _, _ in self.storage.files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            stats.append([path, st.st_size, st.st_mtime_ns])
+        return stats
@@ -1,16 +1,181 @@
 # File: pieces/storage.py
 # -----------------------------
 import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from utils import metrics
+
+MAX_OPEN_FILES = 64
+O_BINARY = getattr(os, 'O_BINARY', 0)
+POSITIONAL_IO = hasattr(os, 'pwrite')
+
+WRITE_LATENCY = metrics.histogram('disk_write_seconds', 'Duration of Storage.write_block calls')
 
 class Storage:
-    def __init__(self, filename, total_length, piece_length):
-        self.filename = filename
-        self.piece_length = piece_length
-        # Pre-allocate file
-        with open(filename, 'wb') as f:
-            f.truncate(total_length)
+    def __init__(self, metadata, base_dir='.', max_open=MAX_OPEN_FILES):
+        self.piece_length = metadata['piece_length']
+        self.base_dir = base_dir
+        self.max_open = max_open
+        # Each file occupies [offset, offset + length) of the torrent's byte space
+        self.files = []
+        offset = 0
+        root = os.path.abspath(base_dir)
+        for path, length in metadata['files']:
+            full = os.path.join(base_dir, path)
+            # Last line of defence against paths that escape the download directory
+            if os.path.commonpath([root, os.path.abspath(full)]) != root or os.path.abspath(full) == root:
+                raise ValueError(f'File outside the download directory: {path!r}')
+            self.files.append((full, offset, length))
+            offset += length
+        self.total_length = offset
+        self._offsets = [f[1] for f in self.files]
+        # Disk writer threads share the descriptors: the lock guards the table
+        # and a descriptor is never closed while a call is using it
+        self._handles = OrderedDict()   # path -> fd, least recently used first
+        self._busy = {}                 # path -> calls currently using its fd
+        self._lock = threading.Lock()
+        # True when none of the files existed, i.e. there is nothing to recheck
+        self.fresh = not any(os.path.exists(f[0]) for f in self.files)
+        self._allocate()
+
+    def _allocate(self):
+        # ftruncate only sets the size, so the files stay sparse until written
+        for path, _, length in self.files:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            fd = self._acquire(path)
+            try:
+                if os.fstat(fd).st_size != length:
+                    os.ftruncate(fd, length)
+            finally:
+                self._release(path)
 
     def write_block(self, index, offset, data):
-        with open(self.filename, 'r+b') as f:
-            f.seek(index * self.piece_length + offset)
-            f.write(data)
+        started = time.perf_counter()
+        view = memoryview(data)
+        for path, file_offset, start, size in self._spans(index * self.piece_length + offset, len(view)):
+            fd = self._acquire(path)
+            try:
+                _pwrite(fd, view[start:start + size], file_offset)
+            finally:
+                self._release(path)
+        WRITE_LATENCY.observe(time.perf_counter() - started)
+
+    def read_block(self, index, offset, length):
+        buf = None
+        for path, file_offset, start, size in self._spans(index * self.piece_length + offset, length):
+            fd = self._acquire(path)
+            try:
+                data = _pread(fd, size, file_offset)
+            finally:
+                self._release(path)
+            if size == length:
+                return data
+            if buf is None:
+                buf = bytearray(length)
+            buf[start:start + size] = data
+        return bytes(buf or length)
+
+    def locate(self, index, offset, length):
+        # (path, file offset) when the range lies inside a single file, else None
+        pos = index * self.piece_length + offset
+        path, start, size = self.files[bisect_right(self._offsets, pos) - 1]
+        if pos + length > start + size:
+            return None
+        return path, pos - start
+
+    @contextmanager
+    def open_file(self, path):
+        # The cached descriptor as a file object, e.g. for loop.sendfile. It
+        # stays open while borrowed and closing the file object leaves it open.
+        if not POSITIONAL_IO:
+            # sendfile's fallback seeks, which would race the disk workers
+            with open(path, 'rb') as f:
+                yield f
+            return
+        fd = self._acquire(path)
+        try:
+            with os.fdopen(fd, 'rb', closefd=False) as f:
+                yield f
+        finally:
+            self._release(path)
+
+    def close(self):
+        with self._lock:
+            while self._handles:
+                os.close(self._handles.popitem()[1])
+
+    def _spans(self, pos, length):
+        # Split [pos, pos + length) into (path, file_offset, data_offset, size) per file
+        i = bisect_right(self._offsets, pos) - 1
+        done = 0
+        while done < length and i < len(self.files):
+            path, start, size = self.files[i]
+            file_offset = pos + done - start
+            n = min(size - file_offset, length - done)
+            if n > 0:
+                yield path, file_offset, done, n
+                done += n
+            i += 1
+
+    def _acquire(self, path):
+        with self._lock:
+            fd = self._handles.get(path)
+            if fd is not None:
+                self._handles.move_to_end(path)
+            else:
+                if len(self._handles) >= self.max_open:
+                    # Close the least recently used descriptor nobody is using
+                    for victim in self._handles:
+                        if not self._busy.get(victim):
+                            os.close(self._handles.pop(victim))
+                            break
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | O_BINARY, 0o644)
+                self._handles[path] = fd
+            self._busy[path] = self._busy.get(path, 0) + 1
+            return fd
+
+    def _release(self, path):
+        with self._lock:
+            self._busy[path] -= 1
+
+# Windows has no positional I/O in the os module. Disk workers, readers and
+# rechecks share the cached descriptors, so a seek and the I/O after it must
+# not interleave with another thread's.
+_seek_locks = {}          # fd -> lock
+_seek_locks_lock = threading.Lock()
+
+def _seek_lock(fd):
+    with _seek_locks_lock:
+        lock = _seek_locks.get(fd)
+        if lock is None:
+            lock = _seek_locks[fd] = threading.Lock()
+        return lock
+
+def _seek_pwrite(fd, data, offset):
+    with _seek_lock(fd):
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+def _seek_pread(fd, length, offset):
+    with _seek_lock(fd):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+if POSITIONAL_IO:
+    def _pwrite(fd, data, offset):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
+
+    def _pread(fd, length, offset):
+        return os.pread(fd, length, offset)
+else:
+    _pwrite = _seek_pwrite
+    _pread = _seek_pread
@@ -0,0 +1,69 @@
+# File: pieces/stream.py
+# -----------------------------
+# Byte-range reads over a torrent that is still downloading. Each read moves
+# the piece manager's priority window to the requested position and returns
+# once the pieces covering the range are verified and on disk.
+import asyncio
+from pieces.manager import COMPLETE
+
+STREAM_WINDOW = 8 * 2 ** 20   # bytes after the read position fetched first
+
+class RangeReader:
+    def __init__(self, storage, piece_manager, window=STREAM_WINDOW):
+        self.storage = storage
+        self.piece_manager = piece_manager
+        self.piece_length = storage.piece_length
+        self.length = storage.total_length
+        self.window_pieces = max(2, window // self.piece_length)
+        self._waiters = {}   # piece index -> futures of reads waiting for it
+        piece_manager.listeners.append(self._on_complete)
+
+    async def read(self, offset, length):
+        # Up to length bytes at offset in the torrent's byte space
+        length = max(0, min(length, self.length - offset))
+        if not length:
+            return b''
+        first = offset // self.piece_length
+        last = (offset + length - 1) // self.piece_length
+        self.piece_manager.set_window(first, max(self.window_pieces, last - first + 1))
+        for index in range(first, last + 1):
+            await self._wait_for(index)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.storage.read_block, first,
+                                          offset - first * self.piece_length, length)
+
+    async def iter_range(self, offset, length):
+        # Yields the range a piece at a time, so the first bytes are available
+        # as soon as the first piece is
+        end = min(self.length, offset + length)
+        while offset < end:
+            boundary = (offset // self.piece_length + 1) * self.piece_length
+            data = await self.read(offset, min(boundary, end) - offset)
+            offset += len(data)
+            yield data
+
+    def file_range(self, index):
+        # (offset, length) of the index-th file in the torrent's byte space
+        _, offset, length = self.storage.files[index]
+        return offset, length
+
+    def close(self):
+        if self._on_complete in self.piece_manager.listeners:
+            self.piece_manager.listeners.remove(self._on_complete)
+        self.piece_manager.clear_window()
+        for futures in self._waiters.values():
+            for future in futures:
+                future.cancel()
+        self._waiters.clear()
+
+    async def _wait_for(self, index):
+        if self.piece_manager.state[index] == COMPLETE:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(index, []).append(future)
+        await future
+
+    def _on_complete(self, index):
+        for future in self._waiters.pop(index, ()):
+            if not future.done():
+                future.set_result(None)
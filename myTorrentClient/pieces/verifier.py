@@ -0,0 +1,67 @@
+# File: pieces/verifier.py
+# -----------------------------
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+
+HASH_TIME = metrics.histogram('piece_hash_seconds', 'SHA-1 time per piece on a worker')
+VERIFIED = metrics.counter('pieces_verified_total', 'Pieces whose hash matched')
+FAILED = metrics.counter('pieces_failed_total', 'Pieces whose hash did not match')
+
+def _check(piece, expected):
+    # hashlib releases the GIL for buffers over 2 KiB, so workers run in parallel
+    start = time.perf_counter()
+    ok = hashlib.sha1(piece).digest() == expected
+    return ok, time.perf_counter() - start
+
+class PieceVerifier:
+    def __init__(self, workers=0, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        # Pieces queued or being hashed; bounds the memory held by finished pieces
+        self.max_pending = max_pending or 2 * self.workers
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='verify')
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._tasks = set()
+        self.pieces = 0
+        self.failed = 0
+        self.bytes_hashed = 0
+        self.hash_time = 0.0
+
+    async def submit(self, piece, expected):
+        # Waits while the queue is full, then returns a task resolving to the result
+        await self._slots.acquire()
+        task = asyncio.ensure_future(self._run(piece, expected))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def verify(self, piece, expected):
+        return await (await self.submit(piece, expected))
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def throughput(self):
+        # Bytes per second per worker, measured inside the hash calls
+        return self.bytes_hashed / self.hash_time if self.hash_time else 0.0
+
+    async def _run(self, piece, expected):
+        loop = asyncio.get_running_loop()
+        try:
+            ok, elapsed = await loop.run_in_executor(self._executor, _check, piece, expected)
+        finally:
+            self._slots.release()
+        self.pieces += 1
+        self.failed += not ok
+        self.bytes_hashed += len(piece)
+        self.hash_time += elapsed
+        HASH_TIME.observe(elapsed)
+        (VERIFIED if ok else FAILED).inc()
+        return ok
@@ -0,0 +1,108 @@
+# File: pieces/writer.py
+# -----------------------------
+# Writes verified pieces from a thread pool so a slow disk never blocks the
+# event loop. Pieces queue up while every worker is busy; the next free
+# worker takes the lowest queued piece plus the pieces directly after it and
+# writes them as one sequential write.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics
+
+DISK_WORKERS = 2
+MAX_PENDING = 64 * 2 ** 20   # unwritten bytes before downloads are held back
+MAX_MERGE = 16 * 2 ** 20     # largest single coalesced write
+
+MERGED = metrics.histogram('disk_pieces_per_write', 'Pieces merged into one disk write',
+                           metrics.DEPTH_BUCKETS)
+STALLS = metrics.counter('disk_backpressure_waits_total', 'Times a peer waited for the disk queue')
+
+class DiskWriter:
+    def __init__(self, storage, workers=DISK_WORKERS, max_pending=MAX_PENDING, max_merge=MAX_MERGE):
+        self.storage = storage
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_merge = max_merge
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='disk')
+        self._queue = {}          # index -> (piece, future) waiting for a worker
+        self._idle = workers
+        self._ready = asyncio.Event()
+        self._ready.set()
+        self._futures = set()
+        self.pending_bytes = 0    # queued plus being written
+        self.writes = 0
+        self.pieces = 0
+
+    def write(self, index, piece):
+        # Returns a future resolved once the piece is on disk
+        future = asyncio.get_running_loop().create_future()
+        self._queue[index] = (piece, future)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        self.pending_bytes += len(piece)
+        if self.congested():
+            self._ready.clear()
+        self._dispatch()
+        return future
+
+    def congested(self):
+        return self.pending_bytes >= self.max_pending
+
+    async def wait(self):
+        # Blocks while unwritten bytes are over the cap
+        if self.congested():
+            STALLS.inc()
+            await self._ready.wait()
+
+    async def drain(self):
+        if self._futures:
+            await asyncio.gather(*self._futures, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._idle and self._queue:
+            run = self._take_run()
+            self._idle -= 1
+            job = loop.run_in_executor(self._executor, self._write_run, run[0][0],
+                                       [piece for _, piece, _ in run])
+            job.add_done_callback(lambda job, run=run: self._finished(run, job))
+
+    def _take_run(self):
+        # Lowest queued piece and the queued pieces that follow it on disk
+        index = min(self._queue)
+        piece, future = self._queue.pop(index)
+        run = [(index, piece, future)]
+        size = len(piece)
+        while index + 1 in self._queue and size + len(self._queue[index + 1][0]) <= self.max_merge:
+            index += 1
+            piece, future = self._queue.pop(index)
+            run.append((index, piece, future))
+            size += len(piece)
+        return run
+
+    def _write_run(self, index, pieces):
+        # Worker thread; pieces are consecutive, so they are contiguous on disk
+        data = pieces[0] if len(pieces) == 1 else b''.join(pieces)
+        self.storage.write_block(index, 0, data)
+
+    def _finished(self, run, job):
+        self._idle += 1
+        self.writes += 1
+        self.pieces += len(run)
+        MERGED.observe(len(run))
+        error = None if job.cancelled() else job.exception()
+        for _, piece, future in run:
+            self.pending_bytes -= len(piece)
+            if future.done():
+                continue
+            if job.cancelled():
+                future.cancel()
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+        if not self.congested():
+            self._ready.set()
+        self._dispatch()
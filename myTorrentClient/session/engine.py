@@ -0,0 +1,167 @@
+# File: session/engine.py
+# -----------------------------
+# One background thread and event loop running every torrent. Other threads
+# talk to it through the thread-safe command methods and receive coalesced
+# snapshots through callbacks invoked on the engine thread.
+import asyncio
+import itertools
+import logging
+import threading
+import aiohttp
+from peer.swarm import MAX_CONNECTIONS
+from pieces.verifier import PieceVerifier
+from session.torrent import Torrent
+from utils import metrics
+from utils.ratelimit import TransferLimits
+
+SNAPSHOT_HZ = 4
+
+log = logging.getLogger('SessionEngine')
+
+class SessionEngine:
+    def __init__(self, download_limit=0, upload_limit=0, hash_workers=0,
+                 max_connections=MAX_CONNECTIONS, on_update=None, on_log=None, metrics_port=None):
+        self.limits = TransferLimits(download_limit, upload_limit)
+        self.hash_workers = hash_workers
+        self.max_connections = max_connections
+        self.on_update = on_update   # called with {torrent_id: snapshot} at SNAPSHOT_HZ
+        self.on_log = on_log or print
+        self.metrics_port = metrics_port   # serve Prometheus text on 127.0.0.1:port if set
+        self._exporter = None
+        self.loop = None
+        self.torrents = {}   # torrent_id -> Torrent, only touched on the engine loop
+        self._tasks = {}     # torrent_id -> asyncio.Task
+        self._stopped = set()   # torrent_ids whose task stop() cancelled
+        self._closing = False
+        self._ids = itertools.count(1)
+        self._id_lock = threading.Lock()
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='session-engine', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    # Thread-safe commands
+
+    def add(self, source):
+        with self._id_lock:
+            torrent_id = next(self._ids)
+        self._call(self._add, torrent_id, source)
+        return torrent_id
+
+    def pause(self, torrent_id):
+        self._call(self._with_torrent, torrent_id, Torrent.pause)
+
+    def resume(self, torrent_id):
+        # Also restarts a stopped torrent
+        self._call(self._resume, torrent_id)
+
+    def stop(self, torrent_id):
+        self._call(self._stop, torrent_id)
+
+    def set_limits(self, download_limit, upload_limit):
+        self._call(self.limits.set_rates, download_limit, upload_limit)
+
+    def set_torrent_limits(self, torrent_id, download_limit, upload_limit):
+        # Caps for one torrent; the engine-wide limits still apply on top
+        self._call(self._with_torrent, torrent_id, Torrent.set_limits, download_limit, upload_limit)
+
+    def stats(self):
+        # Process-wide counters and histograms; values may lag by one update
+        return metrics.snapshot()
+
+    def shutdown(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    # Engine thread
+
+    def _call(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._setup())
+        finally:
+            self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _setup(self):
+        # Shared by every torrent: tracker HTTP pool, hash workers, publisher
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self.verifier = PieceVerifier(self.hash_workers)
+        self._publisher = asyncio.create_task(self._publish())
+        if self.metrics_port:
+            self._exporter = await metrics.serve(self.metrics_port)
+
+    def _add(self, torrent_id, source):
+        torrent = Torrent(source, self.verifier, self.limits, self.max_connections,
+                          session=self._session, log=self.on_log)
+        self.torrents[torrent_id] = torrent
+        self._tasks[torrent_id] = self.loop.create_task(torrent.run())
+
+    def _with_torrent(self, torrent_id, method, *args):
+        torrent = self.torrents.get(torrent_id)
+        if torrent is not None:
+            method(torrent, *args)
+
+    def _resume(self, torrent_id):
+        torrent = self.torrents.get(torrent_id)
+        if torrent is None:
+            return
+        torrent.resume()
+        if torrent_id in self._stopped:
+            self._stopped.discard(torrent_id)
+            task = self._tasks[torrent_id]
+            if task.done():
+                self._restart(torrent_id)
+            else:
+                # Still shutting down: start again once it has
+                task.add_done_callback(lambda _: self._restart(torrent_id))
+
+    def _restart(self, torrent_id):
+        # Not if stopped again before the old task finished
+        if self._closing or torrent_id in self._stopped:
+            return
+        torrent = self.torrents[torrent_id]
+        self._tasks[torrent_id] = self.loop.create_task(torrent.run())
+
+    def _stop(self, torrent_id):
+        task = self._tasks.get(torrent_id)
+        if task is not None and not task.done():
+            task.cancel()
+            self._stopped.add(torrent_id)
+
+    async def _publish(self):
+        # One coalesced update for all torrents instead of a signal per piece
+        while True:
+            await asyncio.sleep(1 / SNAPSHOT_HZ)
+            if self.on_update is not None and self.torrents:
+                snapshots = {tid: t.snapshot() for tid, t in self.torrents.items()}
+                try:
+                    self.on_update(snapshots)
+                except Exception as e:
+                    log.warning("Update callback failed: %r", e)
+
+    async def _shutdown(self):
+        self._closing = True
+        self._publisher.cancel()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.verifier.drain()
+        self.verifier.close()
+        await self._session.close()
+        if self._exporter is not None:
+            await self._exporter.cleanup()
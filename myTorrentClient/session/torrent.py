@@ -0,0 +1,187 @@
+# File: session/torrent.py
+# -----------------------------
+import asyncio
+import aiohttp
+import os
+import time
+from torrent_parser.parser import TorrentParser
+from tracker.client import TrackerClient
+from peer.swarm import SwarmManager, MAX_CONNECTIONS
+from pieces.manager import PieceManager
+from pieces.storage import Storage
+from pieces.resume import FastResume
+from pieces.stream import RangeReader, STREAM_WINDOW
+from pieces.writer import DiskWriter, MAX_PENDING
+from utils.ratelimit import TransferLimits
+
+class Torrent:
+    def __init__(self, source, verifier, limits=None, max_connections=MAX_CONNECTIONS,
+                 session=None, log=print, write_buffer=MAX_PENDING, sequential=False):
+        self.source = source
+        self.verifier = verifier
+        # Per-torrent buckets under the global limits, unlimited until set_limits
+        self.limits = TransferLimits(parent=limits)
+        self.max_connections = max_connections
+        self.session = session   # shared aiohttp session, if any
+        self.write_buffer = write_buffer   # unwritten bytes allowed before peers are held back
+        self.sequential = sequential       # download front to back through a sliding window
+        self.log = log
+        self.state = 'queued'
+        self.name = os.path.basename(source)
+        self.metadata = None
+        self.storage = None
+        self.disk = None
+        self.piece_manager = None
+        self.swarm = None
+        self._paused = False
+        self._rate_sample = (time.monotonic(), 0, 0)
+
+    async def run(self):
+        tracker = None
+        resume = None
+        try:
+            self.state = 'checking'
+            path = await self._fetch(self.source)
+            self.metadata = TorrentParser(path).parse()
+            self.name = self.metadata['name']
+            self.storage = Storage(self.metadata)
+            self.piece_manager = PieceManager(self.metadata)
+            # A restart counts from zero again; the last sample is from the old run
+            self._rate_sample = (time.monotonic(), 0, 0)
+            if self.sequential:
+                self.piece_manager.set_window(0, max(2, STREAM_WINDOW // self.metadata['piece_length']))
+
+            # Skip pieces finished by an earlier run, rechecking existing data if needed
+            resume = FastResume(self.metadata, self.storage, self.piece_manager)
+            if not resume.load() and not self.storage.fresh:
+                await resume.recheck(self.verifier)
+            if self.piece_manager.is_complete():
+                self.log(f"[Torrent] {self.name}: all pieces already downloaded")
+                self.state = 'finished'
+                return
+
+            # Announce to the tracker tiers
+            tracker = TrackerClient(self.metadata, self.piece_manager, self.session)
+            self.disk = DiskWriter(self.storage, max_pending=self.write_buffer)
+            self.swarm = SwarmManager(self.metadata, self.piece_manager, self.storage, self.verifier,
+                                      self.max_connections, limits=self.limits, disk=self.disk,
+                                      web_seeds=self.metadata.get('url_list', ()), session=self.session)
+            if self._paused:
+                self.swarm.pause()
+            # Start as soon as any tracker answers; slower trackers in the
+            # tier add their peers while the swarm is already running
+            found = asyncio.Event()
+
+            def on_peers(peers):
+                self.swarm.add_peers(peers)
+                found.set()
+
+            async def announce():
+                await tracker.get_peers(on_peers=on_peers)
+                found.set()
+                await tracker.run(self.swarm.add_peers)
+
+            announcer = asyncio.create_task(announce())
+            try:
+                if not self.swarm.web_seeds:
+                    waiter = asyncio.ensure_future(found.wait())
+                    await asyncio.wait([waiter, announcer], return_when=asyncio.FIRST_COMPLETED)
+                    waiter.cancel()
+                    if announcer.done():
+                        announcer.result()
+                if not self.swarm.candidates and not self.swarm.web_seeds:
+                    self.log(f"[Torrent] {self.name}: no peers found")
+                    self.state = 'stopped'
+                    return
+
+                # Download through a bounded set of connections, adding new peers on re-announce
+                self.state = 'paused' if self._paused else 'downloading'
+                await self.swarm.run()
+            finally:
+                announcer.cancel()
+                await asyncio.gather(announcer, return_exceptions=True)
+            await self.verifier.drain()
+            await self.disk.drain()
+            self.state = 'finished' if self.piece_manager.is_complete() else 'stopped'
+            self.log(f"[Torrent] {self.name}: {self.state}")
+        except asyncio.CancelledError:
+            self.state = 'stopped'
+            raise
+        except Exception as e:
+            self.state = 'error'
+            self.log(f"[Torrent] {self.name}: error {e!r}")
+        finally:
+            if tracker is not None:
+                done = self.piece_manager.is_complete()
+                await asyncio.shield(tracker.close('completed' if done else 'stopped'))
+            if self.disk is not None:
+                # Pieces already verified still reach the disk before it closes
+                await self.disk.drain()
+                self.disk.close()
+            if self.storage is not None:
+                self.storage.close()
+            if resume is not None:
+                resume.save()
+
+    def open_reader(self, window=STREAM_WINDOW):
+        # Byte-range reader over the data; valid once checking has finished
+        if self.storage is None or self.piece_manager is None:
+            raise RuntimeError('torrent is not running yet')
+        return RangeReader(self.storage, self.piece_manager, window)
+
+    def set_limits(self, download_limit, upload_limit):
+        # Bytes per second for this torrent alone, 0 for unlimited
+        self.limits.set_rates(download_limit, upload_limit)
+
+    def pause(self):
+        self._paused = True
+        if self.swarm is not None:
+            self.swarm.pause()
+        if self.state == 'downloading':
+            self.state = 'paused'
+
+    def resume(self):
+        self._paused = False
+        if self.swarm is not None:
+            self.swarm.resume()
+        if self.state == 'paused':
+            self.state = 'downloading'
+
+    def snapshot(self):
+        # Progress and speeds since the previous snapshot
+        pm = self.piece_manager
+        now = time.monotonic()
+        downloaded = pm.downloaded if pm else 0
+        uploaded = pm.uploaded if pm else 0
+        sources = self.swarm.sources() if self.swarm else []
+        then, last_down, last_up = self._rate_sample
+        elapsed = max(now - then, 1e-6)
+        self._rate_sample = (now, downloaded, uploaded)
+        return {
+            'name': self.name,
+            'state': self.state,
+            'size': self.metadata['length'] if self.metadata else 0,
+            'progress': pm.completed / pm.num_pieces if pm and pm.num_pieces else 0.0,
+            'download_rate': (downloaded - last_down) / elapsed,
+            'upload_rate': (uploaded - last_up) / elapsed,
+            'peers': len(sources),
+            'peer_rates': sorted((source.rate() for source in sources), reverse=True),
+        }
+
+    async def _fetch(self, source):
+        # If URL, download the torrent file next to the data
+        if not source.startswith(('http://', 'https://')):
+            return source
+        self.log("[Torrent] Detected torrent URL, downloading...")
+        if self.session is not None:
+            async with self.session.get(source) as resp:
+                data = await resp.read()
+        else:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(source) as resp:
+                    data = await resp.read()
+        filename = os.path.basename(source)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        self.log(f"[Torrent] Torrent file saved as {filename}")
+        return filename
@@ -0,0 +1,49 @@
+# File: test/conftest.py
+# -----------------------------
+# Helpers shared by the test modules; import them with "from conftest import ..."
+import hashlib
+import struct
+from aiohttp import web
+
+def make_metadata(data, piece_length, info_hash, **fields):
+    # Parsed-torrent metadata for data held in memory; fields adds name, files, ...
+    metadata = {
+        'info_hash': info_hash,
+        'piece_length': piece_length,
+        'length': len(data),
+        'pieces': b''.join(hashlib.sha1(data[i:i + piece_length]).digest()
+                           for i in range(0, len(data), piece_length)),
+    }
+    metadata.update(fields)
+    return metadata
+
+class MemoryStorage:
+    # Stands in for Storage, keeping the whole torrent in one buffer
+    def __init__(self, metadata):
+        self.piece_length = metadata['piece_length']
+        self.data = bytearray(metadata['length'])
+
+    def write_block(self, index, offset, block):
+        start = index * self.piece_length + offset
+        self.data[start:start + len(block)] = block
+
+async def read_message(reader):
+    # One peer wire message as (id, payload); (None, b'') for a keep-alive
+    length = struct.unpack('>I', await reader.readexactly(4))[0]
+    msg = await reader.readexactly(length)
+    return (msg[0], msg[1:]) if msg else (None, b'')
+
+async def start_app(app):
+    # Serves an aiohttp app on a free local port; returns the runner and port
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+async def start_tracker(handler):
+    # HTTP tracker whose announces are answered by handler
+    app = web.Application()
+    app.router.add_get('/announce', handler)
+    runner, port = await start_app(app)
+    return runner, f'http://127.0.0.1:{port}/announce'
@@ -0,0 +1,57 @@
+# File: test/test_bencode.py
+# -----------------------------
+import hashlib
+import pytest
+from utils.bencode_utils import (decode, decode_torrent, encode, IncrementalDecoder,
+                                 BencodeError)
+
+def test_round_trip():
+    value = {b'a': [1, -2, b'xy', {b'k': b''}], b'b': 0, b'c': b'1:2'}
+    assert decode(encode(value)) == value
+    assert encode({'b': 1, 'a': 'x'}) == b'd1:a1:x1:bi1ee'
+
+def test_errors():
+    for bad in (b'i12', b'5:abc', b'l1:a', b'x', b'i1ei2e', b'di1e1:ae', b'iabce', b'3x:abc',
+                b'1 :a', b'l' * 100000 + b'e' * 100000):
+        with pytest.raises(BencodeError):
+            decode(bad)
+    # Deep but within MAX_DEPTH is fine
+    nested = []
+    for _ in range(49):
+        nested = [nested]
+    assert decode(b'l' * 50 + b'e' * 50) == nested
+
+def test_info_hash_uses_original_bytes():
+    # Keys out of order: re-encoding would sort them and change the hash
+    info = b'd4:name1:x12:piece lengthi16e6:pieces20:' + bytes(range(20)) + b'6:lengthi5ee'
+    raw = b'd8:announce3:url4:info' + info + b'e'
+    data, (start, end) = decode_torrent(raw)
+    assert raw[start:end] == info
+    assert hashlib.sha1(raw[start:end]).digest() != hashlib.sha1(encode(data[b'info'])).digest()
+    pieces = data[b'info'][b'pieces']
+    assert isinstance(pieces, memoryview) and pieces.obj is raw
+    assert pieces == bytes(range(20))
+
+def test_incremental():
+    raw = encode({b'interval': 1800, b'peers': bytes(60)})
+    decoder = IncrementalDecoder()
+    chunks = [raw[i:i + 7] for i in range(0, len(raw), 7)]
+    results = [decoder.feed(chunk) for chunk in chunks]
+    assert results[:-1] == [None] * (len(chunks) - 1)
+    assert results[-1][b'interval'] == 1800
+    assert decoder.close() is results[-1]
+    with pytest.raises(BencodeError):
+        IncrementalDecoder().close()
+
+def test_incremental_errors_and_byte_at_a_time():
+    raw = encode({b'interval': 1800, b'peers': [{b'ip': b'1.2.3.4', b'port': 1}] * 50})
+    decoder = IncrementalDecoder()
+    results = [decoder.feed(raw[i:i + 1]) for i in range(len(raw))]
+    assert results[:-1] == [None] * (len(raw) - 1)
+    assert results[-1] == decode(raw)
+    for bad in (b'3x:abc', b'x', b'e', b'l' * 1000):
+        decoder = IncrementalDecoder()
+        with pytest.raises(BencodeError):
+            for i in range(len(bad)):
+                decoder.feed(bad[i:i + 1])
+            decoder.close()
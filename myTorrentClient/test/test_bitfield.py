@@ -0,0 +1,40 @@
+# File: test/test_bitfield.py
+# -----------------------------
+from pieces.bitfield import Bitfield
+from pieces.manager import PieceManager
+
+def test_wire_order_and_spare_bits():
+    bits = Bitfield(10, b'\xa0\xff')
+    assert list(bits) == [0, 2, 8, 9]
+    assert len(bits) == 4
+    assert 2 in bits and 1 not in bits and 10 not in bits and -1 not in bits
+    assert bits.to_bytes() == b'\xa0\xc0'
+    assert Bitfield(10, b'\x80').to_bytes() == b'\x80\x00'
+    assert bits.to_digits() == b'1010000011'
+    assert Bitfield(3).to_digits() == b'000' and Bitfield(0).to_digits() == b''
+
+def test_have_updates_and_set_operations():
+    ours = Bitfield(12)
+    assert ours.add(3) and not ours.add(3)
+    ours.add(11)
+    theirs = Bitfield.full(12)
+    assert theirs.is_full() and len(theirs) == 12
+    need = theirs.andnot(ours)
+    assert len(need) == 10 and 3 not in need and 11 not in need
+    assert list(theirs & ours) == [3, 11]
+    assert (ours | Bitfield(12, b'\x80')) == Bitfield(12, b'\x90\x10')
+    ours.discard(3)
+    ours.discard(3)
+    assert list(ours) == [11] and len(ours) == 1
+
+def test_manager_counts_seeds_and_slices_hashes():
+    hashes = bytes(range(60))
+    pm = PieceManager({'pieces': hashes, 'piece_length': 16, 'length': 40})
+    assert pm.num_pieces == 3 and bytes(pm.expected_hash(1)) == hashes[20:40]
+    assert pm.add_peer(Bitfield.full(3))
+    assert not pm.add_peer(Bitfield(3, b'\x40'))
+    assert pm.seeds == 1 and list(pm.availability) == [0, 1, 0]
+    pm.mark_complete(2)
+    assert list(pm.wanted(Bitfield.full(3))) == [0, 1]
+    pm.remove_peer(Bitfield.full(3), seed=True)
+    assert pm.seeds == 0
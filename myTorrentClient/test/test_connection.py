@@ -0,0 +1,173 @@
+# File: test/test_connection.py
+# -----------------------------
+import asyncio
+import os
+import struct
+from conftest import MemoryStorage, make_metadata, read_message
+from peer import connection
+from peer.connection import PeerConnection
+from peer.protocol import PEER_ID, RESERVED
+from pieces.bitfield import Bitfield
+from pieces.manager import PieceManager
+from pieces.verifier import PieceVerifier
+from utils.bencode_utils import decode, encode
+
+PIECE_LENGTH = 2 ** 15
+DATA = os.urandom(PIECE_LENGTH * 4)
+METADATA = make_metadata(DATA, PIECE_LENGTH, b'c' * 20)
+
+def block(index, begin, length):
+    start = index * PIECE_LENGTH + begin
+    return struct.pack('>IBII', 9 + length, 7, index, begin) + DATA[start:start + length]
+
+def download(peer, reserved=bytes(8)):
+    # One connection against a scripted peer; returns what it sent and the result
+    sent = []
+
+    async def handle(reader, writer):
+        sent.append(('handshake', await reader.readexactly(68)))
+        writer.write(bytes([19]) + b'BitTorrent protocol' + reserved + b'c' * 20 + b's' * 20)
+        try:
+            await peer(reader, writer, sent)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        pm = PieceManager(METADATA)
+        storage = MemoryStorage(METADATA)
+        verifier = PieceVerifier(workers=1)
+        conn = PeerConnection(('127.0.0.1', port), METADATA, pm, storage, verifier)
+        await asyncio.wait_for(conn.start(), 10)
+        server.close()
+        verifier.close()
+        return pm, storage, conn
+
+    return sent, *asyncio.run(run())
+
+async def serve(reader, writer, sent, until):
+    # Answers requests until a message with id until arrives
+    while True:
+        msg_id, payload = await read_message(reader)
+        sent.append((msg_id, payload))
+        if msg_id == until:
+            return
+        if msg_id == 6:
+            writer.write(block(*struct.unpack('>III', payload)))
+
+def test_choke_mid_transfer_keeps_the_connection_and_requeues():
+    async def peer(reader, writer, sent):
+        writer.write(struct.pack('>IBB', 2, 5, 0xe0))   # pieces 0-2, the last one comes as a have
+        msg_id = None
+        while msg_id != 2:
+            msg_id, _ = await read_message(reader)
+        writer.write(struct.pack('>IB', 1, 1))
+        requests = []
+        while len(requests) < 3:
+            msg_id, payload = await read_message(reader)
+            if msg_id == 6:
+                requests.append(struct.unpack('>III', payload))
+        # Answer one request, choke and drop the rest, then let a dropped one arrive late
+        writer.write(block(*requests[0]) + struct.pack('>IB', 1, 0) + block(*requests[1]))
+        writer.write(struct.pack('>IBI', 5, 4, 3) + struct.pack('>IB', 1, 1))
+        await serve(reader, writer, sent, until=3)
+
+    sent, pm, storage, conn = download(peer)
+    assert pm.is_complete() and bytes(storage.data) == DATA
+    assert sent[-1][0] == 3 and not conn.am_interested
+    # Nothing was requested twice except blocks lost to the choke
+    requests = [payload for msg_id, payload in sent if msg_id == 6]
+    assert len(requests) <= len(DATA) // 2 ** 14 + 1
+
+def test_timed_out_request_is_cancelled_and_requested_again(monkeypatch):
+    monkeypatch.setattr(connection, 'REQUEST_TIMEOUT', 0.2)
+    monkeypatch.setattr(connection, 'WATCHDOG_INTERVAL', 0.05)
+    first = []
+
+    async def peer(reader, writer, sent):
+        writer.write(struct.pack('>IBB', 2, 5, 0xf0) + struct.pack('>IB', 1, 1))
+        # The first request never gets an answer
+        while not first:
+            msg_id, payload = await read_message(reader)
+            if msg_id == 6:
+                first.append(struct.unpack('>III', payload))
+        await serve(reader, writer, sent, until=3)
+
+    sent, pm, storage, conn = download(peer)
+    assert pm.is_complete() and bytes(storage.data) == DATA
+    assert (8, struct.pack('>III', *first[0])) in sent
+    assert (6, struct.pack('>III', *first[0])) in sent
+    assert not conn.snubbed
+
+def test_fast_extension_and_extended_handshake():
+    def msg(msg_id, payload=b''):
+        return struct.pack('>IB', 1 + len(payload), msg_id) + payload
+
+    async def peer(reader, writer, sent):
+        writer.write(msg(20, b'\x00' + encode({b'reqq': 2, b'v': b'test 1.0'})) + msg(14)
+                     + msg(17, struct.pack('>I', 1)) + msg(6, struct.pack('>III', 0, 0, 2 ** 14)))
+        # Still choked: only the allowed-fast piece, and no more than reqq at once
+        requests = []
+        while len(requests) < 2:
+            msg_id, payload = await read_message(reader)
+            sent.append((msg_id, payload))
+            if msg_id == 6:
+                requests.append(struct.unpack('>III', payload))
+        writer.write(block(*requests[0]) + msg(16, struct.pack('>III', *requests[1])) + msg(1))
+        await serve(reader, writer, sent, until=3)
+
+    sent, pm, storage, conn = download(peer, RESERVED)
+    assert pm.is_complete() and bytes(storage.data) == DATA
+    handshake = sent[0][1]
+    assert handshake[20:28] == RESERVED and handshake[48:] == PEER_ID
+    assert conn.fast and conn.extended and conn.request_limit == 2 and conn.client == 'test 1.0'
+    messages = [m for m in sent[1:] if m[0] != 6]
+    # Have-none before the extended handshake: the have state must come first
+    assert messages[0] == (15, b'')
+    assert messages[1][0] == 20 and decode(bytes(messages[1][1][1:]))[b'reqq'] == connection.MAX_UPLOAD_QUEUE
+    assert (16, struct.pack('>III', 0, 0, 2 ** 14)) in messages
+    requests = [struct.unpack('>III', p) for m, p in sent if m == 6]
+    assert [r[0] for r in requests[:2]] == [1, 1]
+    # The rejected block was asked for again once unchoked
+    assert requests.count(requests[1]) == 2
+
+def test_endgame_duplicates_are_capped_and_counted():
+    # Every block of pieces 0-3 is out with a slower peer
+    pm = PieceManager(METADATA)
+    slow = PeerConnection(('10.0.0.1', 1), METADATA, pm, MemoryStorage(METADATA), None)
+    slow.available = Bitfield.full(pm.num_pieces)
+    slow.choked = False
+    slow.queue_depth = connection.MAX_REQUESTS
+    slow._fill_pipeline()
+    assert len(slow.pending) == len(DATA) // 2 ** 14 and pm.in_endgame()
+
+    fast = PeerConnection(('10.0.0.2', 1), METADATA, pm, MemoryStorage(METADATA), None)
+    fast.available = Bitfield.full(pm.num_pieces)
+    fast.choked = False
+    fast.queue_depth = connection.MAX_REQUESTS
+    fast._fill_pipeline()
+    assert len(fast.pending) == connection.ENDGAME_PER_PEER
+
+    # The fast peer wins; the slow peer's copy arrives after the cancel
+    index, begin = next(iter(fast.pending))
+    start = index * PIECE_LENGTH + begin
+    fast._on_block(index, begin, DATA[start:start + 2 ** 14])
+    assert (index, begin) not in slow.pending
+    slow._on_block(index, begin, DATA[start:start + 2 ** 14])
+    assert pm.duplicate_bytes == 2 ** 14
+
+def test_wrong_length_block_goes_back_to_the_pool():
+    pm = PieceManager(METADATA)
+    conn = PeerConnection(('10.0.0.1', 1), METADATA, pm, MemoryStorage(METADATA), None)
+    conn.available = Bitfield.full(pm.num_pieces)
+    conn.choked = False
+    conn.queue_depth = 1
+    conn._fill_pipeline()
+    index, begin = next(iter(conn.pending))
+    conn._on_block(index, begin, b'x' * 100)
+    download = pm.downloads[index]
+    assert not conn.pending and begin not in download.requesters
+    # Queued to be asked for again rather than waiting on a timeout
+    assert begin in download.retry
@@ -0,0 +1,112 @@
+# File: test/test_engine.py
+# -----------------------------
+import asyncio
+import socket
+import struct
+import time
+from aiohttp import web
+from conftest import start_tracker
+from session.engine import SessionEngine
+from utils.bencode_utils import encode
+
+def on_engine(engine, coro):
+    return asyncio.run_coroutine_threadsafe(coro, engine.loop).result(5)
+
+def flush(engine):
+    # Commands run on the engine loop in order; wait for those sent so far
+    on_engine(engine, asyncio.sleep(0))
+
+def wait_for_state(engine, torrent_id, state):
+    flush(engine)
+    deadline = time.monotonic() + 5
+    while engine.torrents[torrent_id].state != state:
+        assert time.monotonic() < deadline, engine.torrents[torrent_id].state
+        time.sleep(0.01)
+
+def wait_for_update(updates):
+    count = len(updates)
+    deadline = time.monotonic() + 5
+    while len(updates) == count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def one_peer(peer_port, announces):
+    # Tracker handler handing out one peer that accepts connections and never answers
+    async def announce(request):
+        announces.append(request.query.get('event'))
+        peers = socket.inet_aton('127.0.0.1') + struct.pack('>H', peer_port)
+        return web.Response(body=encode({b'interval': 1800, b'peers': peers}))
+    return announce
+
+def test_add_pause_stop_resume_and_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    silent = socket.socket()
+    silent.bind(('127.0.0.1', 0))
+    silent.listen()
+    updates = []
+    engine = SessionEngine(on_update=updates.append, on_log=lambda msg: None)
+    engine.start()
+    try:
+        announces = []
+        runner, url = on_engine(engine, start_tracker(one_peer(silent.getsockname()[1], announces)))
+        info = {b'name': b'data.bin', b'piece length': 2 ** 14, b'length': 3 * 2 ** 14,
+                b'pieces': bytes(60)}
+        (tmp_path / 'a.torrent').write_bytes(encode({b'announce': url, b'info': info}))
+        torrent_id = engine.add(str(tmp_path / 'a.torrent'))
+        wait_for_state(engine, torrent_id, 'downloading')
+
+        engine.pause(torrent_id)
+        wait_for_state(engine, torrent_id, 'paused')
+        engine.resume(torrent_id)
+        wait_for_state(engine, torrent_id, 'downloading')
+
+        deadline = time.monotonic() + 5
+        while not updates or torrent_id not in updates[-1]:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        snapshot = updates[-1][torrent_id]
+        assert snapshot['name'] == 'data.bin' and snapshot['size'] == 3 * 2 ** 14
+        assert snapshot['progress'] == 0.0 and snapshot['peers'] == 1
+
+        # Some traffic for the rate sample, then resuming a stopped torrent starts it again
+        engine.torrents[torrent_id].piece_manager.downloaded = 10 ** 6
+        wait_for_update(updates)
+        engine.stop(torrent_id)
+        wait_for_state(engine, torrent_id, 'stopped')
+        engine.resume(torrent_id)
+        wait_for_state(engine, torrent_id, 'downloading')
+        # The new run's counters start from zero without a negative speed
+        wait_for_update(updates)
+        assert all(update[torrent_id]['download_rate'] >= 0 for update in updates)
+        # Also when resumed before the stopped task has wound down
+        engine.stop(torrent_id)
+        engine.resume(torrent_id)
+        deadline = time.monotonic() + 5
+        while announces.count('started') < 3:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        wait_for_state(engine, torrent_id, 'downloading')
+        engine.stop(torrent_id)
+        wait_for_state(engine, torrent_id, 'stopped')
+        assert announces.count('started') == 3 and announces.count('stopped') == 3
+        on_engine(engine, runner.cleanup())
+    finally:
+        engine.shutdown()
+        silent.close()
+
+def test_torrent_limits_sit_under_the_engine_limits(tmp_path):
+    engine = SessionEngine(download_limit=100000, on_log=lambda msg: None)
+    engine.start()
+    try:
+        torrent_id = engine.add(str(tmp_path / 'missing.torrent'))
+        engine.set_torrent_limits(torrent_id, 20000, 5000)
+        engine.set_torrent_limits(torrent_id + 1, 1, 1)   # unknown ids are ignored
+        flush(engine)
+        limits = engine.torrents[torrent_id].limits
+        assert (limits.download.rate, limits.upload.rate) == (20000, 5000)
+        assert limits.download.parent is engine.limits.download
+        engine.set_torrent_limits(torrent_id, 0, 0)
+        flush(engine)
+        assert limits.download.limited() and not limits.upload.limited()
+    finally:
+        engine.shutdown()
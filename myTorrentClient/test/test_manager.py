@@ -0,0 +1,166 @@
+# File: test/test_manager.py
+# -----------------------------
+import time
+from pieces import manager
+from pieces.bitfield import Bitfield
+from pieces.manager import PieceManager, COMPLETE, FAILED, STREAM_DEADLINE
+
+def make_manager(count, piece_length=16, last=16):
+    return PieceManager({
+        'pieces': bytes(20 * count),
+        'piece_length': piece_length,
+        'length': piece_length * (count - 1) + last,
+    })
+
+def bits(count, *indices):
+    field = Bitfield(count)
+    for index in indices:
+        field.add(index)
+    return field
+
+def test_rarest_first():
+    pm = make_manager(5)
+    pm.add_peer(bits(5, 0, 1, 2, 3))
+    pm.add_peer(bits(5, 0, 1, 3))
+    pm.add_peer(bits(5, 0, 3))
+    assert list(pm.availability) == [3, 2, 1, 3, 0]
+    assert pm.pick({0, 1, 2, 3}) == 2
+    assert pm.pick({0, 1, 2, 3}) == 1
+    assert pm.pick({1, 2}) is None
+
+def test_random_tie_break():
+    picks = set()
+    for _ in range(50):
+        pm = make_manager(9)
+        pm.add_peer(bits(9, *range(8)))
+        picks.add(pm.pick(set(range(8))))
+    assert len(picks) > 1
+
+def test_failed_piece_returns_to_pool():
+    pm = make_manager(2)
+    pm.add_peer(Bitfield.full(2))
+    first = pm.pick({0, 1})
+    second = pm.pick({0, 1})
+    assert pm.pick({0, 1}) is None
+    pm.mark_failed(first)
+    assert pm.state[first] == FAILED
+    assert pm.pick({0, 1}) == first
+    pm.mark_complete(first)
+    pm.mark_complete(second)
+    assert pm.state[first] == COMPLETE
+    assert pm.is_complete()
+
+def test_release_and_remove_peer():
+    pm = make_manager(3)
+    partial = bits(3, 0, 2)
+    assert not pm.add_peer(partial)
+    assert pm.add_peer(Bitfield.full(3))
+    pm.add_have(1)
+    partial.add(1)
+    assert list(pm.availability) == [1, 1, 1] and pm.seeds == 1
+    index = pm.pick({0, 1, 2})
+    pm.release(index)
+    pm.remove_peer(partial)
+    assert list(pm.availability) == [0, 0, 0] and pm.seeds == 1
+    pm.remove_peer(Bitfield.full(3), seed=True)
+    assert list(pm.availability) == [0, 0, 0] and pm.seeds == 0
+    assert pm.pick({index}) == index
+
+def test_piece_size():
+    pm = make_manager(3, piece_length=16, last=5)
+    assert pm.piece_size(0) == 16
+    assert pm.piece_size(2) == 5
+
+class Owner:
+    def __init__(self):
+        self.pieces = {}
+
+def test_endgame_requests_outstanding_blocks():
+    pm = make_manager(2, piece_length=2 ** 15, last=100)
+    pm.add_peer(Bitfield.full(2))
+    first, second = Owner(), Owner()
+    index = pm.pick({0, 1})
+    download = first.pieces[index] = pm.start_download(index, first)
+    assert not pm.in_endgame()
+    other = pm.pick({0, 1})
+    second.pieces[other] = pm.start_download(other, second)
+    while download.next_block(first):
+        pass
+    assert not pm.in_endgame()
+    while second.pieces[other].next_block(second):
+        pass
+    assert pm.in_endgame()
+
+    found = pm.endgame_block({index}, pending=set())
+    assert found[0] is download and found[1] in (0, 2 ** 14)
+    assert pm.endgame_block({index}, pending={(index, 0), (index, 2 ** 14)}) is None
+
+    assert download.write(0, bytes(2 ** 14))
+    assert not download.write(0, bytes(2 ** 14))
+    pm.finish_download(index)
+    assert index not in first.pieces and index not in pm.downloads
+
+def test_streaming_window_slides_and_races_late_blocks(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(manager.time, 'monotonic', lambda: clock[0])
+    pm = make_manager(10, piece_length=2 ** 15)
+    pm.add_peer(Bitfield.full(10))
+    pm.add_peer(bits(10, 9))
+    pm.set_window(3, 2)
+    assert pm.pick(set(range(10))) == 3
+    assert pm.pick(set(range(10))) == 4
+    # Window exhausted: back to rarest-first, which excludes piece 9
+    assert pm.pick(set(range(9))) not in (3, 4, 9)
+
+    owner = Owner()
+    download = owner.pieces[3] = pm.start_download(3, owner)
+    download.next_block(owner)
+    assert pm.late_block({3}, pending=set()) is None
+    clock[0] += STREAM_DEADLINE + 1
+    assert pm.late_block({3}, pending=set()) == (download, 0, 2 ** 14)
+    assert pm.late_block({3}, pending={(3, 0)}) is None
+    download.requesters[0].add(Owner())
+    assert pm.late_block({3}, pending=set()) is None
+
+    pm.mark_complete(4)
+    assert pm.window == (3, 5)
+    pm.mark_complete(3)
+    assert pm.window == (5, 7)
+
+def test_dropped_blocks_are_requeued_and_pieces_adopted():
+    pm = make_manager(2, piece_length=3 * 2 ** 14, last=3 * 2 ** 14)
+    choked, other = Owner(), Owner()
+    index = pm.pick({0, 1})
+    download = choked.pieces[index] = pm.start_download(index, choked)
+    assert [download.next_block(choked) for _ in range(3)] == [(0, 2 ** 14), (2 ** 14, 2 ** 14), (2 ** 15, 2 ** 14)]
+    assert download.write(0, bytes(2 ** 14))
+    del download.requesters[0]
+    # Choked with two blocks outstanding: both go back, lowest first
+    download.drop(choked, 2 ** 15)
+    download.drop(choked, 2 ** 14)
+    assert not pm.in_endgame()
+    pm.abandon(index)
+    assert download.owner is None and pm.state[index] != COMPLETE
+    assert pm.adopt({1 - index}, other) is None
+    assert pm.adopt({index}, other) is download and download.owner is other
+    assert download.next_block(other) == (2 ** 14, 2 ** 14)
+    # A late reply from the choked peer fills the last block before it is asked for again
+    assert download.write(2 ** 15, bytes(2 ** 14))
+    assert download.next_block(other) is None
+
+    # Nothing received and nothing outstanding: the piece simply goes back to the picker
+    second = pm.pick({0, 1})
+    pm.start_download(second, choked)
+    pm.abandon(second)
+    assert second not in pm.downloads and pm.pick({second}) == second
+
+def test_picking_stays_linear_in_the_number_of_pieces():
+    # Every pick used to rescan the pieces already taken from the front of
+    # the order, so picking all of a large torrent was quadratic
+    pm = make_manager(100000)
+    pm.add_peer(Bitfield.full(100000))
+    peer = Bitfield.full(100000)
+    started = time.perf_counter()
+    picks = [pm.pick(peer) for _ in range(30000)]
+    assert time.perf_counter() - started < 2.0
+    assert len(set(picks)) == 30000
@@ -0,0 +1,43 @@
+# File: test/test_metrics.py
+# -----------------------------
+import asyncio
+import aiohttp
+import pytest
+from utils.metrics import Registry, serve
+
+def test_histogram_quantiles_and_snapshot():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'test', buckets=(0.01, 0.1, 1))
+    for value in (0.005, 0.005, 0.05, 0.5, 5):
+        latency.observe(value)
+    registry.counter('bytes_total').inc(10)
+    snap = registry.snapshot()
+    assert snap['bytes_total'] == 10
+    assert snap['latency_seconds']['count'] == 5
+    assert snap['latency_seconds']['p50'] == 0.1
+    assert snap['latency_seconds']['p99'] == float('inf')
+    assert registry.histogram('latency_seconds') is latency
+    with pytest.raises(ValueError):
+        registry.counter('latency_seconds')
+
+def test_prometheus_endpoint():
+    registry = Registry()
+    registry.counter('blocks_total', 'Blocks received').inc(3)
+    registry.histogram('wait_seconds', buckets=(1, 2)).observe(1.5)
+
+    async def run():
+        runner = await serve(0, registry=registry)
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as resp:
+                    return await resp.text()
+        finally:
+            await runner.cleanup()
+
+    text = asyncio.run(run())
+    assert '# TYPE blocks_total counter\nblocks_total 3' in text
+    assert 'wait_seconds_bucket{le="1"} 0' in text
+    assert 'wait_seconds_bucket{le="2"} 1' in text
+    assert 'wait_seconds_bucket{le="+Inf"} 1' in text
+    assert 'wait_seconds_count 1' in text
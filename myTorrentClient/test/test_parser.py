@@ -1,10 +1,53 @@
 # File: test/test_parser.py
 # -----------------------------
+import hashlib
 import os
-from torrent_parser.parser import TorrentParser
+import pytest
+from pieces.storage import Storage
+from torrent_parser.parser import TorrentParser, TorrentError
+from utils.bencode_utils import encode
 
-def test_parser():
-    # Ensure sample.torrent exists in project root
-    path = os.path.join(os.path.dirname(__file__), '..', 'sample.torrent')
-    md = TorrentParser(path).parse()
+def test_parser(tmp_path):
+    info = {b'name': b'sample.bin', b'piece length': 2 ** 14, b'length': 40000,
+            b'pieces': hashlib.sha1(b'a').digest() * 3}
+    path = tmp_path / 'sample.torrent'
+    path.write_bytes(encode({b'announce': b'http://127.0.0.1/announce', b'info': info}))
+    md = TorrentParser(str(path)).parse()
     assert 'announce' in md and 'info_hash' in md and 'pieces' in md
+    assert md['info_hash'] == hashlib.sha1(encode(info)).digest()
+    assert md['length'] == 40000 and md['name'] == 'sample.bin'
+    assert md['url_list'] == []
+
+def test_parser_url_list(tmp_path):
+    info = {b'name': b'd', b'piece length': 2 ** 14,
+            b'files': [{b'path': [b'a b', b'c'], b'length': 10}], b'pieces': bytes(20)}
+    path = tmp_path / 'web.torrent'
+    for url_list, expected in ((b'http://h/x/', ['http://h/x/']),
+                               ([b'http://h/1', b'', b'http://h/2'], ['http://h/1', 'http://h/2'])):
+        path.write_bytes(encode({b'announce': b'', b'url-list': url_list, b'info': info}))
+        assert TorrentParser(str(path)).parse()['url_list'] == expected
+
+def test_parser_refuses_paths_outside_the_download_dir(tmp_path):
+    path = tmp_path / 'evil.torrent'
+    good = {b'path': [b'a', b'./b'], b'length': 1}
+    cases = [(b'/tmp/evil', good), (b'..', good), (b'C:evil', good),
+             (b'd', {b'path': [b'../../../x'], b'length': 1}),
+             (b'd', {b'path': [b'ok', b'/etc/passwd'], b'length': 1}),
+             (b'd', {b'path': [b'', b'.'], b'length': 1})]
+    for name, entry in cases:
+        info = {b'name': name, b'piece length': 2 ** 14, b'files': [entry], b'pieces': bytes(20)}
+        path.write_bytes(encode({b'announce': b'', b'info': info}))
+        with pytest.raises(TorrentError):
+            TorrentParser(str(path)).parse()
+    # Separators inside a component are split rather than trusted
+    info = {b'name': b'd/e', b'piece length': 2 ** 14, b'files': [good], b'pieces': bytes(20)}
+    path.write_bytes(encode({b'announce': b'', b'info': info}))
+    md = TorrentParser(str(path)).parse()
+    assert md['name'] == os.path.join('d', 'e')
+    assert md['files'] == [(os.path.join('d', 'e', 'a', 'b'), 1)]
+
+def test_storage_refuses_paths_outside_base_dir(tmp_path):
+    metadata = {'piece_length': 4, 'files': [(os.path.join('..', 'x'), 4)]}
+    with pytest.raises(ValueError):
+        Storage(metadata, base_dir=str(tmp_path / 'out'))
+    assert not (tmp_path / 'x').exists()
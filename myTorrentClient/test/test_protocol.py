@@ -0,0 +1,99 @@
+# File: test/test_protocol.py
+# -----------------------------
+import struct
+import pytest
+from peer.protocol import (MessageBatch, MessageDecoder, ProtocolError, handshake, parse_piece,
+                           supports_fast, supports_extensions, PEER_ID, RESERVED)
+
+def build_stream():
+    batch = MessageBatch()
+    batch.keepalive()
+    batch.unchoke()
+    batch.have(7)
+    batch.bitfield(b'\xff\x80')
+    batch.keepalive()
+    batch.request(1, 2 ** 14, 2 ** 14)
+    batch.piece_header(3, 0, 5)
+    batch.buffer += b'hello'
+    batch.extended(0, b'd1:vi1ee')
+    return bytes(batch.buffer)
+
+EXPECTED = [
+    (1, b''),
+    (4, struct.pack('>I', 7)),
+    (5, b'\xff\x80'),
+    (6, struct.pack('>III', 1, 2 ** 14, 2 ** 14)),
+    (7, struct.pack('>II', 3, 0) + b'hello'),
+    (20, b'\x00d1:vi1ee'),
+]
+
+def decode_chunks(chunks, max_length=2 ** 20):
+    decoder = MessageDecoder(max_length)
+    messages = []
+    for chunk in chunks:
+        # Payloads are only valid during the call, so copy them
+        decoder.feed(chunk, lambda msg_id, payload: messages.append((msg_id, bytes(payload))))
+    assert not decoder.buffer
+    return messages
+
+def test_whole_stream_and_keepalives():
+    assert decode_chunks([build_stream()]) == EXPECTED
+
+def test_split_at_every_offset():
+    stream = build_stream()
+    for split in range(len(stream) + 1):
+        assert decode_chunks([stream[:split], stream[split:]]) == EXPECTED, split
+    for split in range(1, len(stream) - 1):
+        chunks = [stream[:split], stream[split:split + 3], stream[split + 3:]]
+        assert decode_chunks(chunks) == EXPECTED, split
+
+def test_byte_at_a_time():
+    stream = build_stream()
+    assert decode_chunks([stream[i:i + 1] for i in range(len(stream))]) == EXPECTED
+
+def test_oversized_message_is_rejected():
+    header = struct.pack('>IB', 101, 7)
+    with pytest.raises(ProtocolError):
+        decode_chunks([header + bytes(100)], max_length=100)
+    # Also when the length prefix arrives in pieces
+    with pytest.raises(ProtocolError):
+        decode_chunks([header[:2], header[2:]], max_length=100)
+    assert decode_chunks([struct.pack('>IB', 100, 7) + bytes(99)], max_length=100) == [(7, bytes(99))]
+
+def test_batch_bytes():
+    batch = MessageBatch()
+    batch.choke()
+    batch.interested()
+    batch.not_interested()
+    batch.have_all()
+    batch.have_none()
+    batch.cancel(1, 2, 3)
+    batch.reject(4, 5, 6)
+    assert bytes(batch.buffer) == (
+        b'\x00\x00\x00\x01\x00' b'\x00\x00\x00\x01\x02' b'\x00\x00\x00\x01\x03'
+        b'\x00\x00\x00\x01\x0e' b'\x00\x00\x00\x01\x0f'
+        b'\x00\x00\x00\x0d\x08\x00\x00\x00\x01\x00\x00\x00\x02\x00\x00\x00\x03'
+        b'\x00\x00\x00\x0d\x10\x00\x00\x00\x04\x00\x00\x00\x05\x00\x00\x00\x06')
+    assert build_stream()[:18] == (b'\x00\x00\x00\x00' b'\x00\x00\x00\x01\x01'
+                                   b'\x00\x00\x00\x05\x04\x00\x00\x00\x07')
+
+    class Writer:
+        def __init__(self):
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(data)
+
+    writer = Writer()
+    batch.flush(writer)
+    batch.flush(writer)
+    assert len(writer.writes) == 1 and len(batch) == 0
+
+def test_handshake_and_piece():
+    msg = handshake(b'i' * 20)
+    assert msg == b'\x13BitTorrent protocol' + RESERVED + b'i' * 20 + PEER_ID
+    assert len(msg) == 68 and len(PEER_ID) == 20
+    assert supports_fast(RESERVED) and supports_extensions(RESERVED)
+    assert not supports_fast(bytes(8)) and not supports_extensions(bytes(8))
+    index, begin, block = parse_piece(memoryview(struct.pack('>II', 3, 16) + b'abc'))
+    assert (index, begin, bytes(block)) == (3, 16, b'abc')
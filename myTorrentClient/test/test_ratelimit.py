@@ -0,0 +1,39 @@
+# File: test/test_ratelimit.py
+# -----------------------------
+from utils import ratelimit
+from utils.ratelimit import TokenBucket, TransferLimits
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    bucket = TokenBucket(rate=100000)
+    bucket.tokens = 0
+    # Back-to-back callers queue behind each other's debt
+    assert bucket.charge(50000) == 0.5
+    assert bucket.charge(50000) == 1.0
+    clock.now += 1.0
+    assert bucket.charge(10000) == 0.1
+    # Unused time refills only up to the burst size
+    clock.now += 60
+    assert bucket.charge(int(bucket.burst)) == 0
+
+def test_hierarchy_and_runtime_change(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    global_limits = TransferLimits(download_rate=100000)
+    torrent = TransferLimits(download_rate=50000, parent=global_limits)
+    global_limits.download.tokens = torrent.download.tokens = 0
+    assert torrent.download.limited() and not torrent.upload.limited()
+    assert torrent.download.charge(10000) == 0.2
+    assert global_limits.download.tokens == -10000
+    global_limits.set_rates(0, 0)
+    torrent.download.set_rate(0)
+    assert not torrent.download.limited()
+    assert torrent.download.charge(10 ** 9) == 0
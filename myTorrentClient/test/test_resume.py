@@ -0,0 +1,62 @@
+# File: test/test_resume.py
+# -----------------------------
+import asyncio
+import os
+from conftest import make_metadata
+from pieces.manager import PieceManager, COMPLETE, MISSING
+from pieces.resume import FastResume
+from pieces.storage import Storage
+from pieces.verifier import PieceVerifier
+
+PIECE_LENGTH = 16
+
+def make_torrent(tmp_path, data):
+    metadata = make_metadata(data, PIECE_LENGTH, bytes(20), name='t',
+                             files=[('a', 20), ('b', len(data) - 20)])
+    storage = Storage(metadata, base_dir=str(tmp_path))
+    return metadata, storage, PieceManager(metadata)
+
+def test_bitfield_round_trip():
+    metadata = {'pieces': bytes(20 * 11), 'piece_length': 1, 'length': 11}
+    pm = PieceManager(metadata)
+    for index in (0, 3, 8, 10):
+        pm.mark_complete(index)
+    bits = pm.completed_bitfield()
+    assert bits == bytes([0b10010000, 0b10100000])
+    other = PieceManager(metadata)
+    other.load_bitfield(bits)
+    assert other.state == pm.state and other.completed == 4
+
+def test_save_load_and_stale(tmp_path):
+    data = os.urandom(50)
+    metadata, storage, pm = make_torrent(tmp_path, data)
+    storage.write_block(1, 0, data[16:32])
+    pm.mark_complete(1)
+    FastResume(metadata, storage, pm).save()
+
+    _, storage2, pm2 = make_torrent(tmp_path, data)
+    assert FastResume(metadata, storage2, pm2).load()
+    assert pm2.state[1] == COMPLETE and pm2.completed == 1
+
+    storage2.write_block(0, 0, data[:16])
+    os.utime(storage2.files[0][0], ns=(0, 0))
+    _, storage3, pm3 = make_torrent(tmp_path, data)
+    assert not FastResume(metadata, storage3, pm3).load()
+    for storage in (storage, storage2, storage3):
+        storage.close()
+
+def test_recheck(tmp_path):
+    data = os.urandom(70)
+    metadata, storage, pm = make_torrent(tmp_path, data)
+    assert storage.fresh
+    storage.write_block(0, 0, data[:32])
+    storage.write_block(4, 0, data[64:])
+
+    async def run():
+        verifier = PieceVerifier(workers=2)
+        await FastResume(metadata, storage, pm).recheck(verifier, chunk_size=40)
+        verifier.close()
+
+    asyncio.run(run())
+    storage.close()
+    assert list(pm.state) == [COMPLETE, COMPLETE, MISSING, MISSING, COMPLETE]
@@ -0,0 +1,77 @@
+# File: test/test_storage.py
+# -----------------------------
+import os
+import threading
+from pieces import storage as storage_module
+from pieces.storage import Storage
+
+def make_storage(tmp_path, files, piece_length=8, max_open=2):
+    metadata = {'piece_length': piece_length, 'files': files}
+    return Storage(metadata, base_dir=str(tmp_path), max_open=max_open)
+
+def test_multi_file_layout(tmp_path):
+    files = [(os.path.join('t', 'a'), 5), (os.path.join('t', 'empty'), 0),
+             (os.path.join('t', 'sub', 'b'), 6), (os.path.join('t', 'c'), 9)]
+    storage = make_storage(tmp_path, files)
+    data = bytes(range(20))
+    storage.write_block(0, 0, data[:8])
+    storage.write_block(1, 0, data[8:16])
+    storage.write_block(2, 0, data[16:])
+    storage.close()
+    assert (tmp_path / 't' / 'a').read_bytes() == data[:5]
+    assert (tmp_path / 't' / 'empty').read_bytes() == b''
+    assert (tmp_path / 't' / 'sub' / 'b').read_bytes() == data[5:11]
+    assert (tmp_path / 't' / 'c').read_bytes() == data[11:]
+
+def test_read_block_across_files(tmp_path):
+    storage = make_storage(tmp_path, [('x', 3), ('y', 3), ('z', 3)], piece_length=4, max_open=1)
+    storage.write_block(0, 1, b'abcdefg')
+    assert storage.read_block(0, 0, 9) == b'\x00abcdefg\x00'
+    assert storage.read_block(1, 0, 4) == b'defg'
+    assert len(storage._handles) == 1
+    storage.close()
+
+def test_existing_data_is_kept(tmp_path):
+    storage = make_storage(tmp_path, [('f', 10)])
+    storage.write_block(0, 0, b'12345678')
+    storage.close()
+    storage = make_storage(tmp_path, [('f', 10)])
+    assert storage.read_block(0, 0, 8) == b'12345678'
+    storage.close()
+
+def test_open_file_borrows_the_cached_descriptor(tmp_path):
+    storage = make_storage(tmp_path, [('f', 10)])
+    storage.write_block(0, 0, b'12345678')
+    fd = storage._handles[os.path.join(str(tmp_path), 'f')]
+    with storage.open_file(os.path.join(str(tmp_path), 'f')) as f:
+        assert f.fileno() == fd
+        f.seek(2)
+        assert f.read(3) == b'345'
+    # Still open and usable after the file object is gone
+    assert storage.read_block(0, 0, 4) == b'1234'
+    assert storage._busy[os.path.join(str(tmp_path), 'f')] == 0
+    storage.close()
+
+def test_seek_fallback_keeps_threads_apart(tmp_path, monkeypatch):
+    # Without os.pwrite every thread seeks the one shared descriptor
+    monkeypatch.setattr(storage_module, '_pwrite', storage_module._seek_pwrite)
+    monkeypatch.setattr(storage_module, '_pread', storage_module._seek_pread)
+    storage = make_storage(tmp_path, [('f', 64 * 512)], piece_length=512)
+
+    errors = []
+
+    def work(first):
+        for _ in range(20):
+            for index in range(first, 64, 4):
+                storage.write_block(index, 0, bytes([index]) * 512)
+                if storage.read_block(index, 0, 512) != bytes([index]) * 512:
+                    errors.append(index)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    storage.close()
+    assert not errors
+    assert (tmp_path / 'f').read_bytes() == b''.join(bytes([i]) * 512 for i in range(64))
@@ -0,0 +1,46 @@
+# File: test/test_stream.py
+# -----------------------------
+import asyncio
+import os
+from pieces.manager import PieceManager
+from pieces.storage import Storage
+from pieces.stream import RangeReader
+
+PIECE_LENGTH = 2 ** 14
+DATA = os.urandom(PIECE_LENGTH * 6 + 10)
+
+def test_range_reads_wait_for_pieces_and_move_the_window(tmp_path):
+    metadata = {'piece_length': PIECE_LENGTH, 'length': len(DATA), 'pieces': bytes(20 * 7),
+                'files': [('a', 5000), ('b', len(DATA) - 5000)]}
+    storage = Storage(metadata, base_dir=str(tmp_path))
+    pm = PieceManager(metadata)
+    reader = RangeReader(storage, pm, window=3 * PIECE_LENGTH)
+
+    def complete(index):
+        start = index * PIECE_LENGTH
+        storage.write_block(index, 0, DATA[start:start + PIECE_LENGTH])
+        pm.mark_complete(index)
+
+    async def run():
+        read = asyncio.ensure_future(reader.read(PIECE_LENGTH + 100, PIECE_LENGTH))
+        await asyncio.sleep(0.01)
+        assert pm.window == (1, 4)
+        complete(1)
+        await asyncio.sleep(0.01)
+        assert not read.done() and pm.window == (2, 5)
+        complete(2)
+        first = await asyncio.wait_for(read, 1)
+        for index in (0, 3, 4, 5, 6):
+            complete(index)
+        chunks = [chunk async for chunk in reader.iter_range(*reader.file_range(1))]
+        tail = await reader.read(len(DATA) - 4, 100)
+        return first, chunks, tail
+
+    first, chunks, tail = asyncio.run(run())
+    reader.close()
+    storage.close()
+    assert first == DATA[PIECE_LENGTH + 100:2 * PIECE_LENGTH + 100]
+    assert b''.join(chunks) == DATA[5000:]
+    assert len(chunks) == 7
+    assert tail == DATA[-4:]
+    assert pm.window is None and reader._on_complete not in pm.listeners
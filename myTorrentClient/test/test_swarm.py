@@ -0,0 +1,117 @@
+# File: test/test_swarm.py
+# -----------------------------
+import asyncio
+import os
+import socket
+import struct
+import time
+from conftest import MemoryStorage, make_metadata
+from peer import connection
+from peer import swarm as swarm_module
+from peer.swarm import SwarmManager
+from pieces.manager import PieceManager
+from pieces.verifier import PieceVerifier
+
+PIECE_LENGTH = 2 ** 15
+DATA = os.urandom(PIECE_LENGTH * 6 + 100)
+METADATA = make_metadata(DATA, PIECE_LENGTH, b'i' * 20)
+
+async def seed(reader, writer, data=DATA):
+    try:
+        await reader.readexactly(68)
+        writer.write(bytes([19]) + b'BitTorrent protocol' + bytes(8) + b'i' * 20 + b's' * 20)
+        writer.write(struct.pack('>IBB', 2, 5, 0xfe) + struct.pack('>IB', 1, 1))
+        while True:
+            size = struct.unpack('>I', await reader.readexactly(4))[0]
+            msg = await reader.readexactly(size)
+            if msg[0] == 6:
+                index, begin, length = struct.unpack_from('>III', msg, 1)
+                start = index * PIECE_LENGTH + begin
+                writer.write(struct.pack('>IBII', 9 + length, 7, index, begin) + data[start:start + length])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def test_bounded_download_with_dead_peers():
+    async def run():
+        server = await asyncio.start_server(seed, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        pm = PieceManager(METADATA)
+        storage = MemoryStorage(METADATA)
+        verifier = PieceVerifier(workers=2)
+        swarm = SwarmManager(METADATA, pm, storage, verifier, max_connections=1, connect_timeout=1)
+        dead = ('127.0.0.1', closed_port())
+        swarm.add_peers([dead, ('127.0.0.1', port), dead])
+        started = time.monotonic()
+        await asyncio.wait_for(swarm.run(), 10)
+        elapsed = time.monotonic() - started
+        server.close()
+        verifier.close()
+        return pm, storage, swarm, dead, elapsed
+
+    pm, storage, swarm, dead, elapsed = asyncio.run(run())
+    # The refused connection and the last piece are noticed at once, not on the next TICK
+    assert elapsed < swarm_module.TICK
+    assert pm.is_complete()
+    assert bytes(storage.data) == DATA
+    assert len(swarm.candidates) == 2
+    assert swarm.candidates[dead].failures == 1
+    assert not swarm.active
+
+class SlowFailVerifier(PieceVerifier):
+    # Fails the first check, and only after everything else has arrived
+    def __init__(self):
+        super().__init__(workers=1)
+        self.failed = False
+
+    async def submit(self, piece, expected):
+        if self.failed:
+            return await super().submit(piece, expected)
+        self.failed = True
+
+        async def fail_later():
+            await asyncio.sleep(0.3)
+            return False
+        return asyncio.ensure_future(fail_later())
+
+def test_idle_connection_asks_again_for_a_failed_piece():
+    async def run():
+        server = await asyncio.start_server(seed, '127.0.0.1', 0)
+        pm = PieceManager(METADATA)
+        storage = MemoryStorage(METADATA)
+        verifier = SlowFailVerifier()
+        swarm = SwarmManager(METADATA, pm, storage, verifier)
+        swarm.add_peers([('127.0.0.1', server.sockets[0].getsockname()[1])])
+        await asyncio.wait_for(swarm.run(), 5)
+        server.close()
+        verifier.close()
+        return pm, storage, verifier
+
+    pm, storage, verifier = asyncio.run(run())
+    assert verifier.failed and pm.is_complete() and bytes(storage.data) == DATA
+
+def test_peer_sending_bad_pieces_is_charged_and_dropped():
+    async def run():
+        good = await asyncio.start_server(seed, '127.0.0.1', 0)
+        bad = await asyncio.start_server(lambda r, w: seed(r, w, bytes(b ^ 1 for b in DATA)), '127.0.0.1', 0)
+        pm = PieceManager(METADATA)
+        storage = MemoryStorage(METADATA)
+        verifier = PieceVerifier(workers=1)
+        swarm = SwarmManager(METADATA, pm, storage, verifier)
+        peers = [('127.0.0.1', server.sockets[0].getsockname()[1]) for server in (good, bad)]
+        swarm.add_peers(peers)
+        await asyncio.wait_for(swarm.run(), 5)
+        for server in (good, bad):
+            server.close()
+        verifier.close()
+        return pm, storage, swarm, peers
+
+    pm, storage, swarm, (good, bad) = asyncio.run(run())
+    assert pm.is_complete() and bytes(storage.data) == DATA
+    # The bad peer ranks behind the good one for the next connection
+    assert swarm.candidates[bad].failures >= connection.MAX_HASH_FAILURES
+    assert swarm.candidates[bad].score() > swarm.candidates[good].score()
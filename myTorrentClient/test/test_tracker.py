@@ -0,0 +1,97 @@
+# File: test/test_tracker.py
+# -----------------------------
+import asyncio
+import socket
+import struct
+from utils.bencode_utils import encode
+from aiohttp import web
+from conftest import start_tracker
+from pieces.manager import PieceManager
+from tracker import client
+from tracker.client import TrackerClient
+
+def compact(*ports):
+    return b''.join(socket.inet_aton('10.0.0.1') + struct.pack('>H', p) for p in ports)
+
+def test_tier_announce_merges_peers():
+    queries = []
+
+    async def good(request):
+        queries.append(dict(request.query))
+        body = {b'interval': 900, b'min interval': 120, b'peers': compact(1, 2)}
+        return web.Response(body=encode(body))
+
+    async def other(request):
+        body = {b'interval': 600, b'peers': compact(2, 3)}
+        return web.Response(body=encode(body))
+
+    async def failing(request):
+        return web.Response(body=encode({b'failure reason': b'nope'}))
+
+    async def run():
+        runners = []
+        urls = []
+        for handler in (good, other, failing, good):
+            runner, url = await start_tracker(handler)
+            runners.append(runner)
+            urls.append(url)
+        metadata = {'info_hash': bytes(20), 'announce': urls[0], 'length': 40,
+                    'piece_length': 16, 'pieces': bytes(60),
+                    'announce_list': [[urls[2], urls[0], urls[1]], [urls[3]]]}
+        pm = PieceManager(metadata)
+        pm.mark_complete(2)
+        pm.downloaded = 8
+        tracker = TrackerClient(metadata, pm)
+        try:
+            peers = await tracker.get_peers()
+            tier = list(tracker.tiers[0])
+        finally:
+            await tracker.close()
+            for runner in runners:
+                await runner.cleanup()
+        return peers, tracker, tier, urls
+
+    peers, tracker, tier, urls = asyncio.run(run())
+    assert sorted(peers) == [('10.0.0.1', 1), ('10.0.0.1', 2), ('10.0.0.1', 3)]
+    assert tracker.interval == 600 and tracker.min_interval == 120
+    assert tier[-1] == urls[2]
+    # The second tier is only used when the whole first tier fails
+    assert len(queries) == 1
+    assert queries[0]['left'] == '32' and queries[0]['downloaded'] == '8'
+    assert queries[0]['event'] == 'started'
+
+def test_silent_tracker_does_not_hold_back_the_tier(monkeypatch):
+    monkeypatch.setattr(client, 'ANNOUNCE_TIMEOUT', 0.5)
+    monkeypatch.setattr(client, 'STOP_TIMEOUT', 0.3)
+
+    async def good(request):
+        return web.Response(body=encode({b'interval': 900, b'peers': compact(1)}))
+
+    async def run():
+        runner, url = await start_tracker(good)
+        # A bound UDP socket that never answers
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        udp = 'udp://127.0.0.1:%d/announce' % silent.getsockname()[1]
+        metadata = {'info_hash': bytes(20), 'announce': url, 'length': 16,
+                    'piece_length': 16, 'pieces': bytes(20), 'announce_list': [[udp, url]]}
+        tracker = TrackerClient(metadata)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        seen = []
+        try:
+            peers = await tracker.get_peers(on_peers=lambda p: seen.append((loop.time() - start, p)))
+            took = loop.time() - start
+            start = loop.time()
+            await tracker.close('stopped')
+            closed = loop.time() - start
+        finally:
+            silent.close()
+            await runner.cleanup()
+        return peers, seen, took, closed
+
+    peers, seen, took, closed = asyncio.run(run())
+    assert peers == [('10.0.0.1', 1)]
+    # Peers arrive before the silent tracker's deadline, which bounds the whole announce
+    assert seen[0][1] == [('10.0.0.1', 1)] and seen[0][0] < 0.4
+    assert took < 2 and closed < 1
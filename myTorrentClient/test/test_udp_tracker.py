@@ -0,0 +1,87 @@
+# File: test/test_udp_tracker.py
+# -----------------------------
+import asyncio
+import socket
+import struct
+import pytest
+from tracker import udp
+from tracker.udp import UDPTrackerClient, UDPTrackerError, PROTOCOL_ID
+
+class FakeTracker(asyncio.DatagramProtocol):
+    def __init__(self, drop=0, error=None):
+        self.drop = drop          # number of datagrams to ignore first
+        self.error = error
+        self.connects = 0
+        self.announces = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.drop:
+            self.drop -= 1
+            return
+        connection_id, action, tid = struct.unpack_from('>QII', data)
+        if self.error:
+            reply = struct.pack('>II', 3, tid) + self.error
+        elif action == 0:
+            assert connection_id == PROTOCOL_ID
+            self.connects += 1
+            reply = struct.pack('>IIQ', 0, tid, 1234)
+        elif action == 1:
+            assert connection_id == 1234
+            self.announces.append(struct.unpack_from('>20s20sQQQIIIiH', data, 16))
+            peers = socket.inet_aton('10.0.0.1') + struct.pack('>H', 6881)
+            peers += socket.inet_aton('10.0.0.2') + struct.pack('>H', 51413)
+            reply = struct.pack('>IIIII', 1, tid, 1800, 3, 7) + peers
+        else:
+            reply = struct.pack('>IIIII', 2, tid, 5, 10, 2)
+        self.transport.sendto(reply, addr)
+
+def run_against(tracker, coro_factory):
+    async def run():
+        udp._connections.clear()
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: tracker, local_addr=('127.0.0.1', 0))
+        port = transport.get_extra_info('sockname')[1]
+        try:
+            return await coro_factory(UDPTrackerClient(f'udp://127.0.0.1:{port}/announce',
+                                                       timeout=0.05, retries=3))
+        finally:
+            transport.close()
+    return asyncio.run(run())
+
+def test_announce_and_connection_cache():
+    tracker = FakeTracker()
+
+    async def twice(client):
+        first = await client.announce(b'i' * 20, b'p' * 20, 6881, left=100)
+        await client.announce(b'i' * 20, b'p' * 20, 6881, left=50, event='none')
+        return first
+
+    resp = run_against(tracker, twice)
+    assert resp['interval'] == 1800 and resp['leechers'] == 3 and resp['seeders'] == 7
+    assert resp['peers'] == [('10.0.0.1', 6881), ('10.0.0.2', 51413)]
+    assert tracker.connects == 1
+    assert [a[3] for a in tracker.announces] == [100, 50]
+    assert [a[5] for a in tracker.announces] == [2, 0]
+
+def test_retransmit_after_loss():
+    tracker = FakeTracker(drop=2)
+    resp = run_against(tracker, lambda c: c.announce(b'i' * 20, b'p' * 20, 6881))
+    assert len(resp['peers']) == 2
+
+def test_scrape():
+    resp = run_against(FakeTracker(), lambda c: c.scrape([b'i' * 20]))
+    assert resp == [{'seeders': 5, 'completed': 10, 'leechers': 2}]
+
+def test_error_and_timeout():
+    with pytest.raises(UDPTrackerError, match='denied'):
+        run_against(FakeTracker(error=b'denied'), lambda c: c.announce(b'i' * 20, b'p' * 20, 6881))
+    with pytest.raises(UDPTrackerError):
+        run_against(FakeTracker(drop=100), lambda c: c.scrape([b'i' * 20]))
+
+def test_compact_ipv6():
+    from tracker.compact import parse_compact_peers
+    data = socket.inet_pton(socket.AF_INET6, '::1') + struct.pack('>H', 80)
+    assert parse_compact_peers(data, ipv6=True) == [('::1', 80)]
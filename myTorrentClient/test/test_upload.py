@@ -0,0 +1,114 @@
+# File: test/test_upload.py
+# -----------------------------
+import asyncio
+import os
+import struct
+from conftest import make_metadata, read_message
+from peer.connection import PeerConnection
+from peer.swarm import SwarmManager, UPLOAD_SLOTS
+from pieces.cache import PieceCache
+from pieces.manager import PieceManager
+from pieces.storage import Storage
+from pieces.verifier import PieceVerifier
+
+PIECE_LENGTH = 2 ** 15
+DATA = os.urandom(PIECE_LENGTH * 3 + 1000)
+
+def make_torrent(tmp_path):
+    # Two files so that piece 1 straddles a file boundary
+    metadata = make_metadata(DATA, PIECE_LENGTH, b'u' * 20, name='t',
+                             files=[(os.path.join('t', 'a'), PIECE_LENGTH + 100),
+                                    (os.path.join('t', 'b'), len(DATA) - PIECE_LENGTH - 100)])
+    storage = Storage(metadata, base_dir=str(tmp_path))
+    storage.write_block(0, 0, DATA)
+    pm = PieceManager(metadata)
+    for index in range(pm.num_pieces):
+        pm.mark_complete(index)
+    return metadata, storage, pm
+
+async def leecher(reader, writer, requests, received):
+    # Handshake, wait for our bitfield and unchoke, then fetch the blocks
+    await reader.readexactly(68)
+    writer.write(bytes([19]) + b'BitTorrent protocol' + bytes(8) + b'u' * 20 + b'l' * 20)
+    writer.write(struct.pack('>IB', 1, 2))
+    msg_id = None
+    while msg_id != 1:
+        msg_id, payload = await read_message(reader)
+        if msg_id == 5:
+            received['bitfield'] = payload
+    for index, begin, length in requests:
+        writer.write(struct.pack('>IBIII', 13, 6, index, begin, length))
+    for _ in requests:
+        msg_id, payload = await read_message(reader)
+        while msg_id != 7:
+            msg_id, payload = await read_message(reader)
+        index, begin = struct.unpack_from('>II', payload)
+        received[(index, begin)] = payload[8:]
+    writer.close()
+
+def test_serves_blocks_from_cache_disk_and_sendfile(tmp_path):
+    metadata, storage, pm = make_torrent(tmp_path)
+    cache = PieceCache(storage, pm)
+    cache.put(2, DATA[2 * PIECE_LENGTH:3 * PIECE_LENGTH])
+    requests = [(0, 0, 2 ** 14), (1, 0, 2 ** 14), (1, 2 ** 14, 2 ** 14), (2, 100, 2 ** 14), (3, 0, 1000)]
+    received = {}
+
+    async def run():
+        server = await asyncio.start_server(lambda r, w: leecher(r, w, requests, received), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        verifier = PieceVerifier(workers=1)
+        conn = PeerConnection(('127.0.0.1', port), metadata, pm, storage, verifier, cache=cache)
+        task = asyncio.ensure_future(conn.start())
+        while not conn.peer_interested:
+            await asyncio.sleep(0.01)
+        conn.set_choking(False)
+        await asyncio.wait_for(task, 5)
+        server.close()
+        verifier.close()
+        return conn
+
+    conn = asyncio.run(run())
+    storage.close()
+    assert received['bitfield'] == b'\xf0'
+    for index, begin, length in requests:
+        start = index * PIECE_LENGTH + begin
+        assert received[(index, begin)] == DATA[start:start + length]
+    assert conn.uploaded == pm.uploaded == sum(r[2] for r in requests)
+    # Piece 1 crosses into the second file, so it was read whole into the cache
+    assert cache.block(1, 0, 4) is not None
+    assert cache.block(0, 0, 4) is None
+
+def test_cache_evicts_least_recently_used():
+    cache = PieceCache(None, None, max_bytes=10)
+    cache.put(0, b'aaaa')
+    cache.put(1, b'bbbb')
+    assert bytes(cache.block(0, 1, 2)) == b'aa'
+    cache.put(2, b'cccc')
+    assert cache.block(1, 0, 1) is None
+    assert cache.size == 8
+    cache.put(3, b'x' * 11)
+    assert cache.block(3, 0, 1) is None
+
+class FakeConn:
+    def __init__(self, downloaded, interested=True):
+        self.connected = True
+        self.peer_interested = interested
+        self.downloaded = downloaded
+        self.uploaded = 0
+        self.am_choking = True
+        self.available = set()
+
+    def set_choking(self, choking):
+        self.am_choking = choking
+
+def test_choker_unchokes_best_uploaders_and_one_optimistic():
+    metadata = {'info_hash': b'i' * 20, 'piece_length': 4, 'length': 8, 'pieces': b'h' * 40}
+    swarm = SwarmManager(metadata, PieceManager(metadata), None, None)
+    conns = [FakeConn(rate) for rate in (50, 10, 40, 30, 20)] + [FakeConn(100, interested=False)]
+    swarm.active = {object(): conn for conn in conns}
+    swarm._choke()
+    unchoked = [conn for conn in conns if not conn.am_choking]
+    assert len(unchoked) == UPLOAD_SLOTS
+    assert {conns[0], conns[2], conns[3]} <= set(unchoked)
+    assert swarm._optimistic in (conns[1], conns[4])
+    assert conns[5].am_choking
@@ -0,0 +1,23 @@
+# File: test/test_verifier.py
+# -----------------------------
+import asyncio
+import hashlib
+from pieces.verifier import PieceVerifier
+
+def test_verify_and_stats():
+    async def run():
+        verifier = PieceVerifier(workers=2, max_pending=1)
+        piece = bytes(2 ** 20)
+        good = hashlib.sha1(piece).digest()
+        results = await asyncio.gather(verifier.verify(piece, good),
+                                       verifier.verify(piece, bytes(20)),
+                                       verifier.verify(piece, good))
+        await verifier.drain()
+        verifier.close()
+        return verifier, results
+
+    verifier, results = asyncio.run(run())
+    assert results == [True, False, True]
+    assert verifier.pieces == 3 and verifier.failed == 1
+    assert verifier.bytes_hashed == 3 * 2 ** 20
+    assert verifier.throughput() > 0
@@ -0,0 +1,116 @@
+# File: test/test_webseed.py
+# -----------------------------
+import asyncio
+import os
+import time
+from aiohttp import web
+from conftest import make_metadata, start_app
+from peer import webseed
+from peer.swarm import SwarmManager
+from peer.webseed import WebSeed, file_urls
+from pieces.manager import PieceManager, MISSING
+from pieces.storage import Storage
+from pieces.verifier import PieceVerifier
+from utils.ratelimit import TransferLimits
+
+PIECE_LENGTH = 2 ** 15
+SIZES = (PIECE_LENGTH + 1000, 3 * PIECE_LENGTH, 500)
+DATA = os.urandom(sum(SIZES))
+FILES = [(os.path.join('d', 'a b'), SIZES[0]), (os.path.join('d', 'c'), SIZES[1]),
+         (os.path.join('d', 'e'), SIZES[2])]
+METADATA = make_metadata(DATA, PIECE_LENGTH, b'w' * 20, name='d', files=FILES)
+
+def test_file_urls():
+    assert file_urls('http://h/f.iso', [('f.iso', 1)]) == ['http://h/f.iso']
+    assert file_urls('http://h/pub/', [('f.iso', 1)]) == ['http://h/pub/f.iso']
+    assert file_urls('http://h/pub', FILES[:2]) == ['http://h/pub/d/a%20b', 'http://h/pub/d/c']
+
+async def http_server(root, ranges):
+    @web.middleware
+    async def record(request, handler):
+        ranges.append(request.headers.get('Range'))
+        return await handler(request)
+
+    app = web.Application(middlewares=[record])
+    app.router.add_static('/files/', str(root))
+    runner, port = await start_app(app)
+    return runner, f'http://127.0.0.1:{port}/files/'
+
+def serve_files(root):
+    offset = 0
+    for path, size in FILES:
+        os.makedirs(root / os.path.dirname(path), exist_ok=True)
+        (root / path).write_bytes(DATA[offset:offset + size])
+        offset += size
+
+def test_swarm_downloads_from_web_seed_alone(tmp_path, monkeypatch):
+    # Runs of two pieces, so ranges start and end inside files
+    monkeypatch.setattr(webseed, 'WEBSEED_RUN', 2 * PIECE_LENGTH)
+    served = tmp_path / 'www'
+    serve_files(served)
+    ranges = []
+
+    async def run():
+        runner, url = await http_server(served, ranges)
+        pm = PieceManager(METADATA)
+        storage = Storage(METADATA, base_dir=str(tmp_path / 'out'))
+        verifier = PieceVerifier(workers=1)
+        swarm = SwarmManager(METADATA, pm, storage, verifier, web_seeds=[url])
+        await asyncio.wait_for(swarm.run(), 10)
+        await verifier.drain()
+        verifier.close()
+        storage.close()
+        await runner.cleanup()
+        return pm, swarm
+
+    pm, swarm = asyncio.run(run())
+    assert pm.is_complete()
+    out = b''.join((tmp_path / 'out' / path).read_bytes() for path, _ in FILES)
+    assert out == DATA
+    assert swarm.web_seeds[0].downloaded == len(DATA) == pm.downloaded
+    assert ranges and all(r and r.startswith('bytes=') for r in ranges)
+    assert pm.seeds == 0
+
+def test_web_seed_is_rate_limited(tmp_path):
+    served = tmp_path / 'www'
+    serve_files(served)
+    limits = TransferLimits()
+    rate = len(DATA)
+    limits.download.set_rate(rate)
+
+    async def run():
+        runner, url = await http_server(served, [])
+        pm = PieceManager(METADATA)
+        storage = Storage(METADATA, base_dir=str(tmp_path / 'out'))
+        verifier = PieceVerifier(workers=1)
+        seed = WebSeed(url, METADATA, pm, storage, verifier, limits=limits)
+        started = time.monotonic()
+        await asyncio.wait_for(seed.run(), 10)
+        elapsed = time.monotonic() - started
+        await verifier.drain()
+        verifier.close()
+        storage.close()
+        await runner.cleanup()
+        return pm, elapsed
+
+    pm, elapsed = asyncio.run(run())
+    assert pm.is_complete()
+    # Everything past the bucket's burst is paid for at the set rate
+    assert elapsed >= (len(DATA) - limits.download.burst) / rate * 0.9
+
+def test_failing_web_seed_gives_pieces_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(webseed, 'RETRY_DELAY', 0.01)
+    ranges = []
+
+    async def run():
+        runner, url = await http_server(tmp_path, ranges)
+        pm = PieceManager(METADATA)
+        seed = WebSeed(url, METADATA, pm, None, None, requests=2)
+        await asyncio.wait_for(seed.run(), 10)
+        await runner.cleanup()
+        return pm, seed
+
+    pm, seed = asyncio.run(run())
+    assert seed.failures >= webseed.MAX_FAILURES
+    assert len(ranges) >= webseed.MAX_FAILURES
+    assert set(pm.state) == {MISSING} and pm.seeds == 0
@@ -0,0 +1,57 @@
+# File: test/test_writer.py
+# -----------------------------
+import asyncio
+import threading
+import pytest
+from pieces.writer import DiskWriter
+
+class SlowStorage:
+    def __init__(self, piece_length, fail=False):
+        self.piece_length = piece_length
+        self.fail = fail
+        self.writes = []
+        self.release = threading.Event()
+
+    def write_block(self, index, offset, data):
+        self.release.wait(5)
+        if self.fail:
+            raise OSError(28, 'No space left on device')
+        self.writes.append((index, bytes(data)))
+
+def test_queued_pieces_are_coalesced():
+    storage = SlowStorage(4)
+
+    async def run():
+        disk = DiskWriter(storage, workers=1, max_pending=16)
+        futures = [disk.write(0, b'aaaa')]
+        # The only worker is stuck on piece 0; these pile up behind it
+        for index, piece in ((2, b'cccc'), (1, b'bbbb'), (5, b'ffff')):
+            futures.append(disk.write(index, piece))
+        assert disk.congested() and disk.pending_bytes == 16
+        waiter = asyncio.ensure_future(disk.wait())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+        storage.release.set()
+        await asyncio.gather(*futures)
+        await asyncio.wait_for(waiter, 1)
+        disk.close()
+        return disk
+
+    disk = asyncio.run(run())
+    assert storage.writes == [(0, b'aaaa'), (1, b'bbbbcccc'), (5, b'ffff')]
+    assert disk.pending_bytes == 0 and disk.writes == 3 and disk.pieces == 4
+
+def test_write_errors_reach_the_caller():
+    storage = SlowStorage(4, fail=True)
+    storage.release.set()
+
+    async def run():
+        disk = DiskWriter(storage)
+        try:
+            await disk.write(3, b'dddd')
+        finally:
+            await disk.drain()
+            disk.close()
+
+    with pytest.raises(OSError):
+        asyncio.run(run())
@@ -1,24 +1,68 @@
 # File: torrent_parser/parser.py
 # -----------------------------
-import bencodepy
 import hashlib
+import os
+import re
+from utils.bencode_utils import decode_torrent
+
+_DRIVE = re.compile(r'^[A-Za-z]:')
+
+class TorrentError(ValueError):
+    pass
 
 class TorrentParser:
     def __init__(self, filepath):
         self.filepath = filepath
 
     def parse(self):
-        raw = open(self.filepath, 'rb').read()
-        data = bencodepy.decode(raw)
+        with open(self.filepath, 'rb') as f:
+            raw = f.read()
+        # The info_hash covers the info dict exactly as it appears in the file
+        data, (start, end) = decode_torrent(raw)
         info = data[b'info']
-        info_encoded = bencodepy.encode(info)
-        info_hash = hashlib.sha1(info_encoded).digest()
+        info_hash = hashlib.sha1(memoryview(raw)[start:end]).digest()
         length = info.get(b'length') or sum(f[b'length'] for f in info[b'files'])
+        name = os.path.join(*self._path([info[b'name']]))
+        if b'files' in info:
+            files = [(os.path.join(name, *self._path(f[b'path'])), f[b'length'])
+                     for f in info[b'files']]
+        else:
+            files = [(name, length)]
+        announce = data.get(b'announce', b'').decode()
+        # BEP 12 tiers; a plain announce URL is a single one-tracker tier
+        tiers = [[url.decode() for url in tier] for tier in data.get(b'announce-list', [])]
+        tiers = [tier for tier in tiers if tier] or [[announce]]
+        # BEP 19 web seeds: one URL or a list of them
+        url_list = data.get(b'url-list', [])
+        if isinstance(url_list, bytes):
+            url_list = [url_list]
+        url_list = [url.decode() for url in url_list if isinstance(url, bytes) and url]
         return {
-            'announce': data[b'announce'].decode(),
+            'announce': announce,
+            'announce_list': tiers,
+            'url_list': url_list,
             'info_hash': info_hash,
             'piece_length': info[b'piece length'],
             'pieces': info[b'pieces'],
             'length': length,
-            'name': info[b'name'].decode()
-        }
\ No newline at end of file
+            'name': name,
+            'files': files
+        }
+
+    @staticmethod
+    def _path(parts):
+        # Components may hide separators ('../../x'), so split every one of
+        # them; anything that could leave the download directory is refused
+        clean = []
+        for raw in parts:
+            part = raw.decode()
+            if part.startswith(('/', os.sep)) or _DRIVE.match(part):
+                raise TorrentError(f'Absolute path in torrent: {part!r}')
+            for piece in re.split(r'[/%s]' % re.escape(os.sep), part):
+                if piece == '..':
+                    raise TorrentError(f'Parent directory in torrent path: {part!r}')
+                if piece and piece != '.':
+                    clean.append(piece)
+        if not clean:
+            raise TorrentError('Empty path in torrent')
+        return clean
\ No newline at end of file
@@ -1,67 +1,190 @@
 # File: tracker/client.py
 # -----------------------------
 import aiohttp
-import socket
-import struct
+import asyncio
+import logging
 import random
+import time
 import urllib.parse
-import bencodepy
+from peer.protocol import PEER_ID
+from tracker.compact import parse_compact_peers
+from tracker.udp import UDPTrackerClient, UDPTrackerError
+from utils import metrics
+from utils.bencode_utils import IncrementalDecoder, BencodeError
+
+DEFAULT_INTERVAL = 1800
+MIN_INTERVAL = 60            # never re-announce faster than this
+ANNOUNCE_TIMEOUT = 30       # deadline for one announce, whatever the protocol
+STOP_TIMEOUT = 5            # the stopped/completed announce must not hold up shutdown
+UDP_TIMEOUT = 5.0           # first UDP retransmit; retries double it within ANNOUNCE_TIMEOUT
+UDP_RETRIES = 2
+
+log = logging.getLogger('TrackerClient')
+ANNOUNCE_LATENCY = metrics.histogram('tracker_announce_seconds', 'Duration of successful announces')
+ANNOUNCE_FAILURES = metrics.counter('tracker_announce_failures_total', 'Announces that raised an error')
+
+class TrackerError(Exception):
+    pass
 
 class TrackerClient:
-    def __init__(self, metadata):
+    def __init__(self, metadata, piece_manager=None, session=None, peer_id=PEER_ID):
         self.metadata = metadata
+        self.piece_manager = piece_manager
+        self.peer_id = peer_id   # the same id peers see in our handshakes
+        self.port = 6881
+        # BEP 12: trackers within a tier are tried in random order
+        self.tiers = [list(tier) for tier in metadata.get('announce_list') or [[metadata['announce']]]]
+        for tier in self.tiers:
+            random.shuffle(tier)
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = MIN_INTERVAL
+        # One pooled keep-alive session for every HTTP tracker, possibly shared
+        self._session = session
+        self._own_session = session is None
+
+    async def get_peers(self, event='started', on_peers=None):
+        # on_peers, if given, is called with each tracker's peers as soon as
+        # it answers, so one slow tracker does not hold back the others
+        log.info("Getting peers from tracker...")
+        for tier in self.tiers:
+            # Announce to the whole tier at once and merge the answers
+            peers = {}
+            intervals = []
+            failed = set()
+            for future in asyncio.as_completed([self._announce_from(url, event) for url in tier]):
+                url, result = await future
+                if isinstance(result, Exception):
+                    log.warning("%s failed: %r", url, result)
+                    failed.add(url)
+                    continue
+                peers.update(dict.fromkeys(result['peers']))
+                intervals.append(result)
+                if on_peers is not None and result['peers']:
+                    on_peers(result['peers'])
+            if intervals:
+                # Remember which trackers answered so they are tried first next time
+                tier.sort(key=lambda url: url in failed)
+                self.interval = min(r['interval'] for r in intervals) or DEFAULT_INTERVAL
+                self.min_interval = max(MIN_INTERVAL, max(r['min_interval'] for r in intervals))
+                if not peers:
+                    log.info("No peers in response")
+                return list(peers)
+        return []
+
+    async def run(self, on_peers):
+        # Re-announce every interval until cancelled
+        while True:
+            await asyncio.sleep(max(self.interval, self.min_interval))
+            peers = await self.get_peers('none')
+            if peers:
+                on_peers(peers)
+
+    async def close(self, event=None):
+        try:
+            if event:
+                await asyncio.wait_for(self.get_peers(event), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.info("No answer to the %s announce in %ss", event, STOP_TIMEOUT)
+        finally:
+            if self._own_session and self._session is not None:
+                await self._session.close()
+            self._session = None
+
+    def _stats(self):
+        pm = self.piece_manager
+        if pm is None:
+            return 0, 0, self.metadata['length']
+        return pm.uploaded, pm.downloaded, pm.bytes_left()
 
-    async def get_peers(self):
-        print("[TrackerClient] Getting peers from tracker...")
-        url = self._build_announce_url()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                data = await resp.read()
-                if data.startswith(b'<'):
-                    print("[TrackerClient] Invalid tracker response (HTML)")
-                    return []
-                try:
-                    decoded = bencodepy.decode(data)
-                except Exception as err:
-                    print("[TrackerClient] Decode error:", err)
-                    return []
-                if b'failure reason' in decoded:
-                    print("[TrackerClient] Tracker failure:", decoded[b'failure reason'].decode(errors='ignore'))
-                    return []
-                peers = []
-                pd = decoded.get(b'peers') or decoded.get(b'peers6')
-                if not pd:
-                    print("[TrackerClient] No peers in response")
-                    return []
-                for i in range(0, len(pd), 6):
-                    ip = socket.inet_ntoa(pd[i:i+4])
-                    port = struct.unpack('>H', pd[i+4:i+6])[0]
-                    peers.append((ip, port))
-                return peers
+    async def _announce_from(self, url, event):
+        # (url, response or exception) for as_completed
+        try:
+            return url, await self._announce(url, event)
+        except Exception as e:
+            return url, e
 
-    def _build_announce_url(self):
-        orig = self.metadata['announce']
-        tracker_url = orig
-        if orig.startswith('udp://'):
-            print(f"[TrackerClient] UDP announce, switching to HTTP fallback")
-            tracker_url = 'http://tracker.opentrackr.org:1337/announce'
+    async def _announce(self, url, event):
+        start = time.monotonic()
+        try:
+            if url.startswith('udp://'):
+                announce = self._announce_udp(url, event)
+            elif url.startswith(('http://', 'https://')):
+                announce = self._announce_http(url, event)
+            else:
+                raise TrackerError(f'Unsupported tracker {url}')
+            resp = await asyncio.wait_for(announce, ANNOUNCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            ANNOUNCE_FAILURES.inc()
+            raise TrackerError(f'No answer from {url} in {ANNOUNCE_TIMEOUT}s')
+        except Exception:
+            ANNOUNCE_FAILURES.inc()
+            raise
+        ANNOUNCE_LATENCY.observe(time.monotonic() - start)
+        return resp
+
+    async def _announce_udp(self, url, event):
+        uploaded, downloaded, left = self._stats()
+        client = UDPTrackerClient(url, timeout=UDP_TIMEOUT, retries=UDP_RETRIES)
+        try:
+            resp = await client.announce(self.metadata['info_hash'], self.peer_id, self.port,
+                                         uploaded=uploaded, downloaded=downloaded, left=left,
+                                         event=event)
+        except (OSError, UDPTrackerError) as err:
+            raise TrackerError(err)
+        resp['min_interval'] = 0
+        return resp
+
+    async def _announce_http(self, url, event):
+        if self._session is None:
+            timeout = aiohttp.ClientTimeout(total=ANNOUNCE_TIMEOUT)
+            self._session = aiohttp.ClientSession(timeout=timeout)
+        decoder = IncrementalDecoder()
+        try:
+            async with self._session.get(self._build_announce_url(url, event)) as resp:
+                # Decode as chunks arrive and stop once the dict is complete
+                async for chunk in resp.content.iter_any():
+                    if not decoder.buffer and chunk.startswith(b'<'):
+                        raise TrackerError('Invalid tracker response (HTML)')
+                    if decoder.feed(chunk) is not None:
+                        break
+            decoded = decoder.close()
+        except BencodeError as err:
+            raise TrackerError(f'Decode error: {err}')
+        if not isinstance(decoded, dict):
+            raise TrackerError('Decode error: response is not a dict')
+        if b'failure reason' in decoded:
+            raise TrackerError(decoded[b'failure reason'].decode(errors='ignore'))
+        peers = decoded.get(b'peers', b'')
+        if isinstance(peers, list):
+            # Non-compact response: a list of dicts
+            peers = [(p[b'ip'].decode(), p[b'port']) for p in peers]
+        else:
+            peers = parse_compact_peers(peers)
+        return {
+            'interval': decoded.get(b'interval', DEFAULT_INTERVAL),
+            'min_interval': decoded.get(b'min interval', 0),
+            'peers': peers + parse_compact_peers(decoded.get(b'peers6', b''), ipv6=True),
+        }
+
+    def _build_announce_url(self, tracker_url, event='started'):
+        uploaded, downloaded, left = self._stats()
         ih = urllib.parse.quote_from_bytes(self.metadata['info_hash'])
-        pid = (b'-PC0001-' + bytes(random.randint(0,9) for _ in range(12)))
         params = {
             'info_hash': ih,
-            'peer_id': pid,
-            'port': 6881,
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.metadata['length'],
+            'peer_id': self.peer_id,
+            'port': self.port,
+            'uploaded': uploaded,
+            'downloaded': downloaded,
+            'left': left,
             'compact': 1,
-            'event': 'started'
         }
+        if event != 'none':
+            params['event'] = event
         parts = []
         for k,v in params.items():
             if isinstance(v, bytes):
                 parts.append(f"{k}={urllib.parse.quote_from_bytes(v)}")
             else:
                 parts.append(f"{k}={v}")
-        return f"{tracker_url}?{'&'.join(parts)}"
-
+        sep = '&' if '?' in tracker_url else '?'
+        return f"{tracker_url}{sep}{'&'.join(parts)}"
@@ -0,0 +1,16 @@
+# File: tracker/compact.py
+# -----------------------------
+import socket
+import struct
+
+def parse_compact_peers(data, ipv6=False):
+    # BEP 23 / BEP 7 compact peers: 4 or 16 address bytes then a 2-byte port
+    family, size = (socket.AF_INET6, 16) if ipv6 else (socket.AF_INET, 4)
+    step = size + 2
+    peers = []
+    for i in range(0, len(data) - step + 1, step):
+        ip = socket.inet_ntop(family, data[i:i+size])
+        port = struct.unpack_from('>H', data, i + size)[0]
+        if port:
+            peers.append((ip, port))
+    return peers
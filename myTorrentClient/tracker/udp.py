@@ -0,0 +1,149 @@
+# File: tracker/udp.py
+# -----------------------------
+# UDP tracker protocol (BEP 15)
+import asyncio
+import logging
+import random
+import socket
+import struct
+import time
+import urllib.parse
+from tracker.compact import parse_compact_peers
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {'none': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+CONNECTION_TTL = 60.0
+
+log = logging.getLogger('UDPTracker')
+
+# (host, port) -> (connection_id, expiry); IDs are per tracker, not per torrent
+_connections = {}
+
+class UDPTrackerError(Exception):
+    pass
+
+class _TrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.waiters = {}   # transaction id -> future
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        action, tid = struct.unpack_from('>II', data)
+        waiter = self.waiters.pop(tid, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result((action, data[8:]))
+
+    def error_received(self, exc):
+        self._fail(exc)
+
+    def connection_lost(self, exc):
+        self._fail(exc or ConnectionError('UDP tracker socket closed'))
+
+    def _fail(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+        self.waiters.clear()
+
+class UDPTrackerClient:
+    def __init__(self, url, timeout=15.0, retries=8):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        # BEP 15 retransmit schedule: timeout * 2 ** n for n in 0..retries
+        self.timeout = timeout
+        self.retries = retries
+
+    async def announce(self, info_hash, peer_id, port, uploaded=0, downloaded=0, left=0,
+                       event='started', num_want=-1, key=None):
+        key = random.getrandbits(32) if key is None else key
+        body = struct.pack('>20s20sQQQIIIiH', info_hash, peer_id, downloaded, left, uploaded,
+                           EVENTS[event], 0, key, num_want, port)
+        async with self._endpoint() as protocol:
+            data = await self._transact(protocol, ACTION_ANNOUNCE, body)
+            ipv6 = protocol.transport.get_extra_info('socket').family == socket.AF_INET6
+        if len(data) < 12:
+            raise UDPTrackerError('Short announce response')
+        interval, leechers, seeders = struct.unpack_from('>III', data)
+        return {
+            'interval': interval,
+            'leechers': leechers,
+            'seeders': seeders,
+            'peers': parse_compact_peers(data[12:], ipv6),
+        }
+
+    async def scrape(self, info_hashes):
+        async with self._endpoint() as protocol:
+            data = await self._transact(protocol, ACTION_SCRAPE, b''.join(info_hashes))
+        results = []
+        for i in range(min(len(info_hashes), len(data) // 12)):
+            seeders, completed, leechers = struct.unpack_from('>III', data, i * 12)
+            results.append({'seeders': seeders, 'completed': completed, 'leechers': leechers})
+        return results
+
+    def _endpoint(self):
+        return _Endpoint(self.host, self.port)
+
+    async def _connection_id(self, protocol):
+        key = (self.host, self.port)
+        cached = _connections.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        data = await self._transact(protocol, ACTION_CONNECT, b'')
+        if len(data) < 8:
+            raise UDPTrackerError('Short connect response')
+        connection_id = struct.unpack_from('>Q', data)[0]
+        _connections[key] = (connection_id, time.monotonic() + CONNECTION_TTL)
+        return connection_id
+
+    async def _transact(self, protocol, action, body):
+        loop = asyncio.get_running_loop()
+        tid = random.getrandbits(32)
+        waiter = loop.create_future()
+        protocol.waiters[tid] = waiter
+        try:
+            for attempt in range(self.retries + 1):
+                if action == ACTION_CONNECT:
+                    connection_id = PROTOCOL_ID
+                else:
+                    # Re-fetched every attempt in case the cached ID expired meanwhile
+                    connection_id = await self._connection_id(protocol)
+                protocol.transport.sendto(struct.pack('>QII', connection_id, action, tid) + body)
+                try:
+                    reply, data = await asyncio.wait_for(asyncio.shield(waiter),
+                                                         self.timeout * 2 ** attempt)
+                    break
+                except asyncio.TimeoutError:
+                    log.debug("No reply from %s:%s, retransmitting", self.host, self.port)
+            else:
+                raise UDPTrackerError(f'{self.host}:{self.port} did not respond')
+        finally:
+            protocol.waiters.pop(tid, None)
+        if reply == ACTION_ERROR:
+            _connections.pop((self.host, self.port), None)
+            raise UDPTrackerError(data.decode(errors='ignore'))
+        if reply != action:
+            raise UDPTrackerError(f'Unexpected action {reply}')
+        return data
+
+class _Endpoint:
+    def __init__(self, host, port):
+        self.addr = (host, port)
+        self.protocol = None
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        _, self.protocol = await loop.create_datagram_endpoint(_TrackerProtocol, remote_addr=self.addr)
+        return self.protocol
+
+    async def __aexit__(self, *exc):
+        self.protocol.transport.close()
@@ -1,9 +1,187 @@
-# Folder: utils/bencode_utils.py
+# File: utils/bencode_utils.py
 # -----------------------------
-# Optional custom bencode
-# -----------------------------
-class PieceManager:
-    def __init__(self, metadata):
-        self.metadata = metadata
-    def next_piece(self): pass
-    def verify_piece(self, data, h): pass
+# Bencode decoder/encoder. The decoder records the byte span of top-level
+# dict values so the info_hash is hashed from the original bytes, and can
+# hand out large strings as memoryviews instead of copies.
+
+MAX_DEPTH = 100   # nested lists/dicts; far beyond any real torrent or tracker reply
+
+class BencodeError(ValueError):
+    pass
+
+class _Incomplete(BencodeError):
+    pass
+
+class Decoder:
+    def __init__(self, data, view_keys=()):
+        self.data = bytes(data) if not isinstance(data, bytes) else data
+        self.view = memoryview(self.data)
+        # String values under these dict keys come back as zero-copy memoryviews
+        self.view_keys = frozenset(view_keys)
+        self.spans = {}   # top-level key -> (start, end) of its encoded value
+
+    def decode(self):
+        value, end = self._decode(0, 0, False)
+        if end != len(self.data):
+            raise BencodeError(f'Trailing data at offset {end}')
+        return value
+
+    def _decode(self, pos, depth, as_view):
+        data = self.data
+        try:
+            c = data[pos]
+        except IndexError:
+            raise _Incomplete('Truncated data')
+        if 0x30 <= c <= 0x39:   # <length>:<bytes>
+            colon = data.find(b':', pos)
+            if colon < 0:
+                raise _Incomplete('Truncated string length')
+            length = data[pos:colon]
+            if not length.isdigit():
+                raise BencodeError(f'Bad string length at offset {pos}')
+            start = colon + 1
+            end = start + int(length)
+            if end > len(data):
+                raise _Incomplete('Truncated string')
+            return (self.view[start:end] if as_view else data[start:end]), end
+        if c == 0x69:   # i<int>e
+            end = data.find(b'e', pos)
+            if end < 0:
+                raise _Incomplete('Truncated integer')
+            try:
+                return int(data[pos + 1:end]), end + 1
+            except ValueError:
+                raise BencodeError(f'Bad integer at offset {pos}')
+        if depth >= MAX_DEPTH and c in (0x6c, 0x64):
+            raise BencodeError(f'Nesting deeper than {MAX_DEPTH} at offset {pos}')
+        if c == 0x6c:   # l...e
+            items = []
+            pos += 1
+            while True:
+                if pos >= len(data):
+                    raise _Incomplete('Truncated list')
+                if data[pos] == 0x65:
+                    return items, pos + 1
+                item, pos = self._decode(pos, depth + 1, False)
+                items.append(item)
+        if c == 0x64:   # d...e
+            result = {}
+            pos += 1
+            while True:
+                if pos >= len(data):
+                    raise _Incomplete('Truncated dict')
+                if data[pos] == 0x65:
+                    return result, pos + 1
+                key, pos = self._decode(pos, depth + 1, False)
+                if not isinstance(key, bytes):
+                    raise BencodeError(f'Non-string dict key at offset {pos}')
+                start = pos
+                result[key], pos = self._decode(pos, depth + 1, key in self.view_keys)
+                if depth == 0:
+                    self.spans[key] = (start, pos)
+        raise BencodeError(f'Unexpected byte {c!r} at offset {pos}')
+
+def decode(data):
+    return Decoder(data).decode()
+
+def decode_torrent(raw):
+    # Returns (metadata dict, (start, end) of the raw info dict); 'pieces' is
+    # a memoryview into raw
+    decoder = Decoder(raw, view_keys=(b'pieces',))
+    data = decoder.decode()
+    if not isinstance(data, dict) or b'info' not in decoder.spans:
+        raise BencodeError('Not a torrent: missing info dict')
+    return data, decoder.spans[b'info']
+
+class IncrementalDecoder:
+    # Accumulates chunks (e.g. an HTTP tracker response body) and returns the
+    # decoded value as soon as it is complete. Each chunk is only scanned for
+    # the end of the value; the buffer is decoded once, when that is found.
+    def __init__(self):
+        self.buffer = bytearray()
+        self.value = None
+        self.done = False
+        self._pos = 0     # scanned up to here
+        self._depth = 0   # lists/dicts open at _pos
+
+    def feed(self, chunk):
+        if self.done:
+            raise BencodeError('Data after complete value')
+        self.buffer += chunk
+        if not self._scan():
+            return None
+        self.value = Decoder(self.buffer).decode()
+        self.done = True
+        return self.value
+
+    def _scan(self):
+        # True once the top-level value may be complete. Malformed input also
+        # returns True so that the full decode reports the error.
+        buf = self.buffer
+        pos, depth = self._pos, self._depth
+        try:
+            while pos < len(buf):
+                c = buf[pos]
+                if 0x30 <= c <= 0x39:
+                    colon = buf.find(b':', pos)
+                    if colon < 0:
+                        return len(buf) - pos > 20
+                    length = bytes(buf[pos:colon])
+                    if not length.isdigit():
+                        return True
+                    end = colon + 1 + int(length)
+                    if end > len(buf):
+                        return False
+                    pos = end
+                elif c == 0x69:
+                    end = buf.find(b'e', pos)
+                    if end < 0:
+                        return False
+                    pos = end + 1
+                elif c in (0x6c, 0x64):
+                    depth += 1
+                    pos += 1
+                    continue
+                elif c == 0x65 and depth:
+                    depth -= 1
+                    pos += 1
+                else:
+                    return True
+                if not depth:
+                    return True
+            return False
+        finally:
+            self._pos, self._depth = pos, depth
+
+    def close(self):
+        if not self.done:
+            raise BencodeError('Truncated data')
+        return self.value
+
+def encode(value):
+    parts = []
+    _encode(value, parts.append)
+    return b''.join(parts)
+
+def _encode(value, out):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        out(b'%d:' % len(value))
+        out(value)
+    elif isinstance(value, str):
+        _encode(value.encode(), out)
+    elif isinstance(value, bool) or not isinstance(value, (int, list, tuple, dict)):
+        raise BencodeError(f'Cannot bencode {type(value).__name__}')
+    elif isinstance(value, int):
+        out(b'i%de' % value)
+    elif isinstance(value, (list, tuple)):
+        out(b'l')
+        for item in value:
+            _encode(item, out)
+        out(b'e')
+    else:
+        out(b'd')
+        items = ((k.encode() if isinstance(k, str) else bytes(k), v) for k, v in value.items())
+        for key, item in sorted(items):
+            _encode(key, out)
+            _encode(item, out)
+        out(b'e')
@@ -0,0 +1,119 @@
+# File: utils/metrics.py
+# -----------------------------
+# Process-wide counters and histograms. Recording is a few integer
+# operations; names, percentiles and text are only produced when read.
+from bisect import bisect_left
+
+# Upper bucket bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = tuple(2 ** n for n in range(10, 28, 2))      # 1 KiB/s .. 128 MiB/s
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def prometheus(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter',
+                f'{self.name} {self.value}']
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, name, help='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)   # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+    def prometheus(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def prometheus(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, cls, name, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'{name} is already registered as a {type(metric).__name__}')
+        return metric
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
+
+async def serve(port, host='127.0.0.1', registry=REGISTRY):
+    # Prometheus text endpoint at http://host:port/metrics; returns the
+    # runner so the caller can clean it up
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,61 @@
+# File: utils/ratelimit.py
+# -----------------------------
+# Token buckets for the socket read/write path. A torrent's buckets hang off
+# the global ones; every byte is charged to the whole chain.
+import asyncio
+import time
+
+BURST_SECONDS = 0.25     # bucket depth, as seconds of traffic at the set rate
+MIN_BURST = 2 ** 14
+
+class TokenBucket:
+    def __init__(self, rate=0, parent=None):
+        self.parent = parent
+        self.rate = 0
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        # Bytes per second, 0 for unlimited; takes effect for the next transfer
+        self._refill()
+        self.rate = max(0, rate)
+        self.burst = max(MIN_BURST, self.rate * BURST_SECONDS)
+        self.tokens = min(self.tokens, self.burst)
+
+    def limited(self):
+        return bool(self.rate) or (self.parent is not None and self.parent.limited())
+
+    def charge(self, size):
+        # Takes size bytes and returns how long to wait before using them.
+        # Tokens may go negative: each caller queues behind the debt of the
+        # ones before it, which shares the rate fairly across peers.
+        delay = 0.0
+        if self.rate:
+            self._refill()
+            self.tokens -= size
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+        if self.parent is not None:
+            delay = max(delay, self.parent.charge(size))
+        return delay
+
+    async def consume(self, size):
+        delay = self.charge(size)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+class TransferLimits:
+    def __init__(self, download_rate=0, upload_rate=0, parent=None):
+        self.download = TokenBucket(download_rate, parent and parent.download)
+        self.upload = TokenBucket(upload_rate, parent and parent.upload)
+
+    def set_rates(self, download_rate, upload_rate):
+        self.download.set_rate(download_rate)
+        self.upload.set_rate(upload_rate)